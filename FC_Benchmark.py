@@ -0,0 +1,334 @@
+"""
+FC_Benchmark
+
+Synthetic follower/following exports and benchmarks of the import and read paths.
+Run "python FC_Benchmark.py -h" for the generate, run and compare commands.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+from os.path import abspath, dirname, join
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import FC_DataClasses as dc
+from FC_DBAccess import dbAccessor
+
+
+# Folder holding this file, static data and migrations are found from here so benchmarks run from any directory
+FC_ROOT = dirname(abspath(__file__))
+
+# Benchmark scales: audience per account, daily snapshots, fraction of the audience that changes per snapshot, accounts
+SCALES = {
+    "small": {"users": 2000, "snapshots": 5, "churn": 0.02, "accounts": 1},
+    "medium": {"users": 20000, "snapshots": 10, "churn": 0.02, "accounts": 2},
+    "large": {"users": 100000, "snapshots": 10, "churn": 0.01, "accounts": 2},
+}
+
+
+class export_generator():
+    """
+    Generator for realistic synthetic follower/following exports.
+    Every account has an audience of users, most follow it and it follows back some of them (mutuals are likelier than one-sided follows).
+    Each snapshot a churn fraction of the audience unfollows or starts following, accounts share part of their audience.
+    Output is seeded, the same settings always write the same exports.
+    """
+    # Chance a user in the audience follows the account when the history starts
+    P_FOLLOWER = 0.6
+    # Chance the account follows a user, for followers and for everyone else
+    P_FOLLOW_BACK = 0.5
+    P_FOLLOW_OTHER = 0.2
+    # Share of each account's audience drawn from users every account knows
+    SHARED_AUDIENCE = 0.3
+
+    def __init__(self,
+                 users: int = 10000,
+                 snapshots: int = 7,
+                 churn: float = 0.02,
+                 accounts: int = 1,
+                 seed: int = 0,
+                 start: datetime = datetime(2024, 5, 1)):
+        self.users = users
+        self.snapshots = snapshots
+        self.churn = churn
+        self.accounts = accounts
+        self.seed = seed
+        # Date of the first snapshot, later snapshots are a day apart
+        self.start = start
+
+    @staticmethod
+    def mk_username(rnd: random.Random) -> str:
+        """ Make an Instagram style username, lowercase letters with the odd digit run, "." or "_"."""
+        name = "".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(4, 14)))
+        roll = rnd.random()
+        if roll < 0.3:
+            name += str(rnd.randint(0, 9999))
+        elif roll < 0.45:
+            name = f"{name[:len(name) // 2]}{rnd.choice('._')}{name[len(name) // 2:]}"
+        return name
+
+    def _mk_audiences(self, rnd):
+        # Sample each account's audience, a shared pool every account draws from plus users only that account knows
+        shared_size = int(self.users * self.SHARED_AUDIENCE)
+        names = set()
+        while len(names) < shared_size + (self.users - shared_size) * self.accounts:
+            names.add(self.mk_username(rnd))
+        names = sorted(names)
+        rnd.shuffle(names)
+        shared, own = names[:shared_size], names[shared_size:]
+        own_size = self.users - shared_size
+        return [shared + own[i * own_size:(i + 1) * own_size] for i in range(self.accounts)]
+
+    def generate(self, out_dir) -> dict[str, list[tuple]]:
+        """
+        Write every account's snapshots as followers_<date>.json/following_<date>.json pairs in a folder per account.
+        The folders can be imported with "FollowerCenobite.py import" or munch_follow_data.
+
+        Args:
+            out_dir (str): Folder to write to, created if needed
+
+        Returns:
+            dict[str, list[tuple]]: Account username -> [(date key, follower json, following json)] oldest first
+        """
+        rnd = random.Random(self.seed)
+        exports = {}
+        for i, audience in enumerate(self._mk_audiences(rnd)):
+            acc_name = f"bench_acc_{i}"
+            acc_dir = join(out_dir, acc_name)
+            os.makedirs(acc_dir, exist_ok=True)
+
+            flwr = {u for u in audience if rnd.random() < self.P_FOLLOWER}
+            flwg = {u for u in audience if rnd.random() < (self.P_FOLLOW_BACK if u in flwr else self.P_FOLLOW_OTHER)}
+            exports[acc_name] = []
+            for day in range(self.snapshots):
+                if day:
+                    changed = max(1, int(len(audience) * self.churn))
+                    flwr.symmetric_difference_update(rnd.sample(audience, changed))
+                    flwg.symmetric_difference_update(rnd.sample(audience, changed // 2))
+                date = dc.to_date_key(self.start + timedelta(days=day))
+                flwr_path = join(acc_dir, f"followers_{date}.json")
+                flwg_path = join(acc_dir, f"following_{date}.json")
+                self._write_export(flwr_path, "relationships_followers", flwr)
+                self._write_export(flwg_path, "relationships_following", flwg)
+                exports[acc_name].append((date, flwr_path, flwg_path))
+        return exports
+
+    @staticmethod
+    def _write_export(path, key, users):
+        # Write one export in the flat {"relationships_...": [{"username": ...}]} layout munch_follow_data reads
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({key: [{"username": u} for u in sorted(users)]}, f)
+
+
+class benchmark():
+    """
+    Times the import and read paths on synthetic data at several scales.
+    Every scale gets a fresh database in a temp folder (or in memory), reads are repeated with the query cache cleared so every run hits SQLite.
+    """
+
+    def __init__(self,
+                 scales: list[str],
+                 repeat: int = 3,
+                 seed: int = 0,
+                 memory: bool = False):
+        self.scales = scales
+        self.repeat = repeat
+        self.seed = seed
+        # Run against in-memory databases, timings then leave out disk I/O
+        self.memory = memory
+
+    def run(self) -> dict:
+        """ Run every scale and return the results document (see save)."""
+        doc = {"meta": self.get_meta(), "results": []}
+        for scale in self.scales:
+            print(f"Benchmarking {scale} {SCALES[scale]}")
+            with tempfile.TemporaryDirectory(prefix="fc_bench_") as tmp:
+                for result in self._run_scale(scale, tmp):
+                    print(f"\t{result['op']:<40} best {result['best'] * 1000:10.2f} ms  median {result['median'] * 1000:10.2f} ms  {result['rows']:>10,} rows")
+                    doc["results"].append(result)
+        return doc
+
+    def get_meta(self) -> dict:
+        """ Describe the code and machine the benchmark ran on, so result files from different commits can be compared."""
+        try:
+            commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=FC_ROOT, capture_output=True, text=True).stdout.strip()
+            dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=FC_ROOT, capture_output=True, text=True).stdout.strip())
+        except OSError:
+            commit, dirty = None, None
+        return {"commit": commit or None,
+                "dirty": dirty,
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "repeat": self.repeat,
+                "seed": self.seed,
+                "memory": self.memory}
+
+    def _mk_db(self, folder) -> dbAccessor:
+        # Make an empty database in a folder, migrations and static data come from the repo
+        about = json.load(open(join(FC_ROOT, "FC_About.json")))
+        about["DataFolder"] = folder + os.sep
+        about["MigrationFolder"] = join(FC_ROOT, "ProgramData", "Migrations") + os.sep
+        for name in ("dbCreationScript.sql", "FC_Startup_Data.json"):
+            shutil.copy(join(FC_ROOT, "ProgramData", name), folder)
+        about_path = join(folder, "FC_About.json")
+        with open(about_path, "w") as f:
+            json.dump(about, f)
+        return dbAccessor(about_path, memory=self.memory)
+
+    def _run_scale(self, scale, tmp):
+        # Import a scale's exports, then time the reads on the first account
+        params = SCALES[scale]
+        exports = export_generator(seed=self.seed, **params).generate(join(tmp, "exports"))
+        os.makedirs(join(tmp, "db"))
+        dba = self._mk_db(join(tmp, "db"))
+        try:
+            accs = []
+            for name in exports:
+                acc = dba.obj_f.ig_account(-1, name, name[-3:], exports[name][0][0])
+                acc.id = dba.save_ig_account(acc)
+                accs.append(acc)
+
+            # Snapshots are imported day by day across accounts, like a daily job would
+            runs, rows = [], 0
+            for day in range(params["snapshots"]):
+                for acc, name in zip(accs, exports):
+                    date, flwr_path, flwg_path = exports[name][day]
+                    start = time.perf_counter()
+                    import_id = dba.munch_follow_data(flwr_path, flwg_path, acc.id, date)
+                    runs.append(time.perf_counter() - start)
+                    rows += dba.get_import(import_id).follow_count
+            yield self._mk_result(scale, "munch_follow_data", runs, rows, per_run_rows=rows / len(runs))
+
+            acc = accs[0]
+            reads = {
+                "get_newest_follows_by_acc": lambda: dba.get_newest_follows_by_acc(acc),
+                "get_newest_follows_by_acc[columnar]": lambda: dba.get_newest_follows_by_acc(acc, columnar=True),
+                "get_follows_by_acc": lambda: dba.get_follows_by_acc(acc),
+                "get_follows_by_acc[columnar]": lambda: dba.get_follows_by_acc(acc, columnar=True),
+                "_select[follow]": lambda: dba._select(dc.follow, suffix=f"WHERE acc_id = {acc.id}"),
+                "_select[last_follow]": lambda: dba._select(dc.last_follow, suffix=f"WHERE acc_id = {acc.id}"),
+            }
+            for op, read in reads.items():
+                runs = []
+                for _ in range(self.repeat):
+                    dba.clear_query_cache()
+                    start = time.perf_counter()
+                    result = read()
+                    runs.append(time.perf_counter() - start)
+                yield self._mk_result(scale, op, runs, len(result))
+        finally:
+            dba.close()
+
+    def _mk_result(self, scale, op, runs, rows, per_run_rows=None) -> dict:
+        # One timed operation, rows_per_s is worked out from the median run
+        median = statistics.median(runs)
+        per_run_rows = rows if per_run_rows is None else per_run_rows
+        return {"scale": scale,
+                "params": SCALES[scale],
+                "op": op,
+                "rows": rows,
+                "runs": runs,
+                "best": min(runs),
+                "median": median,
+                "rows_per_s": per_run_rows / median if median else None}
+
+    @staticmethod
+    def save(doc, path):
+        """ Write a results document as json: {"meta": {...}, "results": [{"scale", "op", "runs", "best", "median", ...}]}."""
+        with open(path, "w") as f:
+            json.dump(doc, f, indent=2)
+
+    @staticmethod
+    def compare(base: dict, new: dict, threshold: float = 0.1) -> int:
+        """
+        Print the median time of every operation in two results documents side by side.
+
+        Args:
+            base (dict): Results to compare against (e.g. from the previous commit)
+            new (dict): Results to check
+            threshold (float): Slowdown ratio flagged as a regression, 0.1 = 10% slower
+
+        Returns:
+            int: Number of regressions
+        """
+        base_times = {(x["scale"], x["op"]): x["median"] for x in base["results"]}
+        print(f"Comparing {new['meta'].get('commit')} against {base['meta'].get('commit')}")
+        if base["meta"].get("memory", False) != new["meta"].get("memory", False):
+            print("\tOne run used in-memory databases and the other didn't, timings aren't comparable")
+        regressions = 0
+        for x in new["results"]:
+            old = base_times.get((x["scale"], x["op"]))
+            if old is None:
+                print(f"\t{x['scale']:<8} {x['op']:<40} new")
+                continue
+            ratio = x["median"] / old if old else float("inf")
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            print(f"\t{x['scale']:<8} {x['op']:<40} {old * 1000:10.2f} ms -> {x['median'] * 1000:10.2f} ms  {ratio:6.2f}x {flag}")
+        return regressions
+
+
+def main(argv=None) -> int:
+    """ Run a benchmark command, see -h."""
+    parser = argparse.ArgumentParser(prog="FC_Benchmark", description="FollowerCenobite synthetic data and benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("generate", help="Write synthetic exports, one folder of dated exports per account")
+    cmd.add_argument("out", help="Folder to write to")
+    cmd.add_argument("--users", type=int, default=10000, help="Audience per account")
+    cmd.add_argument("--snapshots", type=int, default=7, help="Daily snapshots per account")
+    cmd.add_argument("--churn", type=float, default=0.02, help="Fraction of the audience that changes per snapshot")
+    cmd.add_argument("--accounts", type=int, default=1)
+    cmd.add_argument("--seed", type=int, default=0)
+
+    cmd = commands.add_parser("run", help="Benchmark the import and read paths")
+    cmd.add_argument("--scales", default="small,medium", help=f"Comma separated scales from {', '.join(SCALES)}")
+    cmd.add_argument("--repeat", type=int, default=3, help="Runs per read")
+    cmd.add_argument("--seed", type=int, default=0)
+    cmd.add_argument("--out", default="bench_results.json", help="Results json")
+    cmd.add_argument("--compare", help="Results json of an earlier run to compare against")
+    cmd.add_argument("--memory", action="store_true", help="Use in-memory databases")
+
+    cmd = commands.add_parser("compare", help="Compare two results files")
+    cmd.add_argument("base")
+    cmd.add_argument("new")
+    cmd.add_argument("--threshold", type=float, default=0.1, help="Slowdown ratio flagged as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        exports = export_generator(args.users, args.snapshots, args.churn, args.accounts, args.seed).generate(args.out)
+        for name, snapshots in exports.items():
+            print(f"{name}: {len(snapshots)} snapshots in {join(args.out, name)}")
+        return 0
+
+    if args.command == "compare":
+        return 1 if benchmark.compare(json.load(open(args.base)), json.load(open(args.new)), args.threshold) else 0
+
+    scales = args.scales.split(",")
+    unknown = [x for x in scales if x not in SCALES]
+    if unknown:
+        print(f"Unknown scales {unknown}, pick from {list(SCALES)}", file=sys.stderr)
+        return 2
+    doc = benchmark(scales, args.repeat, args.seed, args.memory).run()
+    benchmark.save(doc, args.out)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        return 1 if benchmark.compare(json.load(open(args.compare)), doc) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""
+FC_CLI
+
+Headless commands for bulk imports and reports, never imports the UI stack
+"""
+import argparse
+import csv
+from datetime import datetime
+import os
+import sys
+import time
+import FC_DataClasses as dc
+import FC_ExportParser as ep
+from FC_DBAccess import dbAccessor
+from FC_Import import import_job, import_scheduler
+from FC_ImportProfile import CAPTURES, format_report
+from FC_Watch import export_watcher
+
+
+class fc_cli():
+    """
+    FC command line interface.
+    Each command is a cmd_<name> method, output goes to stdout and problems are printed to stderr.
+    """
+
+    def __init__(self,
+                 args: argparse.Namespace,
+                 launched: float = None):
+        self.args = args
+        # perf_counter() when the launcher started, used to report startup time
+        self.launched = launched if launched is not None else time.perf_counter()
+        self.dba = None
+
+    @staticmethod
+    def mk_parser() -> argparse.ArgumentParser:
+        """ Make the argument parser for every command."""
+        parser = argparse.ArgumentParser(prog="FollowerCenobite", description="Headless FollowerCenobite commands, run without a command for the UI.")
+        parser.add_argument("--about", default="FC_About.json", help="About.json of the database to use")
+        parser.add_argument("--timing", action="store_true", help="Print startup and total time to stderr")
+        parser.add_argument("--profile", action="store_true", help="Print the statements the command ran, grouped by shape, to stderr")
+        parser.add_argument("--slow-ms", type=float, default=100.0, help="With --profile, statements slower than this are logged")
+        parser.add_argument("--slow-log", default=None, help="With --profile, file slow statements are appended to as json lines")
+        parser.add_argument("--stages", action="store_true", help="Print every import's stage report (time, peak RSS, items per stage) to stderr")
+        parser.add_argument("--capture", choices=CAPTURES + ("all",), default=None,
+                            help="Capture a cProfile (.prof file) or tracemalloc peaks of every import's write, overrides FC_IMPORT_PROFILE")
+        commands = parser.add_subparsers(dest="command", required=True)
+
+        cmd = commands.add_parser("import", help="Import a directory of dated exports for an account")
+        cmd.add_argument("account", help="Account ID, username or abbreviation")
+        cmd.add_argument("path", help="Directory of follower/following json pairs or export directories/zips with dates in their names")
+        fc_cli._add_import_args(cmd)
+
+        cmd = commands.add_parser("batch", help="Import directories of dated exports for many accounts at once")
+        cmd.add_argument("imports", nargs="+", metavar="ACCOUNT=PATH", help="Account ID, username or abbreviation and its export directory")
+        fc_cli._add_import_args(cmd)
+
+        cmd = commands.add_parser("watch", help="Import exports as they are dropped into a directory, until stopped with Ctrl+C")
+        cmd.add_argument("path", nargs="?", help="Directory to watch, defaults to the data directory in preferences")
+        cmd.add_argument("--account", help="Account of exports that don't name one (ID, username or abbreviation), defaults to the default account")
+        cmd.add_argument("--interval", type=float, default=2.0, help="Seconds between looks at the directory")
+        cmd.add_argument("--settle", type=float, default=5.0, help="Seconds an export's files must stay unchanged before it is imported")
+        cmd.add_argument("--once", action="store_true", help="Import what is in the directory once it settled, then exit")
+        fc_cli._add_import_args(cmd, "half the CPU count")
+
+        cmd = commands.add_parser("stats", help="Print an account's follower counts per import")
+        cmd.add_argument("account", help="Account ID, username or abbreviation")
+        cmd.add_argument("--start", help="First date (20240530 or the About.json date format)")
+        cmd.add_argument("--end", help="Last date (20240530 or the About.json date format)")
+
+        cmd = commands.add_parser("export", help="Write an account's current follower/following/dfb/idfb list as csv")
+        cmd.add_argument("account", help="Account ID, username or abbreviation")
+        cmd.add_argument("view", choices=list(dbAccessor.PAGE_VIEWS), help="List to export")
+        cmd.add_argument("--sort", choices=list(dbAccessor.PAGE_SORTS), default="username")
+        cmd.add_argument("--desc", action="store_true", help="Sort descending")
+        cmd.add_argument("--out", help="Output file, defaults to stdout")
+
+        commands.add_parser("accounts", help="List accounts with their latest counts")
+        return parser
+
+    @staticmethod
+    def _add_import_args(cmd, workers="the CPU count"):
+        # Options shared by the import commands
+        cmd.add_argument("--create", action="store_true", help="Create accounts that don't exist")
+        cmd.add_argument("--delta", action="store_true", help="Only store users whose relationship changed")
+        cmd.add_argument("--workers", type=int, default=None, help=f"Parser processes, defaults to {workers}")
+
+    @classmethod
+    def from_argv(cls, argv, launched=None):
+        """ Make a CLI from command line arguments."""
+        return cls(cls.mk_parser().parse_args(argv), launched)
+
+    def run(self) -> int:
+        """ Run the parsed command, returns the process exit code."""
+        self.dba = dbAccessor(self.args.about)
+        if self.args.timing:
+            self._err(f"startup {(time.perf_counter() - self.launched) * 1000:.0f} ms")
+        if self.args.profile:
+            self.dba.start_profiling(self.args.slow_ms, self.args.slow_log)
+        if self.args.capture:
+            self.dba.import_capture = self.args.capture
+        try:
+            return getattr(self, f"cmd_{self.args.command}")()
+        except BrokenPipeError:
+            # Output was piped into something that stopped reading (e.g. head), point stdout at devnull so exiting doesn't fail again
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+        finally:
+            if self.args.profile:
+                profiler = self.dba.stop_profiling()
+                self._err(profiler.report())
+                for x in profiler.slow:
+                    self._err(f"slow {x['ms']:.1f} ms  {x['site']}  {x['statement'][:160]}")
+            self.dba.close()
+            if self.args.timing:
+                self._err(f"total {time.perf_counter() - self.launched:.2f} s")
+
+    # region Helpers
+    @staticmethod
+    def _err(text):
+        # Print to stderr so reports on stdout stay clean
+        print(text, file=sys.stderr)
+
+    @staticmethod
+    def _rate(rows, seconds) -> str:
+        # Format a rows/sec throughput
+        return f"{rows / seconds:,.0f} rows/s" if seconds > 0 else "- rows/s"
+
+    def _get_account(self, key, create=False) -> dc.ig_account:
+        # Find an account by ID, username or abbreviation, optionally creating it
+        for acc in self.dba.get_ig_accounts().values():
+            if key in (str(acc.id), acc.username, acc.abbrv):
+                return acc
+        if create:
+            acc = self.dba.obj_f.ig_account(-1, key, key[:3], dc.to_date_key(datetime.today()))
+            acc.id = self.dba.save_ig_account(acc)
+            print(f"Created account {key} (ID {acc.id})")
+            return acc
+        self._err(f"No account {key} was found (use --create to add it)")
+        return None
+
+    def _get_date(self, text):
+        # Parse a date argument to a date key
+        if text is None:
+            return None
+        date = ep.parse_date_key(text, self.dba.date_format)
+        if date is None:
+            self._err(f"Couldn't read a date from {text}")
+        return date
+    # endregion
+
+    # region Commands
+    def cmd_import(self) -> int:
+        """ Import every dated export in a directory, oldest first, printing throughput per export."""
+        return self._r_imports([(self.args.account, self.args.path)])
+
+    def cmd_batch(self) -> int:
+        """ Import directories of dated exports for many accounts in one scheduler run."""
+        pairs = [x.split("=", 1) for x in self.args.imports]
+        if any(len(x) != 2 for x in pairs):
+            self._err("Imports must be given as ACCOUNT=PATH")
+            return 1
+        return self._r_imports(pairs)
+
+    def _r_imports(self, pairs) -> int:
+        # Run the dated exports of each (account, directory) through the import scheduler
+        jobs = []
+        for key, path in pairs:
+            acc = self._get_account(key, self.args.create)
+            if not acc:
+                return 1
+            exports, skipped = ep.find_dated_exports(path, self.dba.date_format)
+            for name in skipped:
+                self._err(f"Skipping {name}, no date or no matching follower/following file")
+            jobs += [import_job(acc.id, date, source, self.args.delta) for date, source in exports]
+
+        start = time.perf_counter()
+        import_scheduler(self.dba, self.args.workers, self._print_job).run(jobs)
+        return self._print_imported(jobs, time.perf_counter() - start)
+
+    def cmd_watch(self) -> int:
+        """ Import exports dropped into a directory as soon as their files stop changing, see FC_Watch."""
+        acc = None
+        if self.args.account:
+            acc = self._get_account(self.args.account, self.args.create)
+            if not acc:
+                return 1
+        watcher = export_watcher(self.dba, self.args.path, self.args.interval, self.args.settle, self.args.workers, self.args.delta,
+                                 acc.id if acc else None, self._print_job)
+        if not os.path.isdir(watcher.path):
+            self._err(f"{watcher.path} is not a directory")
+            return 1
+
+        start = time.perf_counter()
+        if self.args.once:
+            return self._print_imported(watcher.drain(), time.perf_counter() - start)
+        print(f"Watching {watcher.path} for exports, stop with Ctrl+C")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def _print_imported(self, jobs, elapsed) -> int:
+        # Print the totals of a batch of import jobs, returns the exit code
+        total_rows = sum(job.rows for job in jobs)
+        print(f"Imported {total_rows:,} rows from {len(jobs)} exports in {elapsed:.2f} s ({self._rate(total_rows, elapsed)})")
+        return 1 if any(job.status == "failed" for job in jobs) else 0
+
+    def _print_job(self, job):
+        # Print a line for every finished import job
+        acc = self.dba.get_ig_account_by_id(job.acc_id)
+        if job.status == "done":
+            print(f"{acc.username:<20} {job.date}  import {job.import_id:<5} {job.rows:>9,} rows  "
+                  f"parse {job.parse_time:6.2f} s  write {job.write_time:6.2f} s  {self._rate(job.rows, job.write_time)} written")
+        elif job.status in ("skipped", "failed"):
+            print(f"{acc.username:<20} {job.date}  {job.status}{f' ({job.error})' if job.error else ''}")
+        if self.args.stages and job.report and job.is_finished():
+            self._err(format_report(job.report))
+
+    def cmd_stats(self) -> int:
+        """ Print the account's follow summary per import date."""
+        acc = self._get_account(self.args.account)
+        if not acc:
+            return 1
+        summaries = self.dba.get_summaries(acc, self._get_date(self.args.start), self._get_date(self.args.end))
+        if not summaries:
+            print(f"No imports for {acc.username}")
+            return 0
+        print(f"{'date':>10} {'followers':>10} {'following':>10} {'dfb':>8} {'idfb':>8} {'gained':>8} {'lost':>8}")
+        for s in summaries:
+            print(f"{s.date:>10} {s.follower:>10,} {s.following:>10,} {s.dfb:>8,} {s.idfb:>8,} {s.gained:>8,} {s.lost:>8,}")
+        return 0
+
+    def cmd_export(self) -> int:
+        """ Write a relationship view as csv (username, since) by paging through it, printing throughput to stderr."""
+        acc = self._get_account(self.args.account)
+        if not acc:
+            return 1
+        out = open(self.args.out, "w", newline="", encoding="utf-8") if self.args.out else sys.stdout
+        rows = 0
+        start = time.perf_counter()
+        try:
+            writer = csv.writer(out)
+            writer.writerow(["username", "since"])
+            after = None
+            while True:
+                page = self.dba.get_relation_page(acc, self.args.view, after, 5000, self.args.sort, self.args.desc)
+                if not page:
+                    break
+                writer.writerows((username, dc.from_date_key(since).date().isoformat()) for username, since in page)
+                rows += len(page)
+                after = page[-1]
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        elapsed = time.perf_counter() - start
+        self._err(f"Exported {rows:,} rows in {elapsed:.2f} s ({self._rate(rows, elapsed)})")
+        return 0
+
+    def cmd_accounts(self) -> int:
+        """ List every account with its latest counts."""
+        for acc in self.dba.get_ig_accounts().values():
+            s = self.dba.get_latest_summary(acc)
+            counts = f"{s.date}  {s.follower:,} followers  {s.following:,} following" if s else "no imports"
+            print(f"{acc.id:>4}  {acc.username:<30} {acc.abbrv:<6} {counts}")
+        return 0
+    # endregion
@@ -3,11 +3,18 @@ FC_DBAccess
 
 Contains controller classes for abstracted interaction with the DB
 """
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+from itertools import chain
+import threading
 import json
-from os import remove
-from os.path import isfile
+from os.path import dirname, join
+import sqlite3
+import sys
 import FC_DataClasses as dc
+import FC_ExportParser as ep
+from FC_ImportProfile import import_profile
 from FC_DBConnect import fcdb, Struct
 
 
@@ -16,14 +23,28 @@ class dbAccessor(fcdb):
     FC Controller Class
     Contains high-level methods for updating model with dbObj classes
     """
+    # Number of query results kept in the LRU query cache
+    QUERY_CACHE_SIZE = 64
 
-    def __init__(self, about="FC_About.json"):
-        super(dbAccessor, self).__init__(about)
+    def __init__(self, about="FC_About.json", pragmas=None, memory=None):
+        super(dbAccessor, self).__init__(about, pragmas, memory)
         self.menus = {}
         self.windows = {}
         self.w_subtypes = {}
         self.ig_accs = {}
 
+        # LRU query cache: (method, args, account IDs) -> (generations, result)
+        # Every write bumps the generation of the account it touched, entries read under an older generation are never served
+        self._query_cache = OrderedDict()
+        self._generations = {}
+        # Cache and generations are shared by every thread reading through this accessor
+        self._cache_lock = threading.RLock()
+
+        # Stage report of the last import (see FC_ImportProfile.import_profile.finish), also appended to import_log
+        self.last_import_report = None
+
+        self.obj_f.set_user_loader(self.get_usernames)
+
     # region Low Level
     def _get_all_obj(self, T: type[dc.dbObj]):
         return self._select(T)
@@ -50,7 +71,10 @@ class dbAccessor(fcdb):
     def save_active_prefs(self, prefs):
         """Updates prefs in DB and sets active prefs on DB connection."""
         self.set_new_prefs(prefs)
-        return self._update(prefs)
+        try:
+            return self._update(prefs)
+        finally:
+            self._bump_generation()
 
     def get_ig_accounts(self):
         """ Get all registered IG accounts."""
@@ -66,7 +90,10 @@ class dbAccessor(fcdb):
 
     def save_ig_account(self, acc: dc.ig_account):
         """ Save an IG account to DB."""
-        return self._insert(acc)
+        acc_id = self._insert(acc)
+        self.ig_accs = {}
+        self._bump_generation(acc.id if acc.has_static_id() else acc_id)
+        return acc_id
 
     def get_active_ig_account(self):
         """ Get the active IG account."""
@@ -77,113 +104,927 @@ class dbAccessor(fcdb):
         return self.ig_accs.get(self.active_prefs.default_acc_id)
     # endregion
 
-    # region Not Cached
-    def get_follows_by_acc(self, acc):
+    # region Users
+    # Schema version that moved follows and last_follows onto ig_user IDs
+    USER_SCHEMA_VERSION = 8
+
+    # Max user IDs bound in one lookup
+    USER_CHUNK = 500
+
+    def get_usernames(self, user_ids) -> dict[int, str]:
+        """ Get the usernames of user IDs, keyed by ID. Use obj_f.fmt_user(s) for display, it keeps resolved names."""
+        usernames = {}
+        for chunk in ep.iter_chunks(user_ids, self.USER_CHUNK):
+            rows = self._r_query(f"SELECT id, username FROM ig_user WHERE id IN ({', '.join('?' for _ in chunk)});", tuple(chunk))
+            usernames.update(rows or [])
+        return usernames
+
+    def get_user_id(self, username) -> int:
+        """ Get the ID of a username, or None if it was never imported."""
+        return self.first_or((None,), self._r_query("SELECT id FROM ig_user WHERE username = ?;", (username,)))[0]
+    # endregion
+
+    # region Query Cache
+    def _bump_generation(self, acc_id=None):
+        # Invalidate cached queries that read an account, or every cached query when acc_id is None (preferences changed)
+        key = acc_id if acc_id is not None else "prefs"
+        with self._cache_lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._generations["all"] = self._generations.get("all", 0) + 1
+
+            # Drop the stale entries now instead of letting them age out of the LRU
+            for cache_key in [k for k in self._query_cache if acc_id is None or k[2] is None or acc_id in k[2]]:
+                del self._query_cache[cache_key]
+
+    def _get_generations(self, acc_ids):
+        # Generations a cached result depends on, acc_ids None means the query reads every account
+        if acc_ids is None:
+            return (self._generations.get("prefs", 0), self._generations.get("all", 0))
+        return (self._generations.get("prefs", 0),) + tuple(self._generations.get(x, 0) for x in acc_ids)
+
+    def _cached(self, name, args, acc_ids, load):
+        """
+        Get a query result from the LRU query cache, running load() on a miss.
+        Cached results are shared between callers and must be treated as read-only.
+
+        Args:
+            name (str): Name of the query method
+            args (tuple): Hashable arguments of the query
+            acc_ids (tuple): IDs of the accounts the query reads, None if it reads every account
+            load (callable): Runs the query
+
+        Returns:
+            The query result
+        """
+        key = (name, args, acc_ids)
+        with self._cache_lock:
+            # Generations are read before loading, a write during the load leaves the entry tagged stale
+            generations = self._get_generations(acc_ids)
+            entry = self._query_cache.get(key)
+            if entry and entry[0] == generations:
+                self._query_cache.move_to_end(key)
+                return entry[1]
+
+        result = load()
+        # Failed queries return None and aren't cached
+        if result is not None:
+            with self._cache_lock:
+                self._query_cache[key] = (generations, result)
+                self._query_cache.move_to_end(key)
+                while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+        return result
+
+    def clear_query_cache(self):
+        """ Drop every cached query result."""
+        with self._cache_lock:
+            self._query_cache.clear()
+
+    def _after_restore(self):
+        # A restored snapshot replaces every row, drop everything read from the old contents
+        super(dbAccessor, self)._after_restore()
+        self.ig_accs = {}
+        self.obj_f.clear_usernames()
+        self._bump_generation()
+        self.clear_query_cache()
+    # endregion
+
+    # region Query Cached
+    # Bulk reads take columnar=True to get compact columns (dc.dbColumns) instead of a list of dbObjs
+    def _select_follows(self, suffix, columnar=False):
+        # Select follows as dbObjs or as follow_columns
+        if columnar:
+            return self._select_columns(dc.follow, suffix=suffix, cols_type=dc.follow_columns)
+        return self._select(dc.follow, suffix=suffix)
+
+    def get_follows_by_acc(self, acc, columnar=False):
         """ Get all follows by Account."""
-        return self._select(dc.follow, suffix=f"WHERE acc_id = {acc.id}")
+        return self._cached("follows", (columnar,), (acc.id,),
+                            lambda: self._select_follows(f"WHERE acc_id = {acc.id}", columnar))
 
-    def get_last_follows_by_acc(self, acc: dc.ig_account) -> list[dc.last_follow]:
+    def get_last_follows_by_acc(self, acc: dc.ig_account, columnar=False) -> list[dc.last_follow]:
         """ Get all last_follows by Account."""
-        return self._select(dc.last_follow, suffix=f"WHERE acc_id = {acc.id}")
+        return self._cached("last_follows", (columnar,), (acc.id,),
+                            lambda: (self._select_columns if columnar else self._select)(dc.last_follow, suffix=f"WHERE acc_id = {acc.id}"))
 
     def get_flws_by_last_flw(self, lf: dc.last_follow):
         """ Get follows referenced on a last_follow."""
-        flws = []
-        if lf.last_follower_id:
-            flws.append(self._select(dc.follow, suffix=f"WHERE id = {lf.last_follower_id}"))
-        if lf.last_following_id:
-            if lf.last_follower_id != lf.last_following_id:
-                flws.append(self._select(dc.follow, suffix=f"WHERE id = {lf.last_following_id}"))
-        return flws
-
-    def get_newest_follows_by_acc(self, acc) -> list[dc.follow]:
+        ids = tuple(sorted({x for x in (lf.last_follower_id, lf.last_following_id) if x}))
+        if not ids:
+            return []
+        return self._cached("flws_by_last_flw", ids, (lf.acc_id,),
+                            lambda: self._select(dc.follow, suffix=f"WHERE id IN ({', '.join(str(x) for x in ids)})"))
+
+    # Picks the newer of the follows referenced by each last_follow, ties go to the following follow
+    Q_NEWEST_FOLLOWS = """WHERE id IN (
+        SELECT CASE WHEN f_flwg.id IS NULL OR f_flwr.date > f_flwg.date THEN f_flwr.id ELSE f_flwg.id END
+        FROM last_follows lf
+        LEFT JOIN follow f_flwr ON f_flwr.id = lf.last_follower_id
+        LEFT JOIN follow f_flwg ON f_flwg.id = lf.last_following_id
+        WHERE lf.acc_id IN ({0}))"""
+
+    def get_newest_follows_by_acc(self, acc, columnar=False) -> list[dc.follow]:
         """ Get all the newest follows for each user following an account."""
-        lfs = self.get_last_follows_by_acc(acc)
-        recent_flws = []
-        for lf in lfs:
-            flws = self.get_flws_by_last_flw(lf)
-            if len(flws) == 1:
-                recent_flws.append(flws[0])
-            if len(flws) == 2:
-                recent_flws.append(flws[0] if flws[0] > flws[1] else flws[1])
-        return recent_flws
+        return self._cached("newest_follows", (columnar,), (acc.id,),
+                            lambda: self._select_follows(self.Q_NEWEST_FOLLOWS.format(acc.id), columnar))
+
+    def get_newest_follows_by_accs(self, accs) -> dict[int, list[dc.follow]]:
+        """ Get the newest follows for each user of many accounts in one query, keyed by account ID."""
+        acc_ids = tuple(sorted({acc.id for acc in accs}))
+        if not acc_ids:
+            return {}
+        return self._cached("newest_follows_by_accs", (), acc_ids, lambda: self._load_newest_follows(acc_ids))
+
+    def _load_newest_follows(self, acc_ids):
+        # Select the newest follows of many accounts and group them by account ID
+        newest = {x: [] for x in acc_ids}
+        rows = self._select(dc.follow, suffix=self.Q_NEWEST_FOLLOWS.format(", ".join(str(x) for x in acc_ids)))
+        if rows is None:
+            return None
+        for flw in rows:
+            newest[flw.acc_id].append(flw)
+        return newest
+
+    def get_follows_at(self, acc, date: int, columnar=False) -> list[dc.follow]:
+        """
+        Get the newest follow of every user related to an account as of a date.
+        Rebuilds the state from the last full snapshot plus any delta imports after it, so it works for both storage modes.
+        """
+        return self._cached("follows_at", (date, columnar), (acc.id,),
+                            lambda: self._select_follows(f"WHERE id IN ({self.Q_STATE_IDS.format(acc.id, date)})", columnar))
     # endregion
 
     # region JsonProcessing
-    def munch_follow_data(self, follower_json, following_json, acc_id, date):
-        """ Process json follower data into database."""
-        # Load Json Data
-        f_flwr = open(follower_json, encoding="utf-8-sig")
-        f_flwg = open(following_json, encoding="utf-8-sig")
-        flwr = next(iter(json.load(f_flwr).values()))
-        flwg = next(iter(json.load(f_flwg).values()))
+    # Staging table for a single snapshot, follow_id is pre-assigned after the current last follow ID and user_id is resolved from ig_user
+    Q_STAGE_CREATE = """CREATE TEMP TABLE follow_stage (
+        username TEXT PRIMARY KEY,
+        follower BOOLEAN,
+        following BOOLEAN,
+        follow_id INTEGER,
+        user_id INTEGER
+    );"""
+
+    # Drops the staging table
+    Q_STAGE_DROP = "DROP TABLE IF EXISTS temp.follow_stage;"
+
+    # Stages one user from the snapshot
+    Q_STAGE_INSERT = "INSERT INTO follow_stage (username, follower, following) VALUES (?, ?, ?);"
+
+    # Adds staged users that were never seen before to ig_user
+    Q_STAGE_USERS = "INSERT OR IGNORE INTO ig_user (username) SELECT username FROM follow_stage;"
+
+    # Numbers staged users sequentially after the last follow ID and resolves their user IDs
+    Q_STAGE_IDS = """UPDATE follow_stage SET
+        follow_id = rowid + (SELECT IFNULL(MAX(id), 0) FROM follow),
+        user_id = (SELECT id FROM ig_user WHERE ig_user.username = follow_stage.username);"""
+
+    # Writes one follow per staged user
+    Q_FOLLOW_INSERT = """INSERT INTO follow (id, user_id, acc_id, date, follower, following, import_id)
+        SELECT follow_id, user_id, :acc_id, :date, follower, following, :import_id FROM follow_stage;"""
+
+    # Creates last_follows for new users and repoints existing last_follows that are older than the snapshot
+    Q_LAST_FOLLOW_UPSERT = """INSERT INTO last_follows (user_id, acc_id, last_following_id, last_follower_id)
+        SELECT s.user_id, :acc_id,
+            CASE WHEN lf.user_id IS NULL THEN (CASE WHEN s.following THEN s.follow_id END)
+                 WHEN f_flwg.date < :date THEN s.follow_id
+                 ELSE lf.last_following_id END,
+            CASE WHEN lf.user_id IS NULL THEN (CASE WHEN s.follower THEN s.follow_id END)
+                 WHEN f_flwr.date < :date THEN s.follow_id
+                 ELSE lf.last_follower_id END
+        FROM follow_stage s
+        LEFT JOIN last_follows lf ON lf.acc_id = :acc_id AND lf.user_id = s.user_id
+        LEFT JOIN follow f_flwg ON f_flwg.id = lf.last_following_id
+        LEFT JOIN follow f_flwr ON f_flwr.id = lf.last_follower_id
+        WHERE lf.user_id IS NULL
+            OR f_flwg.date < :date
+            OR f_flwr.date < :date
+        ON CONFLICT (acc_id, user_id) DO UPDATE SET
+            last_following_id = excluded.last_following_id,
+            last_follower_id = excluded.last_follower_id;"""
+
+    # Records the ledger row counts, must run directly after the last_follows upsert so changes() counts its rows
+    Q_IMPORT_COUNTS = """UPDATE imports SET
+        last_follow_count = changes(),
+        follow_count = (SELECT COUNT(*) FROM follow_stage)
+        WHERE id = :import_id;"""
+
+    # Stage users from a follower/following export chunk, users already staged from the other export keep their flags
+    Q_STAGE_FOLLOWER = """INSERT INTO follow_stage (username, follower, following) VALUES (?, 1, 0)
+        ON CONFLICT (username) DO UPDATE SET follower = 1;"""
+    Q_STAGE_FOLLOWING = """INSERT INTO follow_stage (username, follower, following) VALUES (?, 0, 1)
+        ON CONFLICT (username) DO UPDATE SET following = 1;"""
+
+    # IDs of the latest follow per related user of an account as of a date, starting from the last full snapshot (format with acc_id, date)
+    Q_STATE_IDS = """SELECT id FROM (
+            SELECT id, follower, following, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY date DESC, id DESC) AS rn
+            FROM follow
+            WHERE acc_id = {0} AND date <= {1}
+                AND date >= (SELECT IFNULL(MAX(date), 0) FROM imports WHERE acc_id = {0} AND NOT delta AND date <= {1}))
+        WHERE rn = 1 AND (follower OR following)"""
+
+    # Relationship state before a delta import (format with state IDs)
+    Q_STATE_CREATE = """CREATE TEMP TABLE follow_state AS SELECT u.username, f.follower, f.following
+        FROM follow f JOIN ig_user u ON u.id = f.user_id WHERE f.id IN ({0});"""
+    # Without it Q_DELTA_UNCHANGED scans the whole state for every staged user
+    Q_STATE_INDEX = "CREATE INDEX temp.ix_follow_state_username ON follow_state (username);"
+    Q_STATE_DROP = "DROP TABLE IF EXISTS temp.follow_state;"
+
+    # Delta imports write users who were related but are missing from the snapshot with neither flag, and skip unchanged users
+    Q_DELTA_GONE = """INSERT INTO follow_stage (username, follower, following)
+        SELECT username, 0, 0 FROM follow_state WHERE username NOT IN (SELECT username FROM follow_stage);"""
+    Q_DELTA_UNCHANGED = """DELETE FROM follow_stage WHERE EXISTS (
+        SELECT 1 FROM follow_state s
+        WHERE s.username = follow_stage.username AND s.follower = follow_stage.follower AND s.following = follow_stage.following);"""
+
+    # Number of users staged per statement when streaming an export
+    STREAM_CHUNK = 5000
+
+    def munch_follow_data(self, follower_json, following_json, acc_id, date: int, stream=False, delta=False):
+        """
+        Process json follower data into database, date is a date key (see FC_DataClasses.to_date_key).
+        With stream=True exports are parsed incrementally and staged in chunks, so memory stays flat for any export size.
+        With delta=True only users whose relationship changed since the previous snapshot are written (see get_follows_at).
+        Returns the new import ID, or None if nothing was imported, the import's stage report is left in last_import_report.
+        """
+        with self._profile_import("munch_follow_data", acc_id, date) as prof:
+            with prof.stage("hash", items=2):
+                imp = self._mk_import([follower_json, following_json], acc_id, date, delta)
+            if not imp:
+                prof.status = "skipped"
+                return None
+
+            if stream:
+                staging = prof.timed_iter("parse", self._stream_stage_steps(follower_json, following_json), lambda x: len(x[1]))
+            else:
+                staging = self._load_stage_steps(follower_json, following_json, prof)
+
+            # Full imports don't mark users as "unfollowed" if there is no record in follower/following, but this could happen if we both unfollow eachother.
+            # Delta imports have to track this (a missing row means "unchanged"), so they write a follow with neither flag set for those users.
+            return self._munch_staged(staging, imp, prof)
+
+    def munch_export(self, export_path, acc_id, date: int, workers=None, delta=False):
+        """
+        Process an Instagram "Download your information" export directory or zip into database.
+        Every followers_N.json/following_N.json part is parsed in a process pool and staged by a single writer in the order parts finish.
+
+        Args:
+            export_path (str): Export directory or zip file
+            acc_id (int): ID of the ig_account the export belongs to
+            date (int): Date key of the export
+            workers (int): Parser processes, defaults to the CPU count, 1 parses in-process
+            delta (bool): Only write users whose relationship changed since the previous snapshot
+
+        Returns:
+            int: The new import ID, or None if nothing was imported, the import's stage report is left in last_import_report
+        """
+        flwr_parts, flwg_parts = ep.find_export_parts(export_path)
+        if not flwr_parts and not flwg_parts:
+            print(f"No follower or following files were found in {export_path}", file=sys.stderr)
+            return None
+        statements = [self.Q_STAGE_FOLLOWER] * len(flwr_parts) + [self.Q_STAGE_FOLLOWING] * len(flwg_parts)
+        parts = flwr_parts + flwg_parts
+
+        with self._profile_import("munch_export", acc_id, date) as prof:
+            with prof.stage("hash", items=len(parts)):
+                imp = self._mk_import(parts, acc_id, date, delta)
+            if not imp:
+                prof.status = "skipped"
+                return None
+
+            # Parsing is timed as the wait for each parsed part, so with worker processes it is only the time staging waited on them
+            if workers == 1 or len(parts) == 1:
+                parsed = prof.timed_iter("parse", zip(statements, map(ep.parse_part, parts)), lambda x: len(x[1]))
+                return self._munch_staged(self._part_stage_steps(parsed), imp, prof)
+            # Imported here, the process pool machinery is slow to import and most callers never use it
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Staging statements are per user upserts, so a slow part doesn't hold back the parts after it
+                futures = {pool.submit(ep.parse_part, part): statement for statement, part in zip(statements, parts)}
+                parsed = prof.timed_iter("parse", ((futures[x], x.result()) for x in as_completed(futures)), lambda x: len(x[1]))
+                return self._munch_staged(self._part_stage_steps(parsed), imp, prof)
+
+    def munch_users(self, users, source_hashes, acc_id, date: int, delta=False, parse_time=None):
+        """
+        Process an already parsed snapshot into database, see FC_Import which parses snapshots in worker processes.
+
+        Args:
+            users (list[tuple]): (username, follower, following) for every user in the snapshot
+            source_hashes (list[str]): sha256 of each source file (see FC_ExportParser.parse_snapshot)
+            acc_id (int): ID of the ig_account the snapshot belongs to
+            date (int): Date key of the snapshot
+            delta (bool): Only write users whose relationship changed since the previous snapshot
+            parse_time (float): Seconds the snapshot took to parse, reported as the import's parse stage
+
+        Returns:
+            int: The new import ID, or None if nothing was imported, the import's stage report is left in last_import_report
+        """
+        with self._profile_import("munch_users", acc_id, date) as prof:
+            if parse_time is not None:
+                prof.add_stage("parse", parse_time, len(users))
+            with prof.stage("hash"):
+                imp = self._mk_import(None, acc_id, date, delta, source_hashes)
+            if not imp:
+                prof.status = "skipped"
+                return None
+            return self._munch_staged([(self.Q_STAGE_INSERT, users)], imp, prof)
+
+    @contextmanager
+    def _profile_import(self, entry, acc_id, date):
+        # Report the stages of an import run inside the with block, the report is finished even if the import raises and kept as
+        # last_import_report. Captures (.prof files) are saved next to the import log.
+        log_dir = dirname(self.import_log) if self.import_log else self.data_folder
+        prof = import_profile(entry, acc_id, date, self.import_log, self.import_capture, join(log_dir, "import_profiles")).start()
+        try:
+            yield prof
+        finally:
+            self.last_import_report = prof.finish()
+
+    def _mk_import(self, sources, acc_id, date, delta=False, source_hashes=None):
+        # Hash the source files (unless they were hashed already) and make a ledger entry for them, returns None if the account
+        # already has an import for the date (it must be rolled back to import a replacement) or the same files were already imported
+        dated = self.get_import_by_date(acc_id, date)
+        if dated:
+            print(f"Skipping import, account {acc_id} already has import {dated.id} for {date} (roll it back to import a replacement)", file=sys.stderr)
+            return None
+        # Deltas are diffed against the latest state, so they can only be appended after the account's newest import
+        if delta:
+            newest = self.first_or(None, self._select(dc.fc_import, suffix=f"WHERE acc_id = {acc_id} ORDER BY date DESC LIMIT 1"))
+            if newest and newest.date >= date:
+                print(f"Delta imports must be newer than the newest import for account {acc_id} ({newest.date})", file=sys.stderr)
+                return None
+        if source_hashes is None:
+            source_hashes = [ep.hash_source(x) for x in sources]
+        source_hash = self._get_source_hash(source_hashes)
+        existing = self.find_import(acc_id, source_hashes)
+        if existing:
+            print(f"Skipping import, these files were already imported for account {acc_id} (import {existing.id})", file=sys.stderr)
+            return None
+        return self.obj_f.fc_import(-1, acc_id, date, source_hash, source_hashes, 0, 0, delta)
+
+    @staticmethod
+    def _get_source_hash(source_hashes) -> str:
+        # Ledger hash of a snapshot, from the sha256 of each of its files in order
+        return hashlib.sha256(json.dumps(source_hashes).encode()).hexdigest()
+
+    def find_import(self, acc_id, source_hashes) -> dc.fc_import:
+        """ Get the account's import of the same source files (see FC_ExportParser.get_source_hashes), or None if they were never imported."""
+        return self.first_or(None, self._select(dc.fc_import, suffix=f"WHERE acc_id = {acc_id} AND source_hash = '{self._get_source_hash(source_hashes)}'"))
+
+    def _munch_staged(self, staging, imp: dc.fc_import, prof: import_profile):
+        # Stage the snapshot and diff it against last_follows with joins, the ledger entry and all rows commit in one transaction.
+        # New users get a last_follow pointing at their new follow, existing last_follows are repointed when
+        # the follow they reference is older than this snapshot.
+        # Each step is a stage of the import's report, items are the rows it changed. The commit stage is what's left: BEGIN, COMMIT and cleanup.
+        changes = self._get_total_changes
+        try:
+            with prof.stage("commit"), self.transaction():
+                with prof.stage("ledger", counter=changes):
+                    # Spans are kept up to date incrementally when the snapshot is the account's newest, otherwise they are rebuilt
+                    newest = self._r_query(f"SELECT MAX(date) FROM imports WHERE acc_id = {imp.acc_id};")[0][0]
+                    in_order = newest is None or newest < imp.date
+                    imp.id = self._insert(imp)
+
+                params = {"acc_id": imp.acc_id, "date": imp.date, "import_id": imp.id, "delta": imp.delta}
+                with prof.stage("stage", counter=changes):
+                    self._r_transaction(chain([(self.Q_STAGE_DROP, ()),
+                                               (self.Q_STAGE_CREATE, ())],
+                                              staging))
+                if imp.delta:
+                    with prof.stage("delta", counter=changes):
+                        self._r_transaction([(self.Q_STATE_DROP, ()),
+                                             (self.Q_STATE_CREATE.format(self.Q_STATE_IDS.format(imp.acc_id, imp.date - 1)), ()),
+                                             (self.Q_STATE_INDEX, ()),
+                                             (self.Q_DELTA_GONE, ()),
+                                             (self.Q_DELTA_UNCHANGED, ()),
+                                             (self.Q_STATE_DROP, ())])
+                with prof.stage("users", counter=changes):
+                    self._r_transaction([(self.Q_STAGE_USERS, ()),
+                                         (self.Q_STAGE_IDS, ())])
+                with prof.stage("follows", counter=changes):
+                    self._r_val_statement(self.Q_FOLLOW_INSERT, params)
+                with prof.stage("last_follows", counter=changes):
+                    self._r_transaction([(self.Q_LAST_FOLLOW_UPSERT, params),
+                                         (self.Q_IMPORT_COUNTS, params)])
+                with prof.stage("spans", counter=changes):
+                    self._r_transaction([(self.Q_SPAN_CLOSE, params),
+                                         (self.Q_SPAN_OPEN, params),
+                                         (self.Q_SUMMARY_NEWEST, params)] if in_order
+                                        else self._rebuild_span_steps(imp.acc_id) + self._rebuild_summary_steps(imp.acc_id))
+                with prof.stage("bitmaps", counter=changes):
+                    if in_order:
+                        self._write_staged_bitmaps(imp)
+                    else:
+                        self._rebuild_bitmaps(imp.acc_id)
+                self._r_statement(self.Q_STAGE_DROP)
+            prof.import_id = imp.id
+            prof.status = "done"
+            return imp.id
+        except sqlite3.Error as e:
+            self._on_error(e)
+        finally:
+            self._bump_generation(imp.acc_id)
+
+    def _part_stage_steps(self, parsed_parts):
+        # Yield staging steps for each (follower/following statement, parsed part) as it arrives
+        for statement, users in parsed_parts:
+            for chunk in ep.iter_chunks(((u,) for u in users), self.STREAM_CHUNK):
+                yield (statement, chunk)
+
+    def _load_stage_steps(self, follower_json, following_json, prof: import_profile):
+        # Load both exports fully and stage every user in one statement
+        with prof.stage("parse") as stage:
+            f_flwr = open(follower_json, encoding="utf-8-sig")
+            f_flwg = open(following_json, encoding="utf-8-sig")
+            flwr = next(iter(json.load(f_flwr).values()))
+            flwg = next(iter(json.load(f_flwg).values()))
+            stage["items"] += len(flwr) + len(flwg)
 
         # Get all users in Json
-        s_flwr = set([x["username"] for x in flwr])
-        s_flwg = set([x["username"] for x in flwg])
-        all_known = s_flwg.union(s_flwr)
-
-        # Initialize variables for parsing last follows
-        commit_follows = []
-        commit_last_follows = []
-        last_id = self.get_last_id(dc.follow)
-        for user in all_known:
-            last_id += 1
-            isflwr = False
-            isflwg = False
-            lFlwgId = None
-            lFlwrId = None
-            if user in s_flwr:
-                isflwr = True
-                lFlwrId = last_id
-            if user in s_flwg:
-                isflwg = True
-                lFlwgId = last_id
-            follow = self.obj_f.follow(last_id, user, acc_id, date, isflwr, isflwg)
-            commit_follows.append(follow)
-
-            # If last follow is found compare follow date with current
-            existing_lf = self._select(dc.last_follow, suffix=f"WHERE username = {self._col_data(user)} AND acc_id = {acc_id}")
-            if len(existing_lf) == 1:
-                ex_lf = existing_lf[0]
-                if ex_lf.last_follower_id:
-                    f_lFlwr = self._select(dc.follow, suffix=f"WHERE id = {ex_lf.last_follower_id}")[0]
-                    if f_lFlwr < follow:
-                        ex_lf.last_follower_id = follow.id
-                if ex_lf.last_following_id:
-                    f_lFlwg = self._select(dc.follow, suffix=f"WHERE id = {ex_lf.last_following_id}")[0]
-                    if f_lFlwg < follow:
-                        ex_lf.last_following_id = follow.id
-
-                # Only update if newer is found.
-                if f_lFlwr < follow or f_lFlwg < follow:
-                    commit_last_follows.append(ex_lf)
-
-            # If no existing last follow the user is new
-            if len(existing_lf) == 0:
-                commit_last_follows.append(self.obj_f.last_follow(user, acc_id, lFlwgId, lFlwrId))
-            if len(existing_lf) > 1:
-                print(f"Constraint Violation: Multiple Last Follows were found for user/account pair {user}, {acc_id}")
-
-        self._binsert(commit_follows)
-        self._bupsert(commit_last_follows)
-        # We could make this quicker by determining which records are inserts vs updates and doing 2 bulk calls.
-
-        # We currently don't mark users as "unfollowed" if there is no record in follower/following, but this could happen if we both unfollow eachother
-        # To track this we need to track when the last import for a user was, get it when we start the import, and look for any "follow" records with
-        # the previous import date that don't show up in follower or following. IS THERE ANY BENEFIT TO TRACKING THIS??
-
-        # When we import we should create a new GUID and save it in an "imports" table which will track when a follow record was imported
-        # To roll back, we can show a list of imports and let the user select an import to rollback to. We should then delete the
+        with prof.stage("sets") as stage:
+            s_flwr = set([x["username"] for x in flwr])
+            s_flwg = set([x["username"] for x in flwg])
+            all_known = s_flwg.union(s_flwr)
+            users = [(user, user in s_flwr, user in s_flwg) for user in all_known]
+            stage["items"] += len(users)
+        return [(self.Q_STAGE_INSERT, users)]
+
+    def _stream_stage_steps(self, follower_json, following_json):
+        # Lazily parse each export and yield one staging step per chunk of users
+        for path, statement in ((follower_json, self.Q_STAGE_FOLLOWER), (following_json, self.Q_STAGE_FOLLOWING)):
+            users = ((ep.get_username(x),) for x in ep.iter_export_entries(path))
+            for chunk in ep.iter_chunks(users, self.STREAM_CHUNK):
+                yield (statement, chunk)
+    # endregion
+
+    # region Imports
+    # Users touched by the import being rolled back
+    Q_ROLLBACK_USERS = "CREATE TEMP TABLE rollback_users AS SELECT DISTINCT user_id FROM follow WHERE import_id = :import_id;"
+    Q_ROLLBACK_USERS_DROP = "DROP TABLE IF EXISTS temp.rollback_users;"
+
+    # Remove the import's follows, last_follows of touched users and the ledger entry
+    Q_ROLLBACK_FOLLOWS = "DELETE FROM follow WHERE import_id = :import_id;"
+    Q_ROLLBACK_LAST_FOLLOWS = "DELETE FROM last_follows WHERE acc_id = :acc_id AND user_id IN (SELECT user_id FROM rollback_users);"
+    Q_ROLLBACK_IMPORT = "DELETE FROM imports WHERE id = :import_id;"
+
+    # Rebuilds last_follows for touched users from their remaining follows, giving the same result as replaying the remaining imports:
+    # a pointer is set if the user's first follow had the flag, and points at the newest follow (earliest imported on ties)
+    Q_RECOMPUTE_LAST_FOLLOWS = """INSERT INTO last_follows (user_id, acc_id, last_following_id, last_follower_id)
+        SELECT u.user_id, :acc_id,
+            CASE WHEN f_first.following THEN f_newest.id END,
+            CASE WHEN f_first.follower THEN f_newest.id END
+        FROM rollback_users u
+        JOIN follow f_first ON f_first.id = (
+            SELECT MIN(id) FROM follow WHERE acc_id = :acc_id AND user_id = u.user_id)
+        JOIN follow f_newest ON f_newest.id = (
+            SELECT id FROM follow WHERE acc_id = :acc_id AND user_id = u.user_id ORDER BY date DESC, id LIMIT 1);"""
+
+    def get_imports(self, acc=None) -> list[dc.fc_import]:
+        """ Get the import ledger, optionally for one account, newest first."""
+        where = f"WHERE acc_id = {acc.id} " if acc else ""
+        return self._select(dc.fc_import, suffix=f"{where}ORDER BY id DESC")
+
+    def get_import(self, import_id) -> dc.fc_import:
+        """ Get an import ledger entry by ID."""
+        return self._get_obj_by_id(dc.fc_import, import_id)
+
+    def get_import_by_date(self, acc_id, date: int) -> dc.fc_import:
+        """ Get the account's import of a date, or None if the date wasn't imported."""
+        return self.first_or(None, self._select(dc.fc_import, suffix=f"WHERE acc_id = {acc_id} AND date = {date}"))
+
+    def rollback_import(self, import_id):
+        """
+        Undo an import by deleting its follows and ledger entry, then recomputing last_follows for the users it touched.
+
+        Args:
+            import_id (int): ID of the import to roll back
+
+        Returns:
+            bool: True if the import was found and rolled back
+        """
+        imp = self._get_obj_by_id(dc.fc_import, import_id)
+        if not imp:
+            print(f"No import with ID {import_id} was found", file=sys.stderr)
+            return False
+
+        # Later deltas were diffed against the state this import produced
+        if self._select(dc.fc_import, suffix=f"WHERE acc_id = {imp.acc_id} AND delta AND date > {imp.date} LIMIT 1"):
+            print(f"Import {import_id} can't be rolled back while newer delta imports for account {imp.acc_id} exist", file=sys.stderr)
+            return False
+        params = {"acc_id": imp.acc_id, "import_id": imp.id}
+        with self.transaction():
+            self._r_transaction([(self.Q_ROLLBACK_USERS_DROP, ()),
+                                 (self.Q_ROLLBACK_USERS, params),
+                                 (self.Q_ROLLBACK_FOLLOWS, params),
+                                 (self.Q_ROLLBACK_LAST_FOLLOWS, params),
+                                 (self.Q_RECOMPUTE_LAST_FOLLOWS, params),
+                                 (self.Q_ROLLBACK_IMPORT, params),
+                                 (self.Q_ROLLBACK_USERS_DROP, ())]
+                                + self._rebuild_span_steps(imp.acc_id)
+                                + self._rebuild_summary_steps(imp.acc_id))
+            self._rebuild_bitmaps(imp.acc_id)
+        self._bump_generation(imp.acc_id)
+        return True
+    # endregion
+
+    # region Spans
+    # follow_span holds one row per unbroken stretch of a relationship: kind "follower" (the user follows the account) or
+    # "following" (the account follows the user) held from the snapshot at valid_from until the snapshot at valid_to (NULL = still held)
+    SPAN_KINDS = ("follower", "following")
+
+    # Schema version that added follow_span, spans are derived data so they are built when it is applied
+    SPAN_SCHEMA_VERSION = 5
+
+    # Closes open spans the staged snapshot no longer holds. Users missing from a delta snapshot are unchanged, so only full snapshots close them.
+    Q_SPAN_CLOSE = """UPDATE follow_span SET valid_to = :date
+        WHERE acc_id = :acc_id AND valid_to IS NULL
+            AND IFNULL((SELECT CASE follow_span.kind WHEN 'follower' THEN NOT s.follower ELSE NOT s.following END
+                        FROM follow_stage s WHERE s.username = follow_span.username), NOT :delta);"""
+
+    # Opens spans for staged relationships that have no open span
+    Q_SPAN_OPEN = """INSERT INTO follow_span (acc_id, username, kind, valid_from, valid_to)
+        SELECT :acc_id, s.username, k.kind, :date, NULL
+        FROM follow_stage s
+        JOIN (SELECT 'follower' AS kind UNION ALL SELECT 'following') k
+            ON CASE k.kind WHEN 'follower' THEN s.follower ELSE s.following END
+        WHERE NOT EXISTS (
+            SELECT 1 FROM follow_span p
+            WHERE p.acc_id = :acc_id AND p.username = s.username AND p.kind = k.kind AND p.valid_to IS NULL);"""
+
+    # Rebuilds an account's spans from its follows. Each follow's state holds until the user's next follow or the next full
+    # snapshot (which would have included the user), consecutive states with the same flag are then merged into one span.
+    # Spans keep the username itself, so pages sorted by username are read straight from the span indexes.
+    Q_SPAN_DELETE = "DELETE FROM follow_span WHERE acc_id = :acc_id;"
+    Q_SPAN_REBUILD = """INSERT INTO follow_span (acc_id, username, kind, valid_from, valid_to)
+        WITH seg AS (
+            SELECT u.username, f.date AS s_from, f.follower, f.following,
+                LEAD(f.date) OVER (PARTITION BY f.user_id ORDER BY f.date, f.id) AS next_row,
+                (SELECT MIN(i.date) FROM imports i WHERE i.acc_id = f.acc_id AND NOT i.delta AND i.date > f.date) AS next_full
+            FROM follow f
+            JOIN ig_user u ON u.id = f.user_id
+            WHERE f.acc_id = :acc_id),
+        kinds AS (
+            SELECT username, k.kind, s_from,
+                CASE WHEN next_row IS NULL THEN next_full WHEN next_full IS NULL THEN next_row ELSE MIN(next_row, next_full) END AS s_to
+            FROM seg
+            JOIN (SELECT 'follower' AS kind UNION ALL SELECT 'following') k
+                ON CASE k.kind WHEN 'follower' THEN seg.follower ELSE seg.following END),
+        islands AS (
+            SELECT username, kind, s_from, s_to,
+                SUM(island_start) OVER (PARTITION BY username, kind ORDER BY s_from, s_to ROWS UNBOUNDED PRECEDING) AS island
+            FROM (SELECT *, CASE WHEN LAG(s_to) OVER (PARTITION BY username, kind ORDER BY s_from, s_to) = s_from THEN 0 ELSE 1 END AS island_start
+                  FROM kinds))
+        SELECT :acc_id, username, kind, MIN(s_from), CASE WHEN COUNT(s_to) < COUNT(*) THEN NULL ELSE MAX(s_to) END AS valid_to
+        FROM islands
+        GROUP BY username, kind, island
+        HAVING valid_to IS NULL OR valid_to > MIN(s_from);"""
+
+    def _rebuild_span_steps(self, acc_id):
+        # Steps that rebuild every span of an account
+        return [(self.Q_SPAN_DELETE, {"acc_id": acc_id}),
+                (self.Q_SPAN_REBUILD, {"acc_id": acc_id})]
+
+    def rebuild_spans(self, acc=None):
+        """ Rebuild follow_span from raw follows for one account, or every account."""
+        acc_ids = [acc.id] if acc else [x[0] for x in self._r_query("SELECT DISTINCT acc_id FROM follow;")]
+        self._r_transaction([step for acc_id in acc_ids for step in self._rebuild_span_steps(acc_id)])
+
+    def _after_migrate(self, applied):
+        # Build spans, summaries and bitmaps when the migrations that add them run, and shrink the file once usernames are normalized
+        if self.SPAN_SCHEMA_VERSION in applied:
+            self.rebuild_spans()
+        if self.SUMMARY_SCHEMA_VERSION in applied:
+            acc_ids = [x[0] for x in self._r_query("SELECT DISTINCT acc_id FROM imports;")]
+            self._r_transaction([step for acc_id in acc_ids for step in self._rebuild_summary_steps(acc_id)])
+        if self.BITMAP_SCHEMA_VERSION in applied:
+            with self.transaction():
+                for acc_id in [x[0] for x in self._r_query("SELECT DISTINCT acc_id FROM imports;")]:
+                    self._rebuild_bitmaps(acc_id)
+        if self.USER_SCHEMA_VERSION in applied:
+            # The old follow/last_follows tables were dropped, give their pages back to the file system
+            self._r_query("VACUUM;")
+
+    def _check_kind(self, kind):
+        # Validate a span kind before it is put into SQL
+        if kind not in self.SPAN_KINDS:
+            raise ValueError(f"Span kind must be one of {self.SPAN_KINDS}, got {kind}")
+        return kind
+
+    def get_relations_at(self, acc, date: int, kind="follower") -> list[str]:
+        """
+        Get the users related to an account on a date.
+
+        Args:
+            acc (ig_account): Account to look up
+            date (int): Date key
+            kind (str): "follower" for users following the account, "following" for users the account follows
+
+        Returns:
+            list[str]: Usernames
+        """
+        return [x[0] for x in self._r_query(f"""SELECT username FROM follow_span
+            WHERE acc_id = {acc.id} AND kind = '{self._check_kind(kind)}' AND valid_from <= {date} AND (valid_to IS NULL OR valid_to > {date});""")]
+
+    def get_ended_between(self, acc, start: int, end: int, kind="follower") -> list[tuple]:
+        """
+        Get the users related to an account on start who are no longer related on end (e.g. who unfollowed).
+
+        Returns:
+            list[tuple]: (username, valid_from, valid_to) of the span that ended
+        """
+        kind = self._check_kind(kind)
+        return self._r_query(f"""SELECT username, valid_from, valid_to FROM follow_span s
+            WHERE acc_id = {acc.id} AND kind = '{kind}' AND valid_to > {start} AND valid_to <= {end} AND valid_from <= {start}
+                AND NOT EXISTS (SELECT 1 FROM follow_span c INDEXED BY ix_span_user
+                    WHERE c.acc_id = {acc.id} AND c.username = s.username AND c.kind = '{kind}'
+                        AND c.valid_from <= {end} AND (c.valid_to IS NULL OR c.valid_to > {end}));""")
+
+    def get_started_between(self, acc, start: int, end: int, kind="follower") -> list[tuple]:
+        """
+        Get the users related to an account on end who were not related on start (e.g. new followers).
+
+        Returns:
+            list[tuple]: (username, valid_from, valid_to) of the span that started
+        """
+        kind = self._check_kind(kind)
+        return self._r_query(f"""SELECT username, valid_from, valid_to FROM follow_span s
+            WHERE acc_id = {acc.id} AND kind = '{kind}' AND valid_from > {start} AND valid_from <= {end} AND (valid_to IS NULL OR valid_to > {end})
+                AND NOT EXISTS (SELECT 1 FROM follow_span c INDEXED BY ix_span_user
+                    WHERE c.acc_id = {acc.id} AND c.username = s.username AND c.kind = '{kind}'
+                        AND c.valid_from <= {start} AND (c.valid_to IS NULL OR c.valid_to > {start}));""")
+    # endregion
+
+    # region Summary
+    # follow_summary holds an account's headline counts as of each import date, so dashboards and trends don't scan follows.
+    # dfb/idfb are the following/followers that aren't mutual, gained/lost count followers since the previous import.
+    SUMMARY_SCHEMA_VERSION = 6
+
+    # Summarizes the newest snapshot from the open spans, run after the spans of an in-order import are updated
+    Q_SUMMARY_NEWEST = """INSERT OR REPLACE INTO follow_summary (acc_id, date, follower, following, dfb, idfb, gained, lost)
+        SELECT :acc_id, :date, flwr, flwg, flwg - mutual, flwr - mutual, gained, lost
+        FROM (SELECT
+            (SELECT COUNT(*) FROM follow_span WHERE acc_id = :acc_id AND kind = 'follower' AND valid_to IS NULL) AS flwr,
+            (SELECT COUNT(*) FROM follow_span WHERE acc_id = :acc_id AND kind = 'following' AND valid_to IS NULL) AS flwg,
+            (SELECT COUNT(*) FROM follow_span g
+                JOIN follow_span r ON r.acc_id = g.acc_id AND r.username = g.username AND r.kind = 'follower' AND r.valid_to IS NULL
+                WHERE g.acc_id = :acc_id AND g.kind = 'following' AND g.valid_to IS NULL) AS mutual,
+            CASE WHEN EXISTS (SELECT 1 FROM imports WHERE acc_id = :acc_id AND date < :date)
+                THEN (SELECT COUNT(*) FROM follow_span WHERE acc_id = :acc_id AND kind = 'follower' AND valid_from = :date)
+                ELSE 0 END AS gained,
+            (SELECT COUNT(*) FROM follow_span WHERE acc_id = :acc_id AND kind = 'follower' AND valid_to = :date) AS lost);"""
+
+    # Rebuilds every summary of an account from its spans. Spans start and end on import dates, so each count on a date
+    # is the running sum of spans (and mutual overlaps of a user's follower/following spans) starting minus ending up to it.
+    Q_SUMMARY_DELETE = "DELETE FROM follow_summary WHERE acc_id = :acc_id;"
+    Q_SUMMARY_REBUILD = """INSERT INTO follow_summary (acc_id, date, follower, following, dfb, idfb, gained, lost)
+        WITH mutual AS (
+            SELECT MAX(r.valid_from, g.valid_from) AS m_from,
+                CASE WHEN r.valid_to IS NULL THEN g.valid_to WHEN g.valid_to IS NULL THEN r.valid_to ELSE MIN(r.valid_to, g.valid_to) END AS m_to
+            FROM follow_span r
+            CROSS JOIN follow_span g INDEXED BY ix_span_user ON g.acc_id = r.acc_id AND g.username = r.username AND g.kind = 'following'
+                AND (r.valid_to IS NULL OR g.valid_from < r.valid_to) AND (g.valid_to IS NULL OR r.valid_from < g.valid_to)
+            WHERE r.acc_id = :acc_id AND r.kind = 'follower'),
+        events AS (
+            SELECT valid_from AS date, kind = 'follower' AS d_flwr, kind = 'following' AS d_flwg, 0 AS d_mutual, kind = 'follower' AS gained, 0 AS lost
+            FROM follow_span WHERE acc_id = :acc_id
+            UNION ALL
+            SELECT valid_to, -(kind = 'follower'), -(kind = 'following'), 0, 0, kind = 'follower'
+            FROM follow_span WHERE acc_id = :acc_id AND valid_to IS NOT NULL
+            UNION ALL
+            SELECT m_from, 0, 0, 1, 0, 0 FROM mutual
+            UNION ALL
+            SELECT m_to, 0, 0, -1, 0, 0 FROM mutual WHERE m_to IS NOT NULL),
+        by_date AS (
+            SELECT date, SUM(d_flwr) AS d_flwr, SUM(d_flwg) AS d_flwg, SUM(d_mutual) AS d_mutual, SUM(gained) AS gained, SUM(lost) AS lost
+            FROM events GROUP BY date),
+        totals AS (
+            SELECT d.date,
+                SUM(IFNULL(e.d_flwr, 0)) OVER w AS flwr,
+                SUM(IFNULL(e.d_flwg, 0)) OVER w AS flwg,
+                SUM(IFNULL(e.d_mutual, 0)) OVER w AS mutual,
+                CASE WHEN ROW_NUMBER() OVER w = 1 THEN 0 ELSE IFNULL(e.gained, 0) END AS gained,
+                IFNULL(e.lost, 0) AS lost
+            FROM (SELECT DISTINCT date FROM imports WHERE acc_id = :acc_id) d
+            LEFT JOIN by_date e ON e.date = d.date
+            WINDOW w AS (ORDER BY d.date ROWS UNBOUNDED PRECEDING))
+        SELECT :acc_id, date, flwr, flwg, flwg - mutual, flwr - mutual, gained, lost
+        FROM totals;"""
+
+    def _rebuild_summary_steps(self, acc_id):
+        # Steps that rebuild every summary of an account from its spans
+        return [(self.Q_SUMMARY_DELETE, {"acc_id": acc_id}),
+                (self.Q_SUMMARY_REBUILD, {"acc_id": acc_id})]
+
+    def rebuild_summaries(self, acc=None):
+        """ Recompute follow_summary (and the spans it is built from) from raw follows for one account, or every account."""
+        acc_ids = [acc.id] if acc else [x[0] for x in self._r_query("SELECT DISTINCT acc_id FROM imports;")]
+        self._r_transaction([step for acc_id in acc_ids
+                             for step in self._rebuild_span_steps(acc_id) + self._rebuild_summary_steps(acc_id)])
+        for acc_id in acc_ids:
+            self._bump_generation(acc_id)
+
+    def get_summaries(self, acc, start: int = None, end: int = None) -> list[dc.follow_summary]:
+        """
+        Get an account's summaries oldest first, optionally only those dated between start and end (inclusive).
+
+        Args:
+            acc (ig_account): Account to look up
+            start (int): First date key, None for no lower bound
+            end (int): Last date key, None for no upper bound
+
+        Returns:
+            list[follow_summary]: One summary per import date
+        """
+        where = f"WHERE acc_id = {acc.id}"
+        if start is not None:
+            where += f" AND date >= {start}"
+        if end is not None:
+            where += f" AND date <= {end}"
+        return self._cached("summaries", (start, end), (acc.id,),
+                            lambda: self._select(dc.follow_summary, suffix=f"{where} ORDER BY date"))
+
+    def get_latest_summary(self, acc) -> dc.follow_summary:
+        """ Get the summary of an account's newest import, or None if it has no imports."""
+        return self.first_or(None, self._cached("latest_summary", (), (acc.id,),
+                             lambda: self._select(dc.follow_summary, suffix=f"WHERE acc_id = {acc.id} ORDER BY date DESC LIMIT 1")))
+    # endregion
+
+    # region Bitmaps
+    # follow_bitmap holds the users of each relationship kind as of each import date as a compressed user_bitmap of ig_user IDs,
+    # so set questions across snapshots and accounts (who unfollowed, shared followers, never followed back) never load rows.
+    BITMAP_SCHEMA_VERSION = 9
+
+    Q_BITMAP_WRITE = "INSERT OR REPLACE INTO follow_bitmap (acc_id, date, kind, bits) VALUES (?, ?, ?, ?);"
+    Q_BITMAP_DELETE = "DELETE FROM follow_bitmap WHERE acc_id = ?;"
+
+    # Staged users of the snapshot being imported, delta snapshots only stage changed users
+    Q_BITMAP_STAGED = "SELECT user_id, follower, following FROM follow_stage;"
+
+    # Every span of an account with its user ID
+    Q_BITMAP_SPANS = """SELECT u.id, s.kind, s.valid_from, s.valid_to FROM follow_span s
+        JOIN ig_user u ON u.username = s.username
+        WHERE s.acc_id = ?;"""
+
+    def _write_staged_bitmaps(self, imp: dc.fc_import):
+        # Write the bitmaps of an in-order import from the staged snapshot, deltas are applied to the previous bitmaps
+        staged = self._r_query(self.Q_BITMAP_STAGED)
+        rows = []
+        for i, kind in enumerate(self.SPAN_KINDS, 1):
+            held = dc.user_bitmap.from_ids(x[0] for x in staged if x[i])
+            if imp.delta:
+                dropped = dc.user_bitmap.from_ids(x[0] for x in staged if not x[i])
+                held = (self._load_bitmap(imp.acc_id, imp.date, kind) - dropped) | held
+            rows.append((imp.acc_id, imp.date, kind, held.to_blob()))
+        self._r_transaction([(self.Q_BITMAP_WRITE, rows)])
+
+    def _rebuild_bitmaps(self, acc_id):
+        # Rebuild every bitmap of an account from its spans, walking its import dates and applying the spans that start and end on each
+        dates = [x[0] for x in self._r_query(f"SELECT DISTINCT date FROM imports WHERE acc_id = {acc_id} ORDER BY date;")]
+        starts, ends = {}, {}
+        for user_id, kind, valid_from, valid_to in self._r_query(self.Q_BITMAP_SPANS, (acc_id,)):
+            starts.setdefault((kind, valid_from), []).append(user_id)
+            if valid_to is not None:
+                ends.setdefault((kind, valid_to), []).append(user_id)
+
+        rows = []
+        for kind in self.SPAN_KINDS:
+            held = dc.user_bitmap()
+            for date in dates:
+                held = (held - dc.user_bitmap.from_ids(ends.get((kind, date), []))) | dc.user_bitmap.from_ids(starts.get((kind, date), []))
+                rows.append((acc_id, date, kind, held.to_blob()))
+        self._r_transaction([(self.Q_BITMAP_DELETE, (acc_id,)),
+                             (self.Q_BITMAP_WRITE, rows)])
+
+    def rebuild_bitmaps(self, acc=None):
+        """ Rebuild follow_bitmap from spans for one account, or every account."""
+        acc_ids = [acc.id] if acc else [x[0] for x in self._r_query("SELECT DISTINCT acc_id FROM imports;")]
+        with self.transaction():
+            for acc_id in acc_ids:
+                self._rebuild_bitmaps(acc_id)
+        for acc_id in acc_ids:
+            self._bump_generation(acc_id)
+
+    def _load_bitmap(self, acc_id, date, kind) -> dc.user_bitmap:
+        # Load the bitmap of the newest import on or before date (None for the newest import), empty if there is none
+        where = f"acc_id = {acc_id} AND kind = '{self._check_kind(kind)}'"
+        if date is not None:
+            where += f" AND date <= {date}"
+        rows = self._r_query(f"SELECT bits FROM follow_bitmap WHERE {where} ORDER BY date DESC LIMIT 1;")
+        return dc.user_bitmap.from_blob(rows[0][0]) if rows else dc.user_bitmap()
+
+    def get_bitmap(self, acc, date: int = None, kind="follower") -> dc.user_bitmap:
+        """
+        Get the users related to an account as of a date as a bitmap of ig_user IDs.
+        Resolve the IDs with obj_f.fmt_users(list(bitmap)) for display.
+
+        Args:
+            acc (ig_account): Account to look up
+            date (int): Date key, the state of the newest import on or before it is used, None for the newest import
+            kind (str): "follower" for users following the account, "following" for users the account follows
+
+        Returns:
+            user_bitmap: Users related on the date, empty if the account has no imports before it
+        """
+        return self._cached("bitmap", (date, kind), (acc.id,), lambda: self._load_bitmap(acc.id, date, kind))
+
+    def get_bitmaps(self, acc, kind="follower", start: int = None, end: int = None) -> dict[int, dc.user_bitmap]:
+        """ Get an account's bitmap of every import date between start and end (inclusive), keyed by date."""
+        where = f"acc_id = {acc.id} AND kind = '{self._check_kind(kind)}'"
+        if start is not None:
+            where += f" AND date >= {start}"
+        if end is not None:
+            where += f" AND date <= {end}"
+        return self._cached("bitmaps", (kind, start, end), (acc.id,),
+                            lambda: {x.date: x.get_users() for x in self._select(dc.follow_bitmap, suffix=f"WHERE {where} ORDER BY date")})
+
+    def _as_bitmap(self, users) -> dc.user_bitmap:
+        # Resolve a bitmap argument, either a user_bitmap or an (account, date, kind) tuple (see get_bitmap)
+        if isinstance(users, dc.user_bitmap):
+            return users
+        return self.get_bitmap(*users)
+
+    def bitmap_union(self, *users) -> dc.user_bitmap:
+        """ Get the users in any of the given bitmaps or (account, date, kind) tuples, e.g. everyone who ever followed."""
+        result = dc.user_bitmap()
+        for x in users:
+            result = result | self._as_bitmap(x)
+        return result
+
+    def bitmap_intersection(self, first, *users) -> dc.user_bitmap:
+        """ Get the users in all of the given bitmaps or (account, date, kind) tuples, e.g. followers two accounts share."""
+        result = self._as_bitmap(first)
+        for x in users:
+            result = result & self._as_bitmap(x)
+        return result
+
+    def bitmap_difference(self, first, *users) -> dc.user_bitmap:
+        """ Get the users in the first bitmap or (account, date, kind) tuple but none of the others, e.g. who unfollowed between two dates."""
+        result = self._as_bitmap(first)
+        for x in users:
+            result = result - self._as_bitmap(x)
+        return result
+    # endregion
+
+    # region Pages
+    # Current relationships shown by the crawler views, each filters the open spans (s) of an account
+    PAGE_VIEWS = {
+        "follower": "s.kind = 'follower'",
+        "following": "s.kind = 'following'",
+        "dfb": """s.kind = 'following' AND NOT EXISTS (SELECT 1 FROM follow_span r
+            WHERE r.acc_id = s.acc_id AND r.username = s.username AND r.kind = 'follower' AND r.valid_to IS NULL)""",
+        "idfb": """s.kind = 'follower' AND NOT EXISTS (SELECT 1 FROM follow_span r
+            WHERE r.acc_id = s.acc_id AND r.username = s.username AND r.kind = 'following' AND r.valid_to IS NULL)""",
+    }
+
+    # Keyset of each page sort, the username breaks ties so every row has a unique key
+    PAGE_SORTS = {
+        "username": ("s.username",),
+        "since": ("s.valid_from", "s.username"),
+    }
+
+    def get_relation_page(self, acc, view="follower", after=None, limit=100, sort="username", descending=False, offset=0) -> list[tuple]:
+        """
+        Get a page of an account's current relationships using keyset pagination.
+        Pages continue from the last row of the previous one, so reading deep pages costs the same as the first.
+
+        Args:
+            acc (ig_account): Account to look up
+            view (str): One of PAGE_VIEWS ("follower", "following", "dfb", "idfb")
+            after (tuple): Last row of the previous page in the same sort, None to start at the beginning
+            limit (int): Max rows in the page
+            sort (str): One of PAGE_SORTS ("username", "since")
+            descending (bool): Sort direction
+            offset (int): Rows to skip, only meant for jumping to a position without a previous row
+
+        Returns:
+            list[tuple]: (username, since) rows, since is the date key the relationship started on
+        """
+        if view not in self.PAGE_VIEWS or sort not in self.PAGE_SORTS:
+            raise ValueError(f"Page view must be one of {tuple(self.PAGE_VIEWS)} and sort one of {tuple(self.PAGE_SORTS)}, got {view}, {sort}")
+        cols = self.PAGE_SORTS[sort]
+        op, order = ("<", "DESC") if descending else (">", "ASC")
+
+        where = f"s.acc_id = {acc.id} AND s.valid_to IS NULL AND {self.PAGE_VIEWS[view]}"
+        values = ()
+        if after is not None:
+            values = (after[0],) if sort == "username" else (after[1], after[0])
+            where += f" AND ({', '.join(cols)}) {op} ({', '.join('?' for _ in cols)})"
+        return self._r_query(f"""SELECT s.username, s.valid_from FROM follow_span s WHERE {where}
+            ORDER BY {', '.join(f'{c} {order}' for c in cols)} LIMIT {int(limit)} OFFSET {int(offset)};""", values)
+
+    def get_relation_count(self, acc, view="follower") -> int:
+        """ Get the number of rows in a relationship view from the account's latest summary."""
+        summary = self.get_latest_summary(acc)
+        return getattr(summary, view) if summary else 0
     # endregion
 
 
 if __name__ == "__main__":
-    dbname = r"ProgramData\TestData\TEST_FC.db"
-    try:
-        db = dbAccessor(r"ProgramData/TestData/TEST_FC_About.json")
-        db.munch_follow_data(r"ProgramData\FollowerJson\OF_Flwg_May30_2024.json", r"ProgramData\FollowerJson\OF_Flwr_May30_2024.json", 1, datetime.today().strftime("%b%d_%Y"))
-        db.munch_follow_data(r"ProgramData\FollowerJson\OF_Flwg_May31_2024.json", r"ProgramData\FollowerJson\OF_Flwr_May31_2024.json", 1, datetime.today().strftime("%b%d_%Y"))
-    finally:
-        if isfile(dbname):
-            remove(dbname)
+    # Import a few days of synthetic exports into an in-memory test database, see FC_Benchmark for timings
+    from tempfile import TemporaryDirectory
+    from FC_Benchmark import export_generator
+    db = dbAccessor("ProgramData/TestData/TEST_FC_About.json", memory=True)
+    with TemporaryDirectory() as tmp:
+        for date, flwr_json, flwg_json in export_generator(users=1000, snapshots=3).generate(tmp)["bench_acc_0"]:
+            db.munch_follow_data(flwr_json, flwg_json, 0, date)
+    print(vars(db.get_latest_summary(db.get_ig_account_by_id(0))))
+    db.close()
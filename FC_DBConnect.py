@@ -3,10 +3,19 @@ FC_DBConnect
 
 Low level DB access and setup logic
 """
-from os import remove, getcwd
-from os.path import isfile, join
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from os import listdir, getcwd
+from os.path import basename, isfile, join
 import json
+import re
 import sqlite3
+import sys
+import threading
+from time import perf_counter
+from uuid import uuid4
 import FC_DataClasses as dc
 
 
@@ -19,32 +28,77 @@ class fcdb():
     cmd_delim: str
     db_name: str
     obj_f: dc.dbObjFactory
+    conn: sqlite3.Connection
 
-    def __init__(self, about="FC_About.json"):
+    # PRAGMA profile applied to every new connection, overridden by "DBPragmas" in About.json
+    DEFAULT_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    }
+
+    # DBName that keeps the database in memory
+    MEMORY_DB = ":memory:"
+
+    def __init__(self, about="FC_About.json", pragmas=None, memory=None):
         # Load About.json (DB constants)
         about = json.load(open(about))
         self.date_format = about["DateFormat"]
         self.cmd_delim = about["DBCmdDelim"]
         self.data_folder = about["DataFolder"]
-        self.db_name = about["DataFolder"] + about["DBName"]
+        self.migration_folder = about.get("MigrationFolder", "ProgramData/Migrations/")
+
+        # In-memory databases are created from the creation script and startup data like a new file, and disappear with the object.
+        # Every thread's connection opens the same named memdb database, _memory_keeper holds it open while close() reopens connections.
+        self.memory = about["DBName"] == self.MEMORY_DB if memory is None else memory
+        if self.memory:
+            self.db_name = f"file:/fcdb_{uuid4().hex}?vfs=memdb"
+            self._memory_keeper = sqlite3.connect(self.db_name, uri=True, check_same_thread=False)
+        else:
+            self.db_name = about["DataFolder"] + about["DBName"]
+
+        # Import stage reports are appended to "log" (null to only return them) and "capture" switches on cProfile/tracemalloc,
+        # see FC_ImportProfile, capture can also be set with the FC_IMPORT_PROFILE environment variable.
+        # In-memory databases don't log unless "log" is set, they leave nothing behind.
+        import_profile = about.get("ImportProfile", {})
+        self.import_log = import_profile.get("log", None if self.memory else self.data_folder + "import_profile.jsonl")
+        self.import_capture = import_profile.get("capture")
+
+        # Connections are opened lazily, one per thread, and kept for the lifetime of the object
+        self.pragmas = dict(self.DEFAULT_PRAGMAS, **about.get("DBPragmas", {}), **(pragmas or {}))
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        # Bumped by close() so threads reopen their connection on next use
+        self._conn_epoch = 0
+
+        # Statement profiler, None unless profiling was started (see start_profiling or "DBProfile" in About.json)
+        self.profiler = None
         self._set_db_and_prefs()
+        if about.get("DBProfile") is not None:
+            self.start_profiling(**about["DBProfile"])
 
     def set_new_prefs(self, prefs, date_fmt=""):
         """ Set new preferences & date format on DB connection and object factory."""
         self.active_prefs = prefs
         if date_fmt:
             self.date_format = date_fmt
-        self.obj_f.set_new_prefs(prefs, date_fmt)
+        self.obj_f.set_new_prefs(prefs, self.date_format)
 
     def _set_db_and_prefs(self):
         # sets DB connection and preferences, creates DB if it isn't found
-        if not isfile(self.db_name):
-            print(f"No FCDB was found, initializing a new database at: \n\t---> {join(getcwd(), self.db_name)}")
+        if self.memory or not isfile(self.db_name):
+            if not self.memory:
+                print(f"No FCDB was found, initializing a new database at: \n\t---> {join(getcwd(), self.db_name)}", file=sys.stderr)
             self._create_new_db()
+            self._migrate(report=False)
             startup_data = self._load_startup_data()
             self.obj_f = dc.dbObjFactory(dc.preference(*startup_data["startup_prefs"][0]), self.date_format)
             self._populate_startup_data(startup_data)
         else:
+            self._migrate()
             self.active_prefs = self._sselect(dc.preference, suffix="ORDER BY id DESC")[0]
             self.obj_f = dc.dbObjFactory(self.active_prefs, self.date_format)
 
@@ -91,72 +145,290 @@ class fcdb():
         return objs
     # endregion
 
+    # region Connection
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """ The calling thread's connection, None until the thread first uses the database."""
+        if getattr(self._local, "epoch", None) != self._conn_epoch:
+            return None
+        return self._local.conn
+
+    @property
+    def _tx_depth(self):
+        # Transaction nesting depth of the calling thread
+        return getattr(self._local, "tx_depth", 0)
+
+    @_tx_depth.setter
+    def _tx_depth(self, value):
+        self._local.tx_depth = value
+
+    def _get_conn(self):
+        # Get the calling thread's long-lived connection, opening and tuning it on first use
+        conn = self.conn
+        if conn is None:
+            # Each connection is only used by the thread that opened it, check_same_thread is off so close() can close them all
+            conn = sqlite3.connect(self.db_name, isolation_level=None, check_same_thread=False, uri=self.memory)
+            for pragma, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {pragma} = {value};")
+            conn.create_function("fc_date", 1, self._date_key, deterministic=True)
+            with self._conns_lock:
+                self._conns.append(conn)
+                self._local.conn = conn
+                self._local.epoch = self._conn_epoch
+                self._local.tx_depth = 0
+        return conn
+
+    def _date_key(self, value):
+        # SQL function fc_date, converts a date string in the About.json date format to a date key (used by migrations).
+        # Startup accounts were saved with a numeric last_update, which TEXT columns kept as e.g. "19990101".
+        if value is None or isinstance(value, int):
+            return value
+        if value.isdigit():
+            return int(value)
+        return dc.to_date_key(datetime.strptime(value, self.date_format))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group statements into a single commit.
+        Transactions can be nested, only the outermost one commits.
+        Any error rolls back the whole transaction and is re-raised.
+        """
+        conn = self._get_conn()
+        if self._tx_depth == 0:
+            conn.execute("BEGIN;")
+        self._tx_depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                conn.rollback()
+            raise
+        self._tx_depth -= 1
+        if self._tx_depth == 0:
+            if self.profiler is None:
+                conn.commit()
+            else:
+                start = perf_counter()
+                conn.commit()
+                self.profiler.record("COMMIT;", perf_counter() - start, 0)
+
+    def _get_total_changes(self) -> int:
+        # Rows changed on the calling thread's connection since it was opened
+        return self._get_conn().total_changes
+
+    def close(self):
+        """ Close every thread's database connection, each is reopened on its thread's next use. In-memory databases keep their data."""
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+            self._conn_epoch += 1
+    # endregion
+
+    # region Backup
+    def backup(self, path) -> bool:
+        """
+        Snapshot the database to a file with SQLite's backup API, replacing the file's contents.
+        Works for in-memory and file databases while other threads keep reading, returns True if the snapshot was written.
+        """
+        if self._tx_depth:
+            print("Can't back up the database inside a transaction", file=sys.stderr)
+            return False
+        target = sqlite3.connect(path)
+        try:
+            self._get_conn().backup(target)
+            return True
+        except sqlite3.Error as e:
+            self._on_error(e)
+            return False
+        finally:
+            target.close()
+
+    def restore(self, path) -> bool:
+        """
+        Replace the database's contents with a snapshot file (see backup) using SQLite's backup API, the snapshot is only read.
+        Older snapshots are migrated to the current schema, returns True if the snapshot was restored.
+        """
+        if self._tx_depth:
+            print("Can't restore the database inside a transaction", file=sys.stderr)
+            return False
+        if not isfile(path):
+            print(f"No FCDB snapshot was found at {path}", file=sys.stderr)
+            return False
+        source = sqlite3.connect(path, uri=True)
+        try:
+            if self.memory:
+                # A backup copies the snapshot's journal mode and memdb can't open WAL databases, so the snapshot is first
+                # VACUUMed INTO a second memdb database (always a rollback journal database) and backed up from there
+                staging_name = f"file:/fcdb_{uuid4().hex}?vfs=memdb"
+                staging = sqlite3.connect(staging_name, uri=True)
+                try:
+                    source.execute("VACUUM INTO ?;", (staging_name,))
+                    staging.backup(self._get_conn())
+                finally:
+                    staging.close()
+            else:
+                source.backup(self._get_conn())
+        except sqlite3.Error as e:
+            self._on_error(e)
+            return False
+        finally:
+            source.close()
+        self._migrate()
+        self._after_restore()
+        return True
+
+    def _after_restore(self):
+        # Hook run once a snapshot was restored and migrated, reloads everything read from the old contents. Subclasses drop their caches here.
+        self.set_new_prefs(self._sselect(dc.preference, suffix="ORDER BY id DESC")[0])
+    # endregion
+
     # region Run
-    def _r_query(self, statement):
+    def _on_error(self, e):
+        # Errors inside an open transaction are raised so it can roll back, otherwise they are printed
+        if self._tx_depth:
+            raise e
+        print(e, file=sys.stderr)
+
+    def _execute(self, target, statement, values=(), fetch=False):
+        # Run one statement on a connection or cursor, list values are run with executemany. Returns all rows when fetch is set,
+        # otherwise the cursor. Timed and attributed to its call site when a profiler is attached.
+        many = isinstance(values, list)
+        if self.profiler is None:
+            cursor = target.executemany(statement, values) if many else target.execute(statement, values)
+            return cursor.fetchall() if fetch else cursor
+
+        start = perf_counter()
+        try:
+            cursor = target.executemany(statement, values) if many else target.execute(statement, values)
+            result = cursor.fetchall() if fetch else cursor
+        except sqlite3.Error as e:
+            self.profiler.record(statement, perf_counter() - start, 0, error=e)
+            raise
+        self.profiler.record(statement, perf_counter() - start, len(result) if fetch else cursor.rowcount, len(values) if many else None)
+        return result
+
+    def _r_query(self, statement, values=()):
         # Run a query on the database and get all rows
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.execute(statement)
-                return cursor.fetchall()
+            return self._execute(self._get_conn(), statement, values, fetch=True)
         except sqlite3.Error as e:
-            print(e)
+            self._on_error(e)
 
     def _r_val_statement(self, statement, values):
         # Run a statement on the database repeatedly using entries in "values", return the last row ID
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                if isinstance(values, list):
-                    cursor.executemany(statement, values)
-                else:
-                    cursor.execute(statement, values)
-                conn.commit()
-                return cursor.lastrowid
+            with self.transaction() as conn:
+                return self._execute(conn, statement, values).lastrowid
         except sqlite3.Error as e:
-            print(e)
+            self._on_error(e)
 
     def _r_statement(self, statement):
         # Run a query on the database and get the last row ID
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.execute(statement)
-                conn.commit()
-                return cursor.lastrowid
+            with self.transaction() as conn:
+                return self._execute(conn, statement).lastrowid
         except sqlite3.Error as e:
-            print(e)
+            self._on_error(e)
 
     def r_cmds(self, statements):
         # Run a set of statements on the database
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
+            with self.transaction() as conn:
                 for statement in statements:
-                    cursor.execute(statement)
-                conn.commit()
+                    self._execute(conn, statement)
         except sqlite3.Error as e:
-            print(e)
+            self._on_error(e)
+
+    def _r_transaction(self, steps):
+        # Run (statement, values) pairs on one connection and commit them together, list values are run with executemany
+        try:
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                for statement, values in steps:
+                    self._execute(cursor, statement, values)
+                return cursor.lastrowid
+        except sqlite3.Error as e:
+            self._on_error(e)
+    # endregion
+
+    # region Profiling
+    def start_profiling(self, slow_ms: float = 100.0, slow_log: str = None, site_depth: int = 2):
+        """
+        Time every statement run from now on, see sql_profiler.
+        Can also be switched on at startup with "DBProfile": {"slow_ms": ..., "slow_log": ...} in About.json.
+
+        Args:
+            slow_ms (float): Statements slower than this are kept in the slow-query log
+            slow_log (str): File slow statements are also appended to, None to keep them in memory only
+            site_depth (int): Frames outside FC_DBConnect recorded as each statement's call site
+
+        Returns:
+            sql_profiler: The attached profiler
+        """
+        self.profiler = sql_profiler(slow_ms, slow_log, site_depth)
+        return self.profiler
+
+    def stop_profiling(self):
+        """ Detach the profiler and return it with everything it recorded."""
+        profiler, self.profiler = self.profiler, None
+        return profiler
+
+    @contextmanager
+    def profiling(self, **kwargs):
+        """ Profile the statements run inside a with block, yields the profiler (see start_profiling for the arguments)."""
+        profiler = self.start_profiling(**kwargs)
+        try:
+            yield profiler
+        finally:
+            if self.profiler is profiler:
+                self.stop_profiling()
     # endregion
 
     # region Query Strings
+    # Statement text cache keyed by (kind, table, columns[, id columns]), statements only depend on their key
+    _statements = {}
+
+    def _q_insert(self, table, cols: tuple) -> str:
+        # Cached insert statement for a table and column tuple
+        key = ("insert", table, cols)
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = f"INSERT INTO {table} ({','.join(cols)}) VALUES{self._mk_value_string(len(cols))};"
+        return statement
+
+    def _q_update(self, table, cols: tuple) -> str:
+        # Cached update statement for a table and column tuple, the row id is bound as the last value
+        key = ("update", table, cols)
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = f"UPDATE {table} SET {self._mk_col_set(cols)} WHERE id = ?;"
+        return statement
+
+    def _q_upsert(self, table, cols: tuple, id_cols: tuple) -> str:
+        # Cached upsert statement for a table, column tuple and conflict columns
+        key = ("upsert", table, cols, id_cols)
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = (f'{self._q_insert(table, cols)[:-1]} ON CONFLICT({", ".join(id_cols)}) '
+                                                 f'DO UPDATE SET {self._mk_upsert_colset(cols)};')
+        return statement
+
     # Each method makes a corresponding query statment string from supplied data
     def mk_q_insert(self, table, row_data):
         """ Make insert query."""
-        fields = ",".join(row_data.keys())
-        return (f"INSERT INTO {table} ({fields}) VALUES{self._mk_value_string(len(row_data))};", tuple(row_data.values()))
+        return (self._q_insert(table, tuple(row_data)), tuple(row_data.values()))
 
     def mk_q_update(self, table, row_data):
         """ Make update query."""
         row_id = row_data.pop("id")
-        return (f"UPDATE {table} SET {self._mk_col_set(row_data)} WHERE id = {row_id};", tuple(row_data.values()))
+        return (self._q_update(table, tuple(row_data)), tuple(row_data.values()) + (row_id,))
 
     def mk_q_upsert(self, table, row_data, id_cols):
         """ Make upsert query."""
-        # Unwrap the query string and remove trailing semicolon
-        qinsert = self.mk_q_insert(table, row_data)[0][:-1]
-        # Create Upsert query from supplied data and insert query
-        return (f'{qinsert} ON CONFLICT({", ".join(id_cols)}) DO UPDATE SET {self._mk_upsert_colset(row_data)};', tuple(row_data.values()))
+        return (self._q_upsert(table, tuple(row_data), tuple(id_cols)), tuple(row_data.values()))
     # endregion
 
     # region Query Methods
@@ -176,49 +448,83 @@ class fcdb():
         rows = self._r_query(qSelect.format(db_obj_type.get_table(), fields, suffix))
         return [self.obj_f.mk_dbo(db_obj_type, x) for x in rows]
 
+    def _select_columns(self, db_obj_type: type[dc.dbObj], fields="*", suffix="", cols_type=dc.dbColumns) -> dc.dbColumns:
+        """Run a select statement and return compact columns, dbObjs are only made for rows that are indexed"""
+        qSelect = "SELECT {1} FROM {0}{2};"
+        if suffix and suffix[0] != " ":
+            suffix = f" {suffix}"
+        statement = qSelect.format(db_obj_type.get_table(), fields, suffix)
+        profiler = self.profiler
+        start = perf_counter()
+        try:
+            # Rows are streamed from the cursor into the columns, so a profiled read is timed through the fetch
+            cursor = self._get_conn().execute(statement)
+            cols = cols_type.from_rows(db_obj_type, [x[0] for x in cursor.description], cursor, self.obj_f)
+        except sqlite3.Error as e:
+            if profiler:
+                profiler.record(statement, perf_counter() - start, 0, error=e)
+            self._on_error(e)
+            return None
+        if profiler:
+            profiler.record(statement, perf_counter() - start, len(cols))
+        return cols
+
+    @staticmethod
+    def _group_rows(db_objs, kind):
+        # Groups objects by (type, static ID) and turns each into a row tuple -> {(type, static ID): (cols, rows)}
+        # kind "update" puts the row id last (for WHERE id = ?) and skips objects without one
+        groups = {}
+        for db_obj in db_objs:
+            if kind == "update":
+                if not db_obj.id or db_obj.id == -1:
+                    print("When updating a db obj id must be set!", file=sys.stderr)
+                    continue
+                static = False
+            else:
+                static = db_obj.has_static_id()
+            group = groups.get((type(db_obj), static))
+            if group is None:
+                cols = db_obj.get_row_cols(static)
+                # The row values are fetched with the id appended for updates
+                group = groups[(type(db_obj), static)] = (cols, [], cols + ("id",) if kind == "update" else cols)
+            group[1].append(db_obj.get_row_values(group[2]))
+        return groups
+
+    def _r_groups(self, groups, mk_statement):
+        # Runs every group of rows with its statement in one transaction, return the last row ID
+        last_id = None
+        with self.transaction():
+            for (db_obj_type, _), (cols, rows, _) in groups.items():
+                # Single rows go through execute so lastrowid is set
+                last_id = self._r_val_statement(mk_statement(db_obj_type, cols), rows if len(rows) > 1 else rows[0])
+        return last_id
+
     def _insert(self, db_obj: dc.dbObj):
         """SQL Insert"""
-        qInsert = self.mk_q_insert(db_obj.get_table(), db_obj.get_row_data())
-        return self._r_val_statement(*qInsert)
+        return self._binsert([db_obj])
 
     def _binsert(self, db_objs: list[dc.dbObj]):
         """SQL Bulk Insert"""
-        values = []
-        for db_obj in db_objs:
-            qinsert = self.mk_q_insert(db_obj.get_table(), db_obj.get_row_data())
-            values.append(qinsert[1])
-        return self._r_val_statement(qinsert[0], values)
+        return self._r_groups(self._group_rows(db_objs, "insert"),
+                              lambda t, cols: self._q_insert(t.get_table(), cols))
 
     def _update(self, db_obj: dc.dbObj):
         """SQL Update"""
-        if not db_obj.id or db_obj.id == -1:
-            print("When updating a db obj id must be set!")
-        else:
-            qupdate = self.mk_q_update(db_obj.get_table(), db_obj.get_row_data())
-            return self._r_val_statement(*qupdate)
+        return self._bupdate([db_obj])
 
     def _bupdate(self, db_objs: list[dc.dbObj]):
         """SQL Bulk Update"""
-        values = []
-        for db_obj in db_objs:
-            if not db_obj.id or db_obj.id == -1:
-                print("When updating a db obj id must be set!")
-            else:
-                qupdate = self.mk_q_update(db_obj.get_table(), db_obj.get_row_data())
-                values.append(qupdate[1])
-        return self._r_val_statement(qupdate[0], values)
+        return self._r_groups(self._group_rows(db_objs, "update"),
+                              lambda t, cols: self._q_update(t.get_table(), cols))
 
     def _upsert(self, db_obj: dc.dbObj):
         """SQL Upsert"""
-        return self._r_val_statement(*self.mk_q_upsert(db_obj.get_table(), db_obj.get_row_data()))
+        return self._bupsert([db_obj])
 
     def _bupsert(self, db_objs: list[dc.dbObj]):
         """SQL Bulk Upsert"""
-        values = []
-        for db_obj in db_objs:
-            qupsert = self.mk_q_upsert(db_obj.get_table(), db_obj.get_row_data(), db_obj.get_id_cols())
-            values.append(qupsert[1])
-        return self._r_val_statement(qupsert[0], values)
+        return self._r_groups(self._group_rows(db_objs, "upsert"),
+                              lambda t, cols: self._q_upsert(t.get_table(), cols, tuple(t.ID_COLS)))
     # endregion
 
     # region Create
@@ -235,6 +541,10 @@ class fcdb():
     def _create_new_db(self):
         self._r_db_script(f"{self.data_folder}dbCreationScript.sql")
 
+    def explain(self, statement):
+        """ Get the EXPLAIN QUERY PLAN detail lines for a statement, used to confirm queries hit an index."""
+        return [row[-1] for row in self._r_query(f"EXPLAIN QUERY PLAN {statement}")]
+
     def _load_startup_data(self):
         f = open(f"{self.data_folder}FC_Startup_Data.json")
         return json.load(f)
@@ -254,6 +564,163 @@ class fcdb():
             self._insert(db_obj)
     # endregion
 
+    # region Migrate
+    # Migrations are "<version>_<name>.sql" scripts in the migration folder, the applied version is kept in PRAGMA user_version
+    def get_schema_version(self):
+        """ Get the schema version recorded in the database."""
+        return self._r_query("PRAGMA user_version;")[0][0]
+
+    def _get_migrations(self):
+        # Get (version, file name) pairs for every migration script, ordered by version
+        migrations = []
+        for fname in listdir(self.migration_folder):
+            if fname.endswith(".sql"):
+                migrations.append((int(fname.split("_")[0]), fname))
+        return sorted(migrations)
+
+    def _migrate(self, report=True):
+        # Upgrade the schema in place by running every migration newer than the recorded version, one transaction per migration
+        # Progress is only reported when upgrading an existing database, a new one is silently brought up to date
+        version = self.get_schema_version()
+        applied = []
+        for m_version, fname in self._get_migrations():
+            if m_version > version:
+                if report:
+                    print(f"Migrating FCDB to schema version {m_version} ({fname})", file=sys.stderr)
+                with self.transaction() as conn:
+                    for statement in self._prepare_staments(join(self.migration_folder, fname)):
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {m_version};")
+                applied.append(m_version)
+        if applied:
+            self._after_migrate(applied)
+
+    def _after_migrate(self, applied):
+        # Hook run once all migrations are applied, with the versions that were applied. Subclasses build derived data here.
+        pass
+    # endregion
+
+
+class sql_profiler():
+    """
+    Statement instrumentation for fcdb (see fcdb.start_profiling).
+    Every statement is timed with the rows it returned or changed and attributed to the code that ran it.
+    Statements are aggregated by shape (literals and IN lists collapsed), so an N+1 pattern shows up as one shape run many times.
+    """
+    # Literal strings and numbers, and lists of placeholders or literals, collapsed to get a statement's shape
+    _LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w.])\d+(?:\.\d+)?\b")
+    _LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+    _SPACE = re.compile(r"\s+")
+
+    # Files whose frames are skipped when finding a statement's call site
+    _DB_FILES = {basename(__file__), "contextlib.py"}
+
+    def __init__(self,
+                 slow_ms: float = 100.0,
+                 slow_log: str = None,
+                 site_depth: int = 2,
+                 keep_slow: int = 200):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.site_depth = site_depth
+        # Newest slow statements kept in memory: dicts of time, ms, rows, site and statement
+        self.slow = deque(maxlen=keep_slow)
+        # Shape -> aggregate, statements run on any thread are recorded
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def get_shape(statement: str) -> str:
+        """ Normalize a statement to its shape: one line, literals replaced with ? and lists of values with (?, ...)."""
+        shape = sql_profiler._LITERALS.sub("?", statement)
+        shape = sql_profiler._LISTS.sub("(?, ...)", shape)
+        return sql_profiler._SPACE.sub(" ", shape).strip()
+
+    def _get_site(self) -> str:
+        # Describe the innermost frames outside the DB layer, e.g. "FC_DBAccess.py:412 _munch_staged < FC_Import.py:128 _write_ready"
+        frame = sys._getframe(2)
+        sites = []
+        while frame and len(sites) < self.site_depth:
+            name = basename(frame.f_code.co_filename)
+            if name not in self._DB_FILES:
+                sites.append(f"{name}:{frame.f_lineno} {frame.f_code.co_name}")
+            frame = frame.f_back
+        return " < ".join(sites)
+
+    def record(self, statement, seconds, rows, batch=None, error=None):
+        """
+        Record one statement run.
+
+        Args:
+            statement (str): Statement text
+            seconds (float): Time the statement (and its fetch) took
+            rows (int): Rows returned by a query, or changed by a write (-1 if SQLite doesn't report it)
+            batch (int): Parameter sets of an executemany, None for a single run
+            error (Exception): Error the statement raised
+        """
+        shape = self.get_shape(statement)
+        site = self._get_site()
+        ms = seconds * 1000
+        with self._lock:
+            stat = self._stats.get(shape)
+            if stat is None:
+                stat = self._stats[shape] = {"shape": shape, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "batch": 0, "errors": 0, "sites": {}}
+            stat["count"] += 1
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+            stat["rows"] += max(rows, 0)
+            stat["batch"] += batch or 0
+            stat["errors"] += error is not None
+            stat["sites"][site] = stat["sites"].get(site, 0) + 1
+
+        if ms >= self.slow_ms or error is not None:
+            entry = {"time": datetime.now().isoformat(timespec="milliseconds"), "ms": round(ms, 3), "rows": rows, "site": site,
+                     "statement": self._SPACE.sub(" ", statement).strip(), "error": str(error) if error else None}
+            with self._lock:
+                self.slow.append(entry)
+                if self.slow_log:
+                    with open(self.slow_log, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry) + "\n")
+
+    def get_stats(self, sort: str = "total_ms") -> list[dict]:
+        """
+        Get the aggregate of every statement shape, largest first.
+
+        Args:
+            sort (str): Key to sort by, "total_ms", "count", "max_ms" or "rows"
+
+        Returns:
+            list[dict]: shape, count, total_ms, mean_ms, max_ms, rows, batch (executemany parameter sets), errors, sites (call site -> runs)
+        """
+        with self._lock:
+            stats = [dict(x, sites=dict(x["sites"]), mean_ms=x["total_ms"] / x["count"]) for x in self._stats.values()]
+        return sorted(stats, key=lambda x: x[sort], reverse=True)
+
+    def get_totals(self) -> dict:
+        """ Get the statement count, time and rows across every shape."""
+        stats = self.get_stats()
+        return {"statements": sum(x["count"] for x in stats), "total_ms": sum(x["total_ms"] for x in stats),
+                "rows": sum(x["rows"] for x in stats), "shapes": len(stats), "errors": sum(x["errors"] for x in stats)}
+
+    def report(self, top: int = 15, sort: str = "total_ms") -> str:
+        """ Format the top statement shapes as a text table with their busiest call site."""
+        totals = self.get_totals()
+        lines = [f"{totals['statements']:,} statements, {totals['shapes']} shapes, {totals['total_ms']:,.1f} ms, {totals['rows']:,} rows, {totals['errors']} errors",
+                 f"{'count':>8} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'rows':>10}  statement"]
+        for x in self.get_stats(sort)[:top]:
+            site, runs = max(x["sites"].items(), key=lambda s: s[1])
+            others = f", {len(x['sites']) - 1} other sites" if len(x["sites"]) > 1 else ""
+            lines.append(f"{x['count']:>8,} {x['total_ms']:>10,.1f} {x['mean_ms']:>9.2f} {x['max_ms']:>9.2f} {x['rows']:>10,}  {x['shape'][:120]}")
+            lines.append(f"{'':>50}  from {site} ({runs:,} runs{others})")
+        return "\n".join(lines)
+
+    def reset(self):
+        """ Forget every recorded statement."""
+        with self._lock:
+            self._stats = {}
+            self.slow.clear()
+
 
 class Struct(dict):
     """
@@ -268,10 +735,7 @@ class Struct(dict):
 
 
 if __name__ == "__main__":
-    dbname = r"ProgramData\TestData\TESTFC.db"
-    try:
-        db = fcdb("ProgramData/TestData/TEST_FC_About.json")
-        # db.munch_follow_data("ProgramData\FollowerJson\OF_Flwg_May30_2024.json", "ProgramData\FollowerJson\OF_Flwr_May30_2024.json", 0, datetime.today().strftime("%b%d_%Y"))
-    finally:
-        if isfile(dbname):
-            remove(dbname)
+    # Build a test database in memory, nothing is written to disk
+    db = fcdb("ProgramData/TestData/TEST_FC_About.json", memory=True)
+    print(f"Schema version {db.get_schema_version()}, tables {[x[0] for x in db._r_query('SELECT name FROM sqlite_master WHERE type = ?;', ('table',))]}")
+    db.close()
@@ -4,9 +4,28 @@ FC_DataClasses
 Contains Model classes for interacting with the database
 """
 
+from array import array
 from datetime import datetime
 from functools import total_ordering
+from itertools import compress
 import json
+from operator import attrgetter
+from sys import intern
+import threading
+import zlib
+
+
+# region Dates
+# Dates are stored as sortable integer keys in YYYYMMDD form (May 30 2024 -> 20240530)
+def to_date_key(value: datetime) -> int:
+    """ Converts a datetime to a sortable date key."""
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def from_date_key(key: int) -> datetime:
+    """ Converts a date key back to a datetime."""
+    return datetime(key // 10000, key // 100 % 100, key % 100)
+# endregion
 
 
 # region Abstract Types
@@ -62,6 +81,44 @@ class dbObj():
             fields.pop(field, None)
         return fields
 
+    def has_static_id(self) -> bool:
+        """ Checks if the object carries its own ID (every ID column is set and id != -1)."""
+        for id_col in type(self).ID_COLS:
+            if not hasattr(self, id_col):
+                return False
+        # Special case for id = -1
+        return not (hasattr(self, "id") and self.id == -1)
+
+    def get_row_cols(self, with_id: bool) -> tuple:
+        """ Gets the names of the columns saved to the database in field order, with or without the ID columns (cached per class)."""
+        obj_type = type(self)
+        # Cache lives in the class's own __dict__ so subclasses don't share their parent's columns
+        row_cols = obj_type.__dict__.get("_row_cols")
+        if row_cols is None:
+            filt = set(obj_type._get_filter_fields())
+            cols = tuple(f for f in vars(self) if f not in filt)
+            no_id = tuple(f for f in cols if f not in obj_type.ID_COLS)
+            row_cols = obj_type._row_cols = {True: cols, False: no_id}
+        return row_cols[with_id]
+
+    def get_row_values(self, cols: tuple) -> tuple:
+        """ Gets the values of cols as a row tuple, json fields are dumped to strings."""
+        obj_type = type(self)
+        getters = obj_type.__dict__.get("_row_getters")
+        if getters is None:
+            getters = obj_type._row_getters = {}
+        getter = getters.get(cols)
+        if getter is None:
+            # attrgetter returns a bare value for a single name, always wrap it in a tuple
+            getter = attrgetter(*cols) if len(cols) > 1 else lambda x, g=attrgetter(*cols): (g(x),)
+            getters[cols] = getter
+
+        values = getter(self)
+        if obj_type.json_fields:
+            json_fields = obj_type.json_fields
+            values = tuple(json.dumps(v) if c in json_fields else v for c, v in zip(cols, values))
+        return values
+
     def get_row_data(self) -> dict:
         """
         Gets the row data for saving to the database.
@@ -73,26 +130,9 @@ class dbObj():
         Returns:
             dict: a set of (field name [key], field value) pairs
         """
-        obj_type = type(self)
-        has_id = True
-        id_cols = obj_type.get_id_cols()
-
-        for id_col in id_cols:
-            if not hasattr(self, id_col):
-                has_id = False
-                break
-
-            # Special case for id = -1
-            if hasattr(self, "id") and self.id == -1:
-                has_id = False
-                break
-
-        if has_id:
-            print("Writing object with static ID, be careful!")
-            return self._get_filtered_fields(obj_type._get_filter_fields())
-        else:
-            return self._get_filtered_fields(obj_type._get_filter_fields()
-                                             + id_cols)
+        has_id = self.has_static_id()
+        cols = self.get_row_cols(has_id)
+        return dict(zip(cols, self.get_row_values(cols)))
 
     def get_display_data(self):
         """
@@ -114,37 +154,34 @@ class dbObj():
 @total_ordering
 class DateComparable(dbObj):
     """
-    Abstract superclass with comparable datetime property.
+    Abstract superclass with comparable date key property.
     """
-    filter_fields = dbObj.filter_fields + ["date_format", "date_prop"]
+    filter_fields = dbObj.filter_fields + ["date_prop"]
 
     # Date property name
     date_prop = "date"
 
-    def __init__(self, date_format):
+    def __init__(self):
         super(DateComparable, self).__init__()
-        self.date_format = date_format
 
-    # Gets datetime property for comparison
-    def _get_datetime(self):
-        return datetime.strptime(getattr(self, self.date_prop),
-                                 self.date_format)
+    # Gets date key property for comparison
+    def _get_date_key(self):
+        return getattr(self, self.date_prop)
 
     # Checks if "other" has the appropriate comparison fields
     def _is_valid_op(self, other):
         return (hasattr(other, "date_prop")
-                and hasattr(other, other.date_prop)
-                and hasattr(other, "date_format"))
+                and hasattr(other, other.date_prop))
 
     def __eq__(self, other):
         if not self._is_valid_op(other):
             return NotImplemented
-        return self._get_datetime() == other._get_datetime()
+        return self._get_date_key() == other._get_date_key()
 
     def __lt__(self, other):
         if not self._is_valid_op(other):
             return NotImplemented
-        return self._get_datetime() < other._get_datetime()
+        return self._get_date_key() < other._get_date_key()
 # endregion
 # endregion
 
@@ -170,6 +207,40 @@ class preference(dbObj):
         self.progress_dir = progress_dir
         self.data_dir = data_dir
         self.ig_url = ig_url
+
+
+class fc_import(dbObj):
+    """
+    FC Import ledger entry.
+    Represents an imports record from the database, one per imported snapshot.
+    """
+    TABLE = "imports"
+    json_fields = ["source_hashes"]
+
+    def __init__(self,
+                 id,
+                 acc_id,
+                 date,
+                 source_hash,
+                 source_hashes,
+                 follow_count,
+                 last_follow_count,
+                 delta=False):
+        super(fc_import, self).__init__()
+        self.id = id
+        self.acc_id = acc_id
+        self.date = date
+
+        # Hash identifying the whole set of source files, and the sha256 of each source file
+        self.source_hash = source_hash
+        self.source_hashes = source_hashes
+
+        # Rows written to follow and last_follows by the import
+        self.follow_count = follow_count
+        self.last_follow_count = last_follow_count
+
+        # Was the import stored as a delta (only changed users written)?
+        self.delta = delta
 # endregion
 
 
@@ -183,14 +254,15 @@ class follow(DateComparable):
 
     def __init__(self,
                  id,
-                 username,
+                 user_id,
                  acc_id, date,
                  follower,
                  following,
-                 date_format):
-        super(follow, self).__init__(date_format)
+                 import_id=None):
+        super(follow, self).__init__()
         self.id = id
-        self.username = username
+        # ID of the ig_user, see dbObjFactory.fmt_user for the username
+        self.user_id = user_id
         self.acc_id = acc_id
         self.date = date
 
@@ -200,6 +272,9 @@ class follow(DateComparable):
         # Is the associated account following the User?
         self.following = following
 
+        # ID of the import that wrote this follow (None for follows imported before the ledger existed)
+        self.import_id = import_id
+
     # Dont follow back (Your account follows the user, the user does not follow back)
     def dfb(self):
         return (not self.follower and self.following)
@@ -214,36 +289,110 @@ class ig_account(DateComparable):
     Represents an ig_account record from the database
     """
     TABLE = "ig_account"
-    date_field = "last_update"
+    date_prop = "last_update"
 
     def __init__(self,
                  id,
                  username,
                  abbrv,
-                 last_update,
-                 date_format):
-        super(ig_account, self).__init__(date_format)
+                 last_update):
+        super(ig_account, self).__init__()
         self.id = id
         self.username = username
         self.abbrv = abbrv
         self.last_update = last_update
 
 
+class ig_user(dbObj):
+    """
+    FC Instagram User
+    Represents an ig_user record, every user seen in an export is stored once and referenced by ID
+    """
+    TABLE = "ig_user"
+
+    def __init__(self,
+                 id,
+                 username):
+        super(ig_user, self).__init__()
+        self.id = id
+        self.username = username
+
+
+class follow_summary(DateComparable):
+    """
+    FC Follow Summary
+    Represents a follow_summary record, an account's headline counts as of an import date
+    """
+    TABLE = "follow_summary"
+    ID_COLS = ["acc_id", "date"]
+
+    def __init__(self,
+                 acc_id,
+                 date,
+                 follower,
+                 following,
+                 dfb,
+                 idfb,
+                 gained,
+                 lost):
+        super(follow_summary, self).__init__()
+        self.acc_id = acc_id
+        self.date = date
+        self.follower = follower
+        self.following = following
+
+        # Users the account follows who don't follow back, and followers the account doesn't follow back
+        self.dfb = dfb
+        self.idfb = idfb
+
+        # Followers gained/lost since the account's previous import (0 on its first)
+        self.gained = gained
+        self.lost = lost
+
+
+class follow_bitmap(DateComparable):
+    """
+    FC Follow Bitmap
+    Represents a follow_bitmap record, the users holding one relationship (kind) to an account as of an import date
+    """
+    TABLE = "follow_bitmap"
+    ID_COLS = ["acc_id", "kind", "date"]
+
+    def __init__(self,
+                 acc_id,
+                 date,
+                 kind,
+                 bits):
+        super(follow_bitmap, self).__init__()
+        self.acc_id = acc_id
+        self.date = date
+
+        # "follower" (the user follows the account) or "following" (the account follows the user)
+        self.kind = kind
+
+        # Compressed user_bitmap (see user_bitmap.to_blob)
+        self.bits = bits
+
+    def get_users(self):
+        """ Decompress the users into a user_bitmap."""
+        return user_bitmap.from_blob(self.bits)
+
+
 class last_follow(dbObj):
     """
     FC Instagram Account
     Represents an last_follows record from the database
     """
     TABLE = "last_follows"
-    ID_COLS = ["username", "acc_id"]
+    ID_COLS = ["user_id", "acc_id"]
 
     def __init__(self,
-                 username: str,
+                 user_id: int,
                  acc_id: int,
                  last_following_id: int,
                  last_follower_id: int):
         super(last_follow, self).__init__()
-        self.username = username
+        self.user_id = user_id
         self.acc_id = acc_id
         self.last_following_id = last_following_id
         self.last_follower_id = last_follower_id
@@ -251,14 +400,286 @@ class last_follow(dbObj):
 # endregion
 
 
+# region Result Types
+class dbColumns():
+    """
+    Columnar result set for bulk reads.
+    Integer columns are packed into arrays and text columns share one list each, so no dbObj or per-row dict is kept.
+    dbObjs are only built when a row is indexed.
+    """
+    # Maps 0 <-> 1 bytes to negate a mask
+    _NOT = bytes.maketrans(b"\x00\x01", b"\x01\x00")
+
+    def __init__(self,
+                 T: type[dbObj],
+                 names: list[str],
+                 cols: list,
+                 obj_f):
+        self.T = T
+        self.names = names
+        self.cols = cols
+        self.obj_f = obj_f
+
+    @classmethod
+    def from_rows(cls, T: type[dbObj], names, rows, obj_f):
+        """ Builds columns from an iterable of row tuples (e.g. a cursor) without holding the rows."""
+        cols = [array("q") for _ in names]
+        for row in rows:
+            for i, value in enumerate(row):
+                col = cols[i]
+                if isinstance(col, array) and not isinstance(value, int):
+                    # Column holds text or NULLs, fall back to a list
+                    col = cols[i] = list(col)
+                # Repeated text is stored once
+                col.append(intern(value) if isinstance(value, str) else value)
+        return cls(T, names, cols, obj_f)
+
+    def __len__(self):
+        return len(self.cols[0]) if self.cols else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        return self.obj_f.mk_dbo(self.T, [col[key] for col in self.cols])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def col(self, name):
+        """ Gets a column by name."""
+        return self.cols[self.names.index(name)]
+
+    def mask(self, name) -> bytes:
+        """ Gets a mask of a boolean column, one 0/1 byte per row."""
+        return bytes(map(bool, self.col(name)))
+
+    @staticmethod
+    def mask_and(a: bytes, b: bytes) -> bytes:
+        """ Combines two masks, both must be set."""
+        return (int.from_bytes(a, "big") & int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+    @classmethod
+    def mask_not(cls, a: bytes) -> bytes:
+        """ Negates a mask."""
+        return a.translate(cls._NOT)
+
+    def filter(self, mask: bytes):
+        """ Gets the rows where mask is set as new columns."""
+        cols = [array("q", compress(c, mask)) if isinstance(c, array) else list(compress(c, mask)) for c in self.cols]
+        return dbColumns(self.T, self.names, cols, self.obj_f)
+
+
+class follow_columns(dbColumns):
+    """
+    Columnar follow results with vectorized relationship filters.
+    """
+    def followers(self):
+        """ Rows where the user follows the account."""
+        return self.filter(self.mask("follower"))
+
+    def followings(self):
+        """ Rows where the account follows the user."""
+        return self.filter(self.mask("following"))
+
+    def dfb(self):
+        """ Rows where the user doesn't follow back (see follow.dfb)."""
+        return self.filter(self.mask_and(self.mask("following"), self.mask_not(self.mask("follower"))))
+
+    def idfb(self):
+        """ Rows where the account doesn't follow back (see follow.idfb)."""
+        return self.filter(self.mask_and(self.mask("follower"), self.mask_not(self.mask("following"))))
+
+    def filter(self, mask: bytes):
+        filtered = super(follow_columns, self).filter(mask)
+        return follow_columns(filtered.T, filtered.names, filtered.cols, filtered.obj_f)
+
+
+class user_bitmap():
+    """
+    Set of ig_user IDs held as the bits of one int (bit n set = user n is in the set).
+    Union, intersection and difference run over whole machine words in C, no row objects or username sets are built.
+    """
+
+    def __init__(self,
+                 bits: int = 0):
+        self.bits = bits
+
+    @classmethod
+    def from_ids(cls, user_ids):
+        """ Builds a bitmap from user IDs."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return cls()
+        buf = bytearray((max(user_ids) >> 3) + 1)
+        for x in user_ids:
+            buf[x >> 3] |= 1 << (x & 7)
+        return cls(int.from_bytes(buf, "little"))
+
+    @classmethod
+    def from_blob(cls, blob: bytes):
+        """ Loads a bitmap stored with to_blob."""
+        return cls(int.from_bytes(zlib.decompress(blob), "little"))
+
+    def to_blob(self) -> bytes:
+        """ Compresses the bitmap for storage, runs of users that aren't in the set shrink to a few bytes."""
+        return zlib.compress(self.bits.to_bytes((self.bits.bit_length() + 7) >> 3, "little"))
+
+    def __or__(self, other):
+        return user_bitmap(self.bits | other.bits)
+
+    def __and__(self, other):
+        return user_bitmap(self.bits & other.bits)
+
+    def __sub__(self, other):
+        return user_bitmap(self.bits & ~other.bits)
+
+    def __xor__(self, other):
+        return user_bitmap(self.bits ^ other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, user_bitmap) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, user_id):
+        return user_id >= 0 and (self.bits >> user_id) & 1 == 1
+
+    def __iter__(self):
+        # Find set bits in the binary string, lowest user ID first
+        text = format(self.bits, "b")[::-1]
+        pos = text.find("1")
+        while pos != -1:
+            yield pos
+            pos = text.find("1", pos + 1)
+
+
+class paged_rows():
+    """
+    Window over a result that is loaded a page at a time with keyset pagination.
+    At most max_pages pages are held, so any position of a large result is readable in constant memory.
+    get() may run on a worker thread while the UI thread peek()s at the held rows.
+    """
+
+    def __init__(self,
+                 load_page,
+                 count,
+                 sort=None,
+                 page_size=100,
+                 max_pages=3):
+        # load_page(after, limit, sort, descending, offset) -> rows, pages continue after the "after" row
+        self.load_page = load_page
+        # count() -> total rows
+        self.count = count
+        self.page_size = page_size
+        self.max_pages = max(2, max_pages)
+        self._lock = threading.Lock()
+        self.reset(sort)
+
+    def reset(self, sort=None, descending=False):
+        """ Drop every loaded row and optionally change the sort, the total is counted again on the next get()."""
+        with self._lock:
+            if sort is not None:
+                self.sort = sort
+            self.descending = descending
+            self.total = None
+            # Loaded rows and the position of the first one
+            self._rows = []
+            self._start = 0
+
+    def __len__(self):
+        return self.total or 0
+
+    def peek(self, pos: int, n: int) -> list:
+        """ Gets up to n rows starting at pos if they are already held (never reads the DB), otherwise None."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if self.total is None:
+                return None
+            end = min(pos + min(n, self.page_size), self.total)
+            if pos < end and not (self._start <= pos and end <= self._start + len(self._rows)):
+                return None
+            return self._rows[pos - self._start:end - self._start]
+        finally:
+            self._lock.release()
+
+    def get(self, pos: int, n: int) -> list:
+        """ Gets up to n rows (at most page_size) starting at pos, loading pages next to the loaded ones by key and jumping by offset otherwise."""
+        with self._lock:
+            return self._get(pos, n)
+
+    def _get(self, pos, n):
+        # get() without the lock
+        if self.total is None:
+            self.total = self.count()
+        end = min(pos + min(n, self.page_size), self.total)
+        while pos < end and not (self._start <= pos and end <= self._start + len(self._rows)):
+            loaded_end = self._start + len(self._rows)
+            if self._rows and self._start <= pos <= loaded_end + self.page_size:
+                self._load_next()
+            elif self._rows and pos < self._start and end >= self._start - self.page_size:
+                self._load_prev()
+            else:
+                self._rows = self.load_page(None, self.page_size, self.sort, self.descending, pos)
+                self._start = pos
+                if not self._rows:
+                    # Rows were removed since the total was counted
+                    self.total = pos
+            end = min(end, self.total)
+        return self._rows[pos - self._start:end - self._start]
+
+    def _load_next(self):
+        # Load the page after the last loaded row, dropping pages from the front past max_pages
+        page = self.load_page(self._rows[-1], self.page_size, self.sort, self.descending, 0)
+        if len(page) < self.page_size:
+            self.total = self._start + len(self._rows) + len(page)
+        self._rows += page
+        drop = len(self._rows) - self.page_size * self.max_pages
+        if drop > 0:
+            del self._rows[:drop]
+            self._start += drop
+
+    def _load_prev(self):
+        # Load the page before the first loaded row (the next page in reverse order), dropping pages from the back past max_pages
+        page = self.load_page(self._rows[0], self.page_size, self.sort, not self.descending, 0)
+        page.reverse()
+        if len(page) < self.page_size:
+            # Reached the first row
+            self._start = len(page)
+        self._rows[:0] = page
+        self._start -= len(page)
+        del self._rows[self.page_size * self.max_pages:]
+# endregion
+
+
 class dbObjFactory():
     """
-    Factory for creating dbObj using active prefs and dateformat
+    Factory for creating dbObj using active prefs and dateformat.
+    Dates and usernames are only resolved for display here, dbObjs always hold date keys and user IDs.
     """
     def __init__(self,
                  prefs: preference,
                  date_format: str):
         self.set_new_prefs(prefs, date_format)
+        # load_usernames(user_ids) -> {user_id: username}, see set_user_loader
+        self.load_usernames = None
+        # A user ID always names the same user, so resolved usernames are kept
+        self._usernames = {}
+
+    def set_user_loader(self, load_usernames):
+        """ Sets the function usernames are loaded with, load_usernames(user_ids) -> {user_id: username}."""
+        self.load_usernames = load_usernames
+
+    def clear_usernames(self):
+        """ Forget resolved usernames, for when the database they came from was replaced."""
+        self._usernames = {}
 
     def set_new_prefs(self, prefs: preference, date_format: str):
         """ Updates active Preferences and Date Format."""
@@ -269,34 +690,72 @@ class dbObjFactory():
         """Creates dbObj with type & fields."""
         return getattr(self, T.__name__)(*fields)
 
+    def fmt_date(self, key: int) -> str:
+        """ Formats a date key for display."""
+        return from_date_key(key).strftime(self.db_date_format)
+
+    def parse_date(self, text: str) -> int:
+        """ Parses a displayed date back to a date key."""
+        return to_date_key(datetime.strptime(text, self.db_date_format))
+
+    def fmt_user(self, user_id: int) -> str:
+        """ Resolves a user ID to its username for display."""
+        return self.fmt_users([user_id])[0]
+
+    def fmt_users(self, user_ids) -> list[str]:
+        """ Resolves user IDs to usernames for display, unknown IDs are loaded together."""
+        missing = {x for x in user_ids if x not in self._usernames}
+        if missing:
+            self._usernames.update(self.load_usernames(missing))
+        return [self._usernames.get(x) for x in user_ids]
+
     # region Typing Methods
     # - Names must match corresponding class
     # - Args must match ordered column names from corresponding DB table
-    def follow(self, id, username, acc_id, date, follower, following):
+    def follow(self, id, user_id, acc_id, date, follower, following, import_id=None):
         """ Create a follow from data."""
-        return follow(id, username, acc_id, date, follower, following, self.db_date_format)
+        return follow(id, user_id, acc_id, date, follower, following, import_id)
 
-    def last_follow(self, username, acc_id, last_following_id, last_follower_id):
+    def last_follow(self, user_id, acc_id, last_following_id, last_follower_id):
         """ Create a last follow from data."""
-        return last_follow(username, acc_id, last_following_id, last_follower_id)
+        return last_follow(user_id, acc_id, last_following_id, last_follower_id)
+
+    def ig_user(self, id, username):
+        """ Create an ig_user from data."""
+        return ig_user(id, username)
 
     def ig_account(self, id, username, abbrv, last_update):
         """ Create an ig_account from data."""
-        return ig_account(id, username, abbrv, last_update, self.db_date_format)
+        return ig_account(id, username, abbrv, last_update)
 
     def preference(self, id, default_acc_id, progress_dir, data_dir, ig_url):
         """ Create a preference from data."""
         return preference(id, default_acc_id, progress_dir, data_dir, ig_url)
+
+    def follow_summary(self, acc_id, date, follower, following, dfb, idfb, gained, lost):
+        """ Create a follow summary from data."""
+        return follow_summary(acc_id, date, follower, following, dfb, idfb, gained, lost)
+
+    def follow_bitmap(self, acc_id, date, kind, bits):
+        """ Create a follow bitmap from data."""
+        return follow_bitmap(acc_id, date, kind, bits)
+
+    def fc_import(self, id, acc_id, date, source_hash, source_hashes, follow_count, last_follow_count, delta=False):
+        """ Create an import ledger entry from data."""
+        if isinstance(source_hashes, str):
+            source_hashes = json.loads(source_hashes)
+        return fc_import(id, acc_id, date, source_hash, source_hashes, follow_count, last_follow_count, delta)
     # endregion
 
 
 if __name__ == "__main__":
-    d8 = datetime.today().strftime("%b%D_%Y")
-    lf = last_follow("Babar", 56, 21, 21)
+    d8 = to_date_key(datetime.today())
+    lf = last_follow(7, 56, 21, 21)
     iga = ig_account(56, "Barbossa", "BRBSA", d8)
-    f = follow(21, "Babar", 56, datetime.today().strftime("%b%D_%Y"), 1, 1, d8, "%b%D_%Y")
+    igu = ig_user(7, "Babar")
+    f = follow(21, 7, 56, d8, 1, 1)
 
-    testArray = [lf, iga, f]
+    testArray = [lf, iga, igu, f]
 
     for db_o in testArray:
         t_obj = type(db_o)
@@ -0,0 +1,268 @@
+"""
+FC_ExportParser
+
+Incremental parsing of Instagram follower/following json exports
+"""
+from datetime import datetime
+import hashlib
+import io
+import json
+from os import listdir, walk
+from os.path import basename, isdir, join, splitext
+import re
+import zipfile
+
+
+# Number of characters read from an export per block
+BLOCK_SIZE = 1 << 16
+
+# File names of follower/following parts in an Instagram "Download your information" export
+FOLLOWER_PART = re.compile(r"followers(_\d+)?\.json")
+FOLLOWING_PART = re.compile(r"following(_\d+)?\.json")
+
+# Numeric dates in file names (20240530, 2024-05-30, 2024_05_30)
+NUMERIC_DATE = re.compile(r"(?<!\d)(\d{4})[-_]?(\d{2})[-_]?(\d{2})(?!\d)")
+
+
+def iter_export_entries(path, block_size=BLOCK_SIZE):
+    """
+    Yields each entry of an export without loading the whole file.
+    Handles exports that are a list of entries, or an object whose first value is the list of entries.
+
+    Args:
+        path (str): Path to the export json
+        block_size (int): Characters read per block
+
+    Returns:
+        Iterator[dict]: Export entries in file order
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        yield from _iter_stream_entries(f, block_size)
+
+
+def _iter_stream_entries(f, block_size):
+    # Yields each entry from a text stream holding an export
+    decoder = json.JSONDecoder()
+    buf = f.read(block_size)
+
+    # Find the opening bracket of the entry list
+    pos = buf.find("[")
+    while pos == -1:
+        block = f.read(block_size)
+        if not block:
+            return
+        buf += block
+        pos = buf.find("[")
+    pos += 1
+
+    while True:
+        # Skip separators between entries
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+
+        try:
+            entry, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Entry is split across blocks, drop what was consumed and read more
+            block = f.read(block_size)
+            if not block:
+                raise
+            buf = buf[pos:] + block
+            pos = 0
+            continue
+
+        yield entry
+        pos = end
+
+
+def get_username(entry) -> str:
+    """
+    Gets the username from an export entry.
+    Flat entries have a "username" field, Instagram data downloads nest it in string_list_data (or the title in newer exports).
+    """
+    if "username" in entry:
+        return entry["username"]
+    for data in entry.get("string_list_data", []):
+        if data.get("value"):
+            return data["value"]
+    return entry["title"]
+
+
+# region Multi-part Exports
+# A part source is a (zip path, member name) pair, zip path is None for parts on disk
+def find_export_parts(export_path):
+    """
+    Finds the follower and following parts of an export directory or zip.
+
+    Args:
+        export_path (str): Export directory or zip file
+
+    Returns:
+        tuple[list, list]: (follower part sources, following part sources), each sorted by name
+    """
+    if isdir(export_path):
+        names = [(None, join(root, f)) for root, _, files in walk(export_path) for f in files]
+    else:
+        with zipfile.ZipFile(export_path) as z:
+            names = [(export_path, n) for n in z.namelist()]
+    flwr = sorted(x for x in names if FOLLOWER_PART.fullmatch(basename(x[1])))
+    flwg = sorted(x for x in names if FOLLOWING_PART.fullmatch(basename(x[1])))
+    return flwr, flwg
+
+
+def parse_part(source) -> list[str]:
+    """ Gets every username in an export part, safe to run in a worker process."""
+    zip_path, name = source
+    if zip_path is None:
+        return [get_username(x) for x in iter_export_entries(name)]
+    with zipfile.ZipFile(zip_path) as z, z.open(name) as raw:
+        f = io.TextIOWrapper(raw, encoding="utf-8-sig")
+        return [get_username(x) for x in _iter_stream_entries(f, BLOCK_SIZE)]
+# endregion
+
+
+# region Dated Exports
+def parse_date_key(text, date_format):
+    """
+    Finds a date in a file name and returns it as a date key, or None if there is none.
+    Numeric dates (20240530, 2024-05-30) are tried first, then runs of "_" separated words in date_format (e.g. May30_2024).
+    """
+    value = None
+    match = NUMERIC_DATE.search(text)
+    if match:
+        try:
+            value = datetime(*(int(x) for x in match.groups()))
+        except ValueError:
+            pass
+
+    words = re.split(r"[_\-. ]", text)
+    for size in range(1, 4):
+        for i in range(len(words) - size + 1):
+            if value:
+                break
+            try:
+                value = datetime.strptime("_".join(words[i:i + size]), date_format)
+            except ValueError:
+                continue
+    return value.year * 10000 + value.month * 100 + value.day if value else None
+
+
+def get_export_kind(name) -> str:
+    """ Gets "follower" or "following" from an export file name (or its Flwr/Flwg abbreviation), or None if it is neither."""
+    name = basename(name).lower()
+    if not name.endswith(".json"):
+        return None
+    if "following" in name or "flwg" in name:
+        return "following"
+    if "follower" in name or "flwr" in name:
+        return "follower"
+    return None
+
+
+def find_dated_exports(path, date_format, names=None):
+    """
+    Finds the dated exports in a directory.
+    An export is a follower/following json pair with the same date in their names, or an Instagram export directory/zip with a date in its name.
+
+    Args:
+        path (str): Directory holding the exports
+        date_format (str): strptime format of dates in names, besides numeric dates (see parse_date_key)
+        names (list[str]): Only look at these entries of the directory, defaults to all of them
+
+    Returns:
+        tuple[list, list]: ([(date key, source)] sorted by date, names that were skipped),
+                           a source is a (follower json, following json) pair or an export directory/zip path
+    """
+    exports = []
+    pairs = {}
+    skipped = []
+    for name in sorted(listdir(path) if names is None else names):
+        full = join(path, name)
+        date = parse_date_key(splitext(name)[0], date_format)
+        kind = get_export_kind(name)
+        if date is None:
+            skipped.append(name)
+        elif isdir(full) or name.lower().endswith(".zip"):
+            exports.append((date, full))
+        elif kind:
+            pair = pairs.setdefault(date, {})
+            if kind in pair:
+                # Two files for one side of a snapshot, keep the first
+                skipped.append(name)
+            else:
+                pair[kind] = full
+        else:
+            skipped.append(name)
+
+    for date, pair in pairs.items():
+        if len(pair) == 2:
+            exports.append((date, (pair["follower"], pair["following"])))
+        else:
+            skipped += [basename(x) for x in pair.values()]
+    return sorted(exports, key=lambda x: x[0]), skipped
+
+
+def parse_snapshot(source):
+    """
+    Parses and hashes a whole snapshot, safe to run in a worker process.
+
+    Args:
+        source: (follower json, following json) pair, or an export directory/zip
+
+    Returns:
+        tuple[list, list]: ([(username, follower, following)] for every user, sha256 of each source file
+                           in the order dbAccessor.munch_follow_data/munch_export hash them)
+    """
+    flwr_parts, flwg_parts = _get_snapshot_parts(source)
+    flwr = {u for part in flwr_parts for u in parse_part(part)}
+    flwg = {u for part in flwg_parts for u in parse_part(part)}
+    users = [(u, u in flwr, u in flwg) for u in flwr | flwg]
+    return users, [hash_source(x) for x in flwr_parts + flwg_parts]
+
+
+def get_source_hashes(source) -> list[str]:
+    """ Gets the sha256 of each file of a snapshot without parsing it, the same hashes parse_snapshot returns."""
+    flwr_parts, flwg_parts = _get_snapshot_parts(source)
+    return [hash_source(x) for x in flwr_parts + flwg_parts]
+
+
+def _get_snapshot_parts(source):
+    # Get the (follower parts, following parts) of a snapshot source
+    if isinstance(source, tuple):
+        return [(None, source[0])], [(None, source[1])]
+    flwr_parts, flwg_parts = find_export_parts(source)
+    if not flwr_parts and not flwg_parts:
+        raise ValueError(f"No follower or following files were found in {source}")
+    return flwr_parts, flwg_parts
+# endregion
+
+
+def iter_chunks(items, size):
+    """ Yields lists of up to size items from an iterable."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def hash_source(source) -> str:
+    """ Gets the sha256 of a source file or export part without parsing it."""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        source = (None, source)
+    zip_path, name = source
+    if zip_path is None:
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+    else:
+        with zipfile.ZipFile(zip_path) as z, z.open(name) as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+    return digest.hexdigest()
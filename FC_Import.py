@@ -0,0 +1,166 @@
+"""
+FC_Import
+
+Batch import scheduling, snapshots are parsed in a process pool and written through a single connection
+"""
+import os
+import time
+import FC_ExportParser as ep
+
+
+def _parse_job(source):
+    # Parse a snapshot in a worker process, returns (users, source hashes, seconds spent)
+    start = time.perf_counter()
+    users, source_hashes = ep.parse_snapshot(source)
+    return users, source_hashes, time.perf_counter() - start
+
+
+class import_job():
+    """
+    One snapshot to import for an account.
+    Carries its progress (status, rows, timings) while an import_scheduler runs it.
+    """
+    # Job states in order, a job ends as done, skipped (duplicate files, an already imported date or an out of order delta) or failed
+    STATES = ("queued", "parsing", "parsed", "writing", "done", "skipped", "failed")
+
+    def __init__(self,
+                 acc_id: int,
+                 date: int,
+                 source,
+                 delta: bool = False):
+        self.acc_id = acc_id
+        self.date = date
+        # (follower json, following json) pair, or an export directory/zip
+        self.source = source
+        self.delta = delta
+
+        self.status = "queued"
+        self.import_id = None
+        self.rows = 0
+        self.error = None
+        # Seconds spent parsing (in a worker process) and writing
+        self.parse_time = 0.0
+        self.write_time = 0.0
+        # Stage report of the write (see dbAccessor.last_import_report), None until the job was written
+        self.report = None
+
+    def is_finished(self) -> bool:
+        """ Checks if the job is done, skipped or failed."""
+        return self.status in ("done", "skipped", "failed")
+
+
+class import_scheduler():
+    """
+    Imports a batch of snapshots across many accounts.
+    Snapshots are parsed in a process pool while the calling thread is the only writer, so SQLite never sees competing writers.
+    Snapshots whose files are already in the import ledger are skipped without being parsed.
+    Each account's snapshots are written in date order, snapshots of different accounts are written as soon as they are parsed.
+    """
+
+    def __init__(self,
+                 dba,
+                 workers: int = None,
+                 on_progress=None):
+        # dbAccessor all writes go through
+        self.dba = dba
+        # Parser processes, 1 parses on the calling thread
+        self.workers = workers or os.cpu_count() or 1
+        # on_progress(job) is called on the calling thread every time a job changes state
+        self.on_progress = on_progress
+
+    def run(self, jobs: list[import_job]) -> list[import_job]:
+        """
+        Parse and write every job, returns the jobs with their final state.
+        At most 2 parsed snapshots per worker are held at once, so memory doesn't grow with the batch.
+        """
+        for job in jobs:
+            self._skip_imported(job)
+        todo = [job for job in jobs if not job.is_finished()]
+
+        # Parsed in date order, so every account's next snapshot is always parsed before its later ones
+        order = sorted(todo, key=lambda j: (j.date, j.acc_id))
+        self._pending = {}
+        for job in sorted(todo, key=lambda j: (j.acc_id, j.date)):
+            self._pending.setdefault(job.acc_id, []).append(job)
+        self._parsed = {}
+
+        if self.workers == 1:
+            for job in order:
+                self._set_status(job, "parsing")
+                try:
+                    self._parsed[job] = _parse_job(job.source)
+                    self._set_status(job, "parsed")
+                except Exception as e:
+                    self._fail(job, e)
+                self._write_ready(job.acc_id)
+            return jobs
+
+        # Imported here, the process pool machinery is slow to import and read-only CLI commands never use it
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+        window = self.workers * 2
+        queued = iter(order)
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                for job in queued:
+                    self._set_status(job, "parsing")
+                    in_flight[pool.submit(_parse_job, job.source)] = job
+                    if len(in_flight) + len(self._parsed) >= window:
+                        break
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = in_flight.pop(future)
+                    try:
+                        self._parsed[job] = future.result()
+                        self._set_status(job, "parsed")
+                    except Exception as e:
+                        self._fail(job, e)
+                    self._write_ready(job.acc_id)
+        return jobs
+
+    def _skip_imported(self, job):
+        # Skip a job whose account already has an import for its date or whose source files were already imported, only hashing them
+        try:
+            if self.dba.get_import_by_date(job.acc_id, job.date) or self.dba.find_import(job.acc_id, ep.get_source_hashes(job.source)):
+                self._set_status(job, "skipped")
+        except Exception as e:
+            self._fail(job, e)
+
+    def _write_ready(self, acc_id):
+        # Write the account's parsed snapshots that are next in date order
+        pending = self._pending[acc_id]
+        while pending and (pending[0] in self._parsed or pending[0].is_finished()):
+            job = pending.pop(0)
+            if job.is_finished():
+                continue
+            users, source_hashes, job.parse_time = self._parsed.pop(job)
+
+            self._set_status(job, "writing")
+            start = time.perf_counter()
+            try:
+                job.import_id = self.dba.munch_users(users, source_hashes, job.acc_id, job.date, job.delta, job.parse_time)
+            except Exception as e:
+                job.report = self.dba.last_import_report
+                self._fail(job, e)
+                continue
+            job.write_time = time.perf_counter() - start
+            job.report = self.dba.last_import_report
+            if job.import_id:
+                job.rows = self.dba.get_import(job.import_id).follow_count
+                self._set_status(job, "done")
+            else:
+                self._set_status(job, "skipped")
+
+    def _fail(self, job, e):
+        # Mark a job as failed, later snapshots of the account are still written
+        job.error = str(e)
+        self._set_status(job, "failed")
+
+    def _set_status(self, job, status):
+        # Move a job to a new state and report it
+        job.status = status
+        if self.on_progress:
+            self.on_progress(job)
@@ -0,0 +1,272 @@
+"""
+FC_ImportProfile
+
+Per-stage timing and memory reports for imports, with optional cProfile/tracemalloc capture
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+from os.path import basename, join
+import sys
+from time import perf_counter
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, reports leave out RSS there
+    resource = None
+
+
+# Environment variable switching on capture without editing code: "cprofile", "tracemalloc", "all" or a comma separated list
+ENV_CAPTURE = "FC_IMPORT_PROFILE"
+
+# Captures an import_profile can take besides its stage timings
+CAPTURES = ("cprofile", "tracemalloc")
+
+# Functions / allocation sites kept in a report's capture section
+CAPTURE_TOP = 15
+
+
+def get_captures(capture=None) -> set:
+    """ Parse a capture setting ("cprofile", "tracemalloc", "all", comma separated or a list), None reads FC_IMPORT_PROFILE."""
+    if capture is None:
+        capture = os.environ.get(ENV_CAPTURE, "")
+    if isinstance(capture, str):
+        capture = capture.split(",")
+    captures = {x.strip().lower() for x in capture if x and x.strip()}
+    if "all" in captures:
+        return set(CAPTURES)
+    for x in captures - set(CAPTURES):
+        print(f"Unknown import profile capture \"{x}\", expected one of {', '.join(CAPTURES)} or all", file=sys.stderr)
+    return captures & set(CAPTURES)
+
+
+def get_peak_rss_kb() -> int:
+    """ Gets the process' peak resident set size in KB, or None where it isn't available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB everywhere else
+    return peak // 1024 if os.uname().sysname == "Darwin" else peak
+
+
+class import_profile():
+    """
+    Stage report of one import.
+    Each stage records its wall time, the growth of the process' peak RSS while it ran and the items it handled.
+    Stages can nest and be entered many times (e.g. parsing interleaved with staging), a stage's ms excludes time spent in nested stages.
+    Optionally captures a cProfile of the whole import (dumped to a .prof file) and tracemalloc peaks per stage.
+    """
+
+    def __init__(self,
+                 entry: str,
+                 acc_id: int,
+                 date: int,
+                 log_path: str = None,
+                 capture=None,
+                 capture_dir: str = None):
+        # Import method the report is for, e.g. munch_follow_data
+        self.entry = entry
+        self.acc_id = acc_id
+        self.date = date
+        # json lines file every finished report is appended to, None to only return it
+        self.log_path = log_path
+        # Captures to take (see get_captures), .prof files go to capture_dir
+        self.captures = get_captures(capture)
+        self.capture_dir = capture_dir or "."
+
+        # Stage name -> stage record, in the order stages were first entered
+        self.stages = {}
+        # Records of the stages currently running, innermost last
+        self._stack = []
+        # Set by the import as it goes, a profile finished without them reports a failed import
+        self.import_id = None
+        self.status = "failed"
+        self.report = None
+        self._profiler = None
+        self._traced = False
+        # Highest traced memory seen, stages reset tracemalloc's own peak
+        self._traced_peak = 0
+
+    # region Capture
+    def start(self):
+        """ Start the import's clock and any captures, returns the profile."""
+        self.started = datetime.now()
+        self._start = perf_counter()
+        self._rss = get_peak_rss_kb()
+        if "tracemalloc" in self.captures:
+            import tracemalloc
+            # Left running afterwards if the caller was already tracing
+            self._traced = not tracemalloc.is_tracing()
+            if self._traced:
+                tracemalloc.start()
+        if "cprofile" in self.captures:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def _finish_cprofile(self) -> dict:
+        # Stop the profiler, dump it next to the log and summarize the functions with the most cumulative time
+        import pstats
+        self._profiler.disable()
+        stats = pstats.Stats(self._profiler)
+        path = join(self.capture_dir, f"import_{self.acc_id}_{self.date}_{self.started:%Y%m%d%H%M%S}_{self.import_id or 'none'}.prof")
+        try:
+            os.makedirs(self.capture_dir, exist_ok=True)
+            stats.dump_stats(path)
+        except OSError as e:
+            print(f"Couldn't save the import profile to {path}: {e}", file=sys.stderr)
+            path = None
+        top = sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)[:CAPTURE_TOP]
+        return {"file": path,
+                "top": [{"function": f"{basename(f)}:{line} {name}", "calls": nc, "tottime_ms": round(tt * 1000, 3), "cumtime_ms": round(ct * 1000, 3)}
+                        for (f, line, name), (cc, nc, tt, ct, callers) in top]}
+
+    def _finish_tracemalloc(self) -> dict:
+        # Summarize the allocation sites still holding memory and the traced peak, stops tracing if start() began it
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, self._traced_peak)
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        if self._traced:
+            tracemalloc.stop()
+        return {"current_kb": current // 1024, "peak_kb": peak // 1024,
+                "top": [{"site": f"{basename(x.traceback[0].filename)}:{x.traceback[0].lineno}", "size_kb": x.size // 1024, "count": x.count}
+                        for x in snapshot.statistics("lineno")[:CAPTURE_TOP]]}
+    # endregion
+
+    # region Stages
+    def _enter(self, name) -> dict:
+        # Push a stage record, creating it the first time the stage is entered
+        now = perf_counter()
+        stage = self.stages.setdefault(name, {"stage": name, "ms": 0.0, "wall_ms": 0.0, "runs": 0, "items": 0, "rss_peak_delta_kb": None})
+        stage["runs"] += 1
+        stage["_start"] = now
+        stage["_child"] = 0.0
+        stage["_rss"] = get_peak_rss_kb()
+        if "tracemalloc" in self.captures:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                # Fold the running peak into the enclosing stage before resetting it for this one
+                self._fold_traced_peak(self._stack[-1] if self._stack else None)
+                stage["_traced"] = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+        self._stack.append(stage)
+        return stage
+
+    def _exit(self, stage):
+        # Pop a stage record and add its times to it (and its wall time to the enclosing stage's nested time)
+        elapsed = perf_counter() - stage["_start"]
+        self._stack.pop()
+        stage["wall_ms"] += elapsed * 1000
+        stage["ms"] += (elapsed - stage["_child"]) * 1000
+        rss = get_peak_rss_kb()
+        if rss is not None:
+            stage["rss_peak_delta_kb"] = (stage["rss_peak_delta_kb"] or 0) + rss - stage["_rss"]
+        if "_traced" in stage:
+            self._fold_traced_peak(stage)
+        if self._stack:
+            parent = self._stack[-1]
+            parent["_child"] += elapsed
+            if "traced_peak_kb" in stage and "_traced" in parent:
+                parent["traced_peak_kb"] = max(parent.get("traced_peak_kb", 0), stage["traced_peak_kb"] + (stage["_traced"] - parent["_traced"]) // 1024)
+
+    def _fold_traced_peak(self, stage):
+        # Record the traced peak above the memory traced when the stage was entered, and the import's overall peak
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        self._traced_peak = max(self._traced_peak, peak)
+        if stage is not None:
+            stage["traced_peak_kb"] = max(stage.get("traced_peak_kb", 0), (peak - stage["_traced"]) // 1024)
+
+    @contextmanager
+    def stage(self, name: str, items: int = None, counter=None):
+        """
+        Time a stage of the import, yields the stage record so the stage can add to its "items".
+
+        Args:
+            name (str): Stage name, entering a stage again adds to its record
+            items (int): Items the stage handles
+            counter (callable): Called before and after the stage, the difference is added to items (e.g. rows changed)
+        """
+        stage = self._enter(name)
+        before = counter() if counter else 0
+        try:
+            yield stage
+        finally:
+            stage["items"] += (items or 0) + (counter() - before if counter else 0)
+            self._exit(stage)
+
+    def timed_iter(self, name: str, iterable, count=None):
+        """
+        Yield from an iterable, the time spent producing each value is added to a stage.
+        count(value) is added to the stage's items for each value, e.g. the users in a chunk.
+        """
+        iterator = iter(iterable)
+        while True:
+            stage = self._enter(name)
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit(stage)
+            stage["items"] += count(value) if count else 1
+            yield value
+
+    def add_stage(self, name: str, seconds: float, items: int = 0):
+        """ Add a stage that ran before the profile started or outside this process, e.g. parsing in a worker process."""
+        stage = self.stages.setdefault(name, {"stage": name, "ms": 0.0, "wall_ms": 0.0, "runs": 0, "items": 0, "rss_peak_delta_kb": None})
+        stage["runs"] += 1
+        stage["ms"] += seconds * 1000
+        stage["wall_ms"] += seconds * 1000
+        stage["items"] += items
+    # endregion
+
+    def finish(self) -> dict:
+        """
+        Stop the captures and build the report, which is also appended to the log file.
+        import_id and status ("done", "skipped" or "failed") are reported as the import left them.
+
+        Returns:
+            dict: entry, acc_id, date, import_id, status, started, wall_ms, rss_peak_kb, rss_peak_delta_kb,
+                  stages ([{stage, ms, wall_ms, runs, items, rss_peak_delta_kb[, traced_peak_kb]}] in the order they ran)
+                  and a cprofile/tracemalloc section for each capture taken
+        """
+        wall_ms = (perf_counter() - self._start) * 1000
+        rss = get_peak_rss_kb()
+        self.report = {"entry": self.entry, "acc_id": self.acc_id, "date": self.date, "import_id": self.import_id, "status": self.status,
+                       "started": self.started.isoformat(timespec="milliseconds"), "wall_ms": round(wall_ms, 3),
+                       "rss_peak_kb": rss, "rss_peak_delta_kb": rss - self._rss if rss is not None else None,
+                       "stages": [{k: round(v, 3) if isinstance(v, float) else v for k, v in x.items() if not k.startswith("_")}
+                                  for x in self.stages.values()]}
+        if self._profiler:
+            self.report["cprofile"] = self._finish_cprofile()
+        if "tracemalloc" in self.captures:
+            self.report["tracemalloc"] = self._finish_tracemalloc()
+
+        if self.log_path:
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(self.report) + "\n")
+            except OSError as e:
+                print(f"Couldn't append the import report to {self.log_path}: {e}", file=sys.stderr)
+        return self.report
+
+
+def format_report(report: dict) -> str:
+    """ Format an import report as a text table, one line per stage."""
+    traced = f"{'traced KB':>11}" if "tracemalloc" in report else ""
+    lines = [f"{report['entry']} account {report['acc_id']} {report['date']}: {report['status']}, import {report['import_id']}, "
+             f"{report['wall_ms']:,.1f} ms, peak RSS +{report['rss_peak_delta_kb'] or 0:,} KB",
+             f"  {'stage':<16} {'ms':>10} {'runs':>6} {'items':>10} {'RSS +KB':>9}{traced}"]
+    for x in report["stages"]:
+        traced = f"{x['traced_peak_kb']:>11,}" if "traced_peak_kb" in x else ""
+        lines.append(f"  {x['stage']:<16} {x['ms']:>10,.1f} {x['runs']:>6} {x['items']:>10,} {x['rss_peak_delta_kb'] or 0:>9,}{traced}")
+    if "cprofile" in report:
+        lines.append(f"  cProfile: {report['cprofile']['file']}")
+        lines += [f"    {x['cumtime_ms']:>10,.1f} ms cumulative {x['calls']:>9,} calls  {x['function']}" for x in report["cprofile"]["top"][:5]]
+    if "tracemalloc" in report:
+        lines.append(f"  tracemalloc peak {report['tracemalloc']['peak_kb']:,} KB")
+    return "\n".join(lines)
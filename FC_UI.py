@@ -1,8 +1,13 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import customtkinter as ctk
 import os
+import queue
 from PIL import Image
 from datetime import datetime
+import FC_DataClasses as dc
 from FC_DBAccess import dbAccessor
+from FC_Watch import export_watcher
 
 
 class fc_app(ctk.CTk):
@@ -10,6 +15,9 @@ class fc_app(ctk.CTk):
     FC View class.
     Contains all UI logic for FC
     """
+    # Milliseconds between checks for import progress from the watcher, and progress lines kept for the import tab
+    IMPORT_POLL_MS = 250
+    IMPORT_LINES = 200
 
     def __init__(self, 
                  dba: dbAccessor,
@@ -71,53 +79,96 @@ class fc_app(ctk.CTk):
                                                       command=self._chg_ddl_theme)
         self.appearance_mode_menu.grid(row=6, column=0, padx=20, pady=20, sticky="s")
 
-        # Make Frames
-        self.crawler_frame = self._mk_f_crawler()
-        self.import_frame = self._mk_f_import()
-        self.settings_frame = self._mk_f_settings()
+        # DB reads run on a worker thread, frames are made the first time they are shown
+        self.loader = bg_loader(self)
+        self._frames = {}
+        self._frame_makers = {"crawler": self._mk_f_crawler,
+                              "import": self._mk_f_import,
+                              "settings": self._mk_f_settings}
         self._get_f_by_name("crawler")
 
+        # Exports dropped into the data directory are imported in the background, progress lines are handed to the main thread
+        self._import_feed = queue.SimpleQueue()
+        self._import_lines = deque(maxlen=self.IMPORT_LINES)
+        self._import_log = None
+        self.watcher = export_watcher(dba, on_progress=lambda job: self._import_feed.put(self._fmt_import(job)))
+        if os.path.isdir(self.watcher.path):
+            self.watcher.start()
+            self.after(self.IMPORT_POLL_MS, self._poll_imports)
+
+    def destroy(self):
+        # Drop pending loads and stop watching before the window goes away, an import that is being written finishes on its own
+        self.loader.shutdown()
+        self.watcher.stop(wait=False)
+        super().destroy()
+
+    def _fmt_import(self, job):
+        # Describe an import job's new state for the import tab, runs on the watcher's thread
+        acc = self.dba.get_ig_account_by_id(job.acc_id)
+        line = f"{datetime.now():%H:%M:%S}  {acc.username if acc else job.acc_id}  {self.dba.obj_f.fmt_date(job.date)}  {job.status}"
+        if job.status == "done":
+            line += f", {job.rows:,} rows in {job.parse_time + job.write_time:.1f} s"
+        elif job.error:
+            line += f" ({job.error})"
+        return line
+
+    def _poll_imports(self):
+        # Show the watcher's progress lines in the import tab, keeps polling while the watcher runs
+        while not self._import_feed.empty():
+            line = self._import_feed.get()
+            self._import_lines.append(line)
+            if self._import_log:
+                self._import_log.configure(state="normal")
+                self._import_log.insert("end", line + "\n")
+                self._import_log.see("end")
+                self._import_log.configure(state="disabled")
+        if self.watcher.is_running():
+            self.after(self.IMPORT_POLL_MS, self._poll_imports)
+
     def _mk_f_crawler(self):
         # Make the CTk frame for the crawler tab
-        frame = ctk.CTkScrollableFrame(self, corner_radius=0, fg_color="transparent")
+        frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         frame.grid_columnconfigure(0, weight=1)
         ctk.CTkLabel(frame, text="CRAWLER").pack()
         self.crawler_tabview = ctk.CTkTabview(frame)
+        self.crawler_tabview.pack(fill="both", expand=True)
         f_flwr = self.crawler_tabview.add("Follwers")
         f_flwg = self.crawler_tabview.add("Following")
         f_dfb = self.crawler_tabview.add("DFB")
         f_idfb = self.crawler_tabview.add("IDFB")
 
-        # Get follower data
+        # Each tab pages its view of the account's current relationships from the DB as it scrolls
         selectedAcc = self.dba.get_active_ig_account()
-        follows = self.dba.get_newest_follows_by_acc(selectedAcc)
-        if len(follows) > 0:
-            headings = []
-            dfb = [f for f in follows if f.dfb()][0:100]
-            idfb = [f for f in follows if f.idfb()][0:100]
-            flwr = [f for f in follows if f.follower][0:100]
-            flwg = [f for f in follows if f.following][0:100]
-        else:
-            headings = ["Username", "Account Id", "Date", "Follower", "Following"]
-            dfb = idfb = flwr = flwg = []
-        # keys = dc.follow.
-        #for (dataview, frame) in [(flwr, f_flwr), (flwg, f_flwg), (dfb, f_dfb), (idfb, f_idfb)]:
-            #if dataview:
-                #self._mk_table(headings, dataview, [])
-            #else:
-                #self._mk_table(headings, [], [])
+        for (view, tab) in [("follower", f_flwr), ("following", f_flwg), ("dfb", f_dfb), ("idfb", f_idfb)]:
+            rows = dc.paged_rows(lambda after, limit, sort, descending, offset, view=view:
+                                 self.dba.get_relation_page(selectedAcc, view, after, limit, sort, descending, offset),
+                                 lambda view=view: self.dba.get_relation_count(selectedAcc, view),
+                                 sort="username")
+            self._mk_table(tab, ["Username", "Since"], rows, ["username", "since"], [str, self.dba.obj_f.fmt_date])
 
         return frame
 
-    def _mk_table(self, headings, data, ordered_keys):
-        # Make a table for displaying data
-        # for i in range(len(headings))
-        return None
+    def _mk_table(self, master, headings, rows, sort_keys, formatters):
+        # Make a virtual table for displaying paged rows
+        table = virtual_table(master, headings, rows, sort_keys, self.loader, formatters, fg_color="transparent")
+        table.pack(fill="both", expand=True)
+        return table
 
     def _mk_f_import(self):
         # Make the frame for the import tab
         frame = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         ctk.CTkLabel(frame, text="IMPORT").pack()
+        if self.watcher.is_running():
+            status = f"Exports dropped into {os.path.abspath(self.watcher.path)} are imported automatically"
+        else:
+            status = f"{self.watcher.path} doesn't exist, create it to import exports dropped into it"
+        ctk.CTkLabel(frame, text=status).pack()
+
+        # Progress of the watcher's imports, lines from before the tab was first shown included
+        self._import_log = ctk.CTkTextbox(frame)
+        self._import_log.pack(fill="both", expand=True)
+        self._import_log.insert("end", "".join(x + "\n" for x in self._import_lines))
+        self._import_log.configure(state="disabled")
         return frame
 
     def _mk_f_settings(self):
@@ -134,19 +185,14 @@ class fc_app(ctk.CTk):
         self.import_button.configure(fg_color=("gray75", "gray25") if name == "import" else "transparent")
         self.settings_button.configure(fg_color=("gray75", "gray25") if name == "settings" else "transparent")
 
-        # show selected frame
-        if name == "crawler":
-            self.crawler_frame.grid(row=0, column=1, sticky="nsew")
-        else:
-            self.crawler_frame.grid_forget()
-        if name == "import":
-            self.import_frame.grid(row=0, column=1, sticky="nsew")
-        else:
-            self.import_frame.grid_forget()
-        if name == "settings":
-            self.settings_frame.grid(row=0, column=1, sticky="nsew")
-        else:
-            self.settings_frame.grid_forget()
+        # make the frame on first navigation, then show it and hide the others
+        if name not in self._frames:
+            self._frames[name] = self._frame_makers[name]()
+        for (frame_name, frame) in self._frames.items():
+            if frame_name == name:
+                frame.grid(row=0, column=1, sticky="nsew")
+            else:
+                frame.grid_forget()
 
     def _clk_btn_crawler(self):
         self._get_f_by_name("crawler")
@@ -161,6 +207,189 @@ class fc_app(ctk.CTk):
         ctk.set_appearance_mode(new_appearance_mode)
 
 
+class bg_loader():
+    """
+    Runs DB reads on a worker thread and hands their results back on the Tk main thread.
+    Jobs are keyed: submitting a job cancels the key's pending one, and results of cancelled or replaced jobs are dropped.
+    """
+    # Milliseconds between checks for finished jobs while any are pending
+    POLL_MS = 15
+
+    def __init__(self, root):
+        self.root = root
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fc-load")
+        # Pending job future per key, and finished (key, future, on_done) waiting for the main thread
+        self._jobs = {}
+        self._done = queue.SimpleQueue()
+        self._polling = False
+
+    def submit(self, key, fn, on_done):
+        """ Run fn() on the worker, on_done(result) is called on the main thread unless the job is cancelled first."""
+        self.cancel(key)
+        future = self._pool.submit(fn)
+        self._jobs[key] = future
+        future.add_done_callback(lambda f: self._done.put((key, f, on_done)))
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.POLL_MS, self._poll)
+
+    def cancel(self, key):
+        """ Cancel a key's pending job, a job that already started runs to the end but its result is dropped."""
+        future = self._jobs.pop(key, None)
+        if future:
+            future.cancel()
+
+    def is_loading(self, key) -> bool:
+        """ Checks if a key has a pending job."""
+        return key in self._jobs
+
+    def shutdown(self):
+        """ Cancel every pending job and stop the worker."""
+        for key in list(self._jobs):
+            self.cancel(key)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        # Hand finished jobs to their callbacks, keep polling while jobs are pending
+        while not self._done.empty():
+            key, future, on_done = self._done.get()
+            if self._jobs.get(key) is not future:
+                continue
+            del self._jobs[key]
+            if future.exception():
+                print(f"Background load failed: {future.exception()}")
+            else:
+                on_done(future.result())
+        self._polling = bool(self._jobs)
+        if self._polling:
+            self.root.after(self.POLL_MS, self._poll)
+
+
+class virtual_table(ctk.CTkFrame):
+    """
+    Virtual scrolling table.
+    Only the visible rows are widgets, their text is swapped as the table scrolls and rows are read from a dc.paged_rows window.
+    Rows that aren't held yet are loaded on a bg_loader while the table shows a loading label.
+    Clicking a heading sorts by that column, clicking it again reverses the sort.
+    """
+    # Height of a row in pixels
+    ROW_HEIGHT = 26
+
+    def __init__(self,
+                 master,
+                 headings: list[str],
+                 rows: dc.paged_rows,
+                 sort_keys: list[str],
+                 loader: bg_loader,
+                 formatters: list = None,
+                 **kwargs):
+        super().__init__(master, **kwargs)
+        self.headings = headings
+        self.rows = rows
+        self.sort_keys = sort_keys
+        self.loader = loader
+        self.formatters = formatters or [str] * len(headings)
+
+        # Position of the first visible row, and the label widgets of each visible row
+        self._pos = 0
+        self._cells = []
+
+        self.grid_rowconfigure(1, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        # Headings
+        self._header = ctk.CTkFrame(self, fg_color="transparent")
+        self._header.grid(row=0, column=0, sticky="ew")
+        self._heading_buttons = []
+        for i, heading in enumerate(headings):
+            self._header.grid_columnconfigure(i, weight=1, uniform="col")
+            button = ctk.CTkButton(self._header, text=heading, corner_radius=0, command=lambda i=i: self._clk_heading(i))
+            button.grid(row=0, column=i, sticky="ew")
+            self._heading_buttons.append(button)
+
+        # Body, the row labels are made to fill its height
+        self._body = ctk.CTkFrame(self, fg_color="transparent")
+        self._body.grid(row=1, column=0, sticky="nsew")
+        for i in range(len(headings)):
+            self._body.grid_columnconfigure(i, weight=1, uniform="col")
+        self._body.bind("<Configure>", self._chg_size)
+
+        self._scrollbar = ctk.CTkScrollbar(self, command=self._scroll)
+        self._scrollbar.grid(row=0, column=1, rowspan=2, sticky="ns")
+        self._loading = ctk.CTkLabel(self, text="Loading...")
+
+        for widget in (self, self._body):
+            self._bind_wheel(widget)
+        self._show(0)
+
+    def _bind_wheel(self, widget):
+        # Scroll with the mouse wheel over a widget (Button-4/5 are the wheel on X11)
+        widget.bind("<MouseWheel>", lambda e: self._show(self._pos - (1 if e.delta > 0 else -1) * 3))
+        widget.bind("<Button-4>", lambda e: self._show(self._pos - 3))
+        widget.bind("<Button-5>", lambda e: self._show(self._pos + 3))
+
+    def _chg_size(self, event):
+        # Make or drop row labels so the visible rows fill the body
+        visible = max(1, event.height // self.ROW_HEIGHT)
+        visible = min(visible, self.rows.page_size)
+        while len(self._cells) < visible:
+            r = len(self._cells)
+            cells = [ctk.CTkLabel(self._body, text="", anchor="w", height=self.ROW_HEIGHT) for _ in self.headings]
+            for i, cell in enumerate(cells):
+                cell.grid(row=r, column=i, sticky="ew", padx=4)
+                self._bind_wheel(cell)
+            self._cells.append(cells)
+        while len(self._cells) > visible:
+            for cell in self._cells.pop():
+                cell.destroy()
+        self._show(self._pos)
+
+    def destroy(self):
+        # Don't deliver rows to a destroyed table
+        self.loader.cancel(self)
+        super().destroy()
+
+    def _show(self, pos):
+        # Show the rows starting at pos in the row labels and move the scrollbar to match
+        total = len(self.rows)
+        self._pos = max(0, min(pos, total - len(self._cells)))
+        data = self.rows.peek(self._pos, len(self._cells)) if self._cells else []
+        if data is None:
+            # Load the rows on the worker and show whatever position the table is at when they arrive
+            self._loading.place(relx=0.5, rely=0.5, anchor="center")
+            pos, n = self._pos, len(self._cells)
+            self.loader.submit(self, lambda: self.rows.get(pos, n), lambda _: self._show(self._pos))
+            return
+        self._loading.place_forget()
+
+        for r, cells in enumerate(self._cells):
+            row = data[r] if r < len(data) else None
+            for i, cell in enumerate(cells):
+                cell.configure(text=self.formatters[i](row[i]) if row else "")
+        if total:
+            self._scrollbar.set(self._pos / total, min(1, (self._pos + len(self._cells)) / total))
+        else:
+            self._scrollbar.set(0, 1)
+
+    def _scroll(self, action, amount, unit=None):
+        # Scrollbar command, moves to a fraction of the rows or by a number of rows/pages
+        if action == "moveto":
+            self._show(round(float(amount) * len(self.rows)))
+        else:
+            step = len(self._cells) if unit == "pages" else 1
+            self._show(self._pos + int(amount) * step)
+
+    def _clk_heading(self, i):
+        # Sort by a column, or reverse the sort if it is already sorted by it
+        sort = self.sort_keys[i]
+        descending = not self.rows.descending if sort == self.rows.sort else False
+        self.rows.reset(sort, descending)
+        for j, button in enumerate(self._heading_buttons):
+            arrow = (" \u25bc" if descending else " \u25b2") if j == i else ""
+            button.configure(text=self.headings[j] + arrow)
+        self._show(0)
+
+
 def setup(dba: dbAccessor):
     """
     Get the active user account by getting one if it already exists,
@@ -194,7 +423,7 @@ def setup(dba: dbAccessor):
             return False
 
         # Save new ig account to database
-        startAcc = dba.obj_f.ig_account(-1, usrname, usr_abbrv, datetime.today().strftime(dba.date_format))
+        startAcc = dba.obj_f.ig_account(-1, usrname, usr_abbrv, dc.to_date_key(datetime.today()))
         startAcc.id = dba.save_ig_account(startAcc)
         if startAcc.id <= 0:
             warning(f"There was an issue saving {usrname} to the database", "Database Error")
@@ -0,0 +1,223 @@
+"""
+FC_Watch
+
+Watches the data directory and imports exports dropped into it in the background
+"""
+import os
+from os.path import exists, getmtime, getsize, isdir, join
+import re
+import sys
+import threading
+import time
+import zipfile
+import FC_ExportParser as ep
+from FC_Import import import_job, import_scheduler
+
+
+class export_watcher():
+    """
+    Polls a directory for dated exports and imports them with an import_scheduler, on a background thread once started.
+    Exports directly in the directory belong to the account whose username or abbreviation is in their name (the default account otherwise),
+    exports in a sub directory named after an account belong to that account.
+    An export is only imported once its files stopped changing for settle seconds, so exports still being copied are never read half written.
+    Exports that were already imported (same source files or date) are skipped by the import_scheduler without being parsed,
+    exports that failed to import are retried on the next poll.
+    """
+    # Parser processes per batch, half the CPUs so the UI and readers keep running while a batch imports
+    DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+    def __init__(self,
+                 dba,
+                 path: str = None,
+                 interval: float = 2.0,
+                 settle: float = 5.0,
+                 workers: int = None,
+                 delta: bool = False,
+                 acc_id: int = None,
+                 on_progress=None):
+        # dbAccessor imports are written through
+        self.dba = dba
+        # Directory watched, defaults to the active preferences' data_dir
+        self.path = path or dba.get_active_prefs().data_dir
+        # Seconds between polls, and seconds an export's files must stay unchanged before it is imported
+        self.interval = interval
+        self.settle = settle
+        self.workers = workers or self.DEFAULT_WORKERS
+        self.delta = delta
+        # Account of exports that don't name one, defaults to the preferences' default account
+        self.acc_id = acc_id
+        # on_progress(job) is called on the watcher's thread every time an import job changes state
+        self.on_progress = on_progress
+
+        # Path -> (signature, time it has been unchanged since)
+        self._seen = {}
+        # (account ID, source) -> signature the export was handled with, an export is looked at again only when its files change
+        self._handled = {}
+        # (name, signature) of entries already reported as skipped
+        self._reported = set()
+        # Exports found by the last poll that were still changing
+        self.unsettled = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    # region Service
+    def start(self):
+        """ Start watching on a background thread, returns the watcher."""
+        if not self.is_running():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="fc-watch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        """ Stop watching, a batch that is being imported is finished first when waiting."""
+        self._stop.set()
+        if wait and self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_running(self) -> bool:
+        """ Checks if the watcher's background thread is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        """ Poll until stopped, blocking the calling thread (start() runs this on a background thread)."""
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Watching {self.path} failed: {e}", file=sys.stderr)
+            self._stop.wait(self.interval)
+
+    def drain(self) -> list[import_job]:
+        """ Poll until every export in the directory was imported or skipped and none are still changing, returns the jobs that ran."""
+        jobs = self.poll()
+        while self.unsettled and not self._stop.is_set():
+            time.sleep(self.interval)
+            jobs += self.poll()
+        return jobs
+    # endregion
+
+    # region Poll
+    def poll(self) -> list[import_job]:
+        """ Look at the directory once and import the exports that settled since the last poll, returns their jobs."""
+        jobs = []
+        # Job -> (key, signature) it is handled with once it was imported or skipped
+        signatures = {}
+        self.unsettled = 0
+        found = set()
+        for acc_id, date, source in self._find_exports():
+            paths = source if isinstance(source, tuple) else (source,)
+            key = (acc_id, source)
+            found.add(key)
+            signature = tuple(self._get_signature(x) for x in paths)
+            if self._handled.get(key) == signature:
+                continue
+            if not all(self._is_settled(x) for x in paths):
+                self.unsettled += 1
+                continue
+
+            broken = next((x for x in paths if x.lower().endswith(".zip") and not zipfile.is_zipfile(x)), None)
+            if broken:
+                # Looked at again once it changes, e.g. when a stalled copy resumes
+                self._handled[key] = signature
+                print(f"Skipping {broken}, it isn't a complete zip", file=sys.stderr)
+                continue
+            job = import_job(acc_id, date, source, self.delta)
+            jobs.append(job)
+            signatures[job] = (key, signature)
+
+        # Forget exports that were removed, they are imported again if they come back with different files
+        self._handled = {k: v for k, v in self._handled.items() if k in found}
+        self._seen = {k: v for k, v in self._seen.items() if exists(k)}
+        if jobs:
+            import_scheduler(self.dba, self.workers, self.on_progress).run(jobs)
+            # Failed jobs aren't handled, they are retried on the next poll
+            for job in jobs:
+                if job.status in ("done", "skipped"):
+                    key, signature = signatures[job]
+                    self._handled[key] = signature
+        return jobs
+
+    def _find_exports(self):
+        # Yield (account ID, date, source) of every dated export in the directory and in account sub directories
+        if not isdir(self.path):
+            return
+        accounts = list(self.dba.get_ig_accounts().values())
+        default_id = self.acc_id if self.acc_id is not None else self.dba.get_active_prefs().default_acc_id
+        if self.dba.get_ig_account_by_id(default_id) is None:
+            default_id = None
+        names = {}
+        for name in sorted(os.listdir(self.path)):
+            full = join(self.path, name)
+            acc = self._get_folder_account(name, accounts) if isdir(full) else None
+            if acc:
+                exports, skipped = ep.find_dated_exports(full, self.dba.date_format)
+                self._report_skipped(full, skipped)
+                yield from ((acc.id, date, source) for date, source in exports)
+                continue
+            acc = self._get_name_account(name, accounts)
+            if acc or default_id is not None:
+                names.setdefault(acc.id if acc else default_id, []).append(name)
+            else:
+                self._report_skipped(self.path, [name], "no account in its name and no default account")
+
+        for acc_id, acc_names in names.items():
+            exports, skipped = ep.find_dated_exports(self.path, self.dba.date_format, acc_names)
+            self._report_skipped(self.path, skipped)
+            yield from ((acc_id, date, source) for date, source in exports)
+
+    @staticmethod
+    def _get_folder_account(name, accounts):
+        # Get the account a sub directory is named after (username or abbreviation), dated directories are exports
+        if ep.NUMERIC_DATE.search(name):
+            return None
+        return next((x for x in accounts if name.lower() in (x.username.lower(), x.abbrv.lower())), None)
+
+    @staticmethod
+    def _get_name_account(name, accounts):
+        # Get the account whose username or abbreviation appears in a name as a whole word, the longest match wins
+        name = name.lower()
+        best, best_len = None, 0
+        for acc in accounts:
+            for word in (acc.username.lower(), acc.abbrv.lower()):
+                if len(word) > best_len and re.search(rf"(?<![a-z0-9]){re.escape(word)}(?![a-z0-9])", name):
+                    best, best_len = acc, len(word)
+        return best
+
+    def _report_skipped(self, folder, names, reason="no date or no matching follower/following file"):
+        # Print skipped entries once they settled (a half copied pair is only missing its other file), and only once per version
+        for name in names:
+            full = join(folder, name)
+            signature = self._get_signature(full)
+            if (full, signature) not in self._reported and self._is_settled(full):
+                self._reported.add((full, signature))
+                print(f"Skipping {full}, {reason}", file=sys.stderr)
+    # endregion
+
+    # region Debounce
+    @staticmethod
+    def _get_signature(path) -> tuple:
+        # Size and newest modification time of a file, or of every file in a directory, None if it disappeared
+        try:
+            if not isdir(path):
+                return (getsize(path), getmtime(path))
+            size, newest, count = 0, getmtime(path), 0
+            for root, _, files in os.walk(path):
+                for f in files:
+                    full = join(root, f)
+                    size, newest, count = size + getsize(full), max(newest, getmtime(full)), count + 1
+            return (size, newest, count)
+        except OSError:
+            return None
+
+    def _is_settled(self, path) -> bool:
+        # Checks if a path stopped changing settle seconds ago. A path is unchanged since its newest modification time when first seen,
+        # since the poll it changed on otherwise
+        now = time.time()
+        signature = self._get_signature(path)
+        seen = self._seen.get(path)
+        if seen is None or seen[0] != signature:
+            since = now if seen is not None or signature is None else min(now, signature[1])
+            self._seen[path] = seen = (signature, since)
+        return signature is not None and now - seen[1] >= self.settle
+    # endregion
@@ -5,16 +5,30 @@ FollowerCenobite is gives a detailed view of Instagram data over time.
 FC is not a bot, it consumes JSON data about follows/likes and allows
 you to drill down and see your relationship with users across multiple
 accounts.
+
+Run without arguments for the UI, or with a command for headless imports and reports (FollowerCenobite.py -h).
 """
-from FC_DBAccess import dbAccessor
-from FC_UI import fc_app, setup, warning
+import sys
+import time
+
+# When the launcher started, the CLI reports its startup time from here
+LAUNCHED = time.perf_counter()
 
 
 class FollowerCenobite():
     """
     FC App Launcher, handles setup & context switching
+    Runs the UI without arguments, or a headless command (see FC_CLI) with them.
     """
-    def main(self):
+    def main(self, argv=None):
+        argv = sys.argv[1:] if argv is None else argv
+        if argv:
+            # Headless commands never import the UI stack (customtkinter, PIL)
+            from FC_CLI import fc_cli
+            return fc_cli.from_argv(argv, LAUNCHED).run()
+
+        from FC_DBAccess import dbAccessor
+        from FC_UI import fc_app, setup, warning
         self.dba = dbAccessor()
         if setup(self.dba):
             app = fc_app(self.dba)
@@ -25,4 +39,4 @@ class FollowerCenobite():
 
 if __name__ == "__main__":
     fc = FollowerCenobite()
-    fc.main()
+    sys.exit(fc.main())
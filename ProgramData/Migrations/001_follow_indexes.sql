@@ -0,0 +1,5 @@
+CREATE INDEX IF NOT EXISTS ix_follow_acc_user_date ON follow (acc_id, username, date);
+%GO%
+
+CREATE INDEX IF NOT EXISTS ix_follow_acc_date ON follow (acc_id, date);
+%GO%
@@ -0,0 +1,44 @@
+CREATE TABLE follow_v2 (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    acc_id INTEGER,
+    date INTEGER,
+    follower BOOLEAN,
+    following BOOLEAN,
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id)
+);
+%GO%
+
+INSERT INTO follow_v2 (id, username, acc_id, date, follower, following)
+    SELECT id, username, acc_id, fc_date(date), follower, following FROM follow;
+%GO%
+
+DROP TABLE follow;
+%GO%
+
+ALTER TABLE follow_v2 RENAME TO follow;
+%GO%
+
+CREATE INDEX ix_follow_acc_user_date ON follow (acc_id, username, date);
+%GO%
+
+CREATE INDEX ix_follow_acc_date ON follow (acc_id, date);
+%GO%
+
+CREATE TABLE ig_account_v2 (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE,
+    abbrv TEXT,
+    last_update INTEGER
+);
+%GO%
+
+INSERT INTO ig_account_v2 (id, username, abbrv, last_update)
+    SELECT id, username, abbrv, fc_date(last_update) FROM ig_account;
+%GO%
+
+DROP TABLE ig_account;
+%GO%
+
+ALTER TABLE ig_account_v2 RENAME TO ig_account;
+%GO%
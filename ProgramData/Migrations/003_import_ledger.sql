@@ -0,0 +1,20 @@
+CREATE TABLE imports (
+    id INTEGER PRIMARY KEY,
+    acc_id INTEGER,
+    date INTEGER,
+    source_hash TEXT,
+    source_hashes TEXT,
+    follow_count INTEGER,
+    last_follow_count INTEGER,
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id)
+);
+%GO%
+
+CREATE UNIQUE INDEX ix_imports_acc_source ON imports (acc_id, source_hash);
+%GO%
+
+ALTER TABLE follow ADD COLUMN import_id INTEGER REFERENCES imports (id);
+%GO%
+
+CREATE INDEX ix_follow_import ON follow (import_id);
+%GO%
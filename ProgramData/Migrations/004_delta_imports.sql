@@ -0,0 +1,16 @@
+ALTER TABLE imports ADD COLUMN delta BOOLEAN DEFAULT 0;
+%GO%
+
+INSERT INTO imports (acc_id, date, source_hash, source_hashes, follow_count, last_follow_count, delta)
+    SELECT acc_id, date, 'legacy-' || date, '[]', COUNT(*), 0, 0 FROM follow
+    WHERE import_id IS NULL
+    GROUP BY acc_id, date;
+%GO%
+
+UPDATE follow SET import_id = (
+    SELECT id FROM imports WHERE imports.acc_id = follow.acc_id AND imports.source_hash = 'legacy-' || follow.date)
+    WHERE import_id IS NULL;
+%GO%
+
+CREATE INDEX ix_imports_acc_date ON imports (acc_id, date);
+%GO%
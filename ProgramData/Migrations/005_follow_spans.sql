@@ -0,0 +1,19 @@
+CREATE TABLE follow_span (
+    id INTEGER PRIMARY KEY,
+    acc_id INTEGER,
+    username TEXT,
+    kind TEXT,
+    valid_from INTEGER,
+    valid_to INTEGER,
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id)
+);
+%GO%
+
+CREATE INDEX ix_span_user ON follow_span (acc_id, username, kind, valid_to);
+%GO%
+
+CREATE INDEX ix_span_from ON follow_span (acc_id, kind, valid_from);
+%GO%
+
+CREATE INDEX ix_span_to ON follow_span (acc_id, kind, valid_to);
+%GO%
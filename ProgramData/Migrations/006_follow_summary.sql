@@ -0,0 +1,13 @@
+CREATE TABLE follow_summary (
+    acc_id INTEGER,
+    date INTEGER,
+    follower INTEGER,
+    following INTEGER,
+    dfb INTEGER,
+    idfb INTEGER,
+    gained INTEGER,
+    lost INTEGER,
+    PRIMARY KEY (acc_id, date),
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id)
+);
+%GO%
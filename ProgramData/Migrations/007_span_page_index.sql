@@ -0,0 +1,5 @@
+DROP INDEX ix_span_to;
+%GO%
+
+CREATE INDEX ix_span_to ON follow_span (acc_id, kind, valid_to, valid_from, username);
+%GO%
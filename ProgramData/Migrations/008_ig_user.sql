@@ -0,0 +1,73 @@
+CREATE TABLE ig_user (
+    id INTEGER PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL
+);
+%GO%
+
+INSERT INTO ig_user (username)
+    SELECT username FROM follow WHERE username IS NOT NULL GROUP BY username ORDER BY MIN(id);
+%GO%
+
+INSERT OR IGNORE INTO ig_user (username)
+    SELECT username FROM last_follows WHERE username IS NOT NULL;
+%GO%
+
+CREATE TABLE follow_v3 (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    acc_id INTEGER,
+    date INTEGER,
+    follower BOOLEAN,
+    following BOOLEAN,
+    import_id INTEGER,
+    FOREIGN KEY (user_id) REFERENCES ig_user (id),
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id),
+    FOREIGN KEY (import_id) REFERENCES imports (id)
+);
+%GO%
+
+INSERT INTO follow_v3 (id, user_id, acc_id, date, follower, following, import_id)
+    SELECT f.id, u.id, f.acc_id, f.date, f.follower, f.following, f.import_id
+    FROM follow f
+    LEFT JOIN ig_user u ON u.username = f.username;
+%GO%
+
+DROP TABLE follow;
+%GO%
+
+ALTER TABLE follow_v3 RENAME TO follow;
+%GO%
+
+CREATE INDEX ix_follow_acc_user_date ON follow (acc_id, user_id, date);
+%GO%
+
+CREATE INDEX ix_follow_acc_date ON follow (acc_id, date);
+%GO%
+
+CREATE INDEX ix_follow_import ON follow (import_id);
+%GO%
+
+CREATE TABLE last_follows_v2 (
+    user_id INTEGER,
+    acc_id INTEGER,
+    last_following_id INTEGER,
+    last_follower_id INTEGER,
+    PRIMARY KEY (acc_id, user_id),
+    FOREIGN KEY (user_id) REFERENCES ig_user (id),
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id),
+    FOREIGN KEY (last_following_id) REFERENCES follow (id),
+    FOREIGN KEY (last_follower_id) REFERENCES follow (id)
+);
+%GO%
+
+INSERT INTO last_follows_v2 (user_id, acc_id, last_following_id, last_follower_id)
+    SELECT u.id, lf.acc_id, lf.last_following_id, lf.last_follower_id
+    FROM last_follows lf
+    JOIN ig_user u ON u.username = lf.username;
+%GO%
+
+DROP TABLE last_follows;
+%GO%
+
+ALTER TABLE last_follows_v2 RENAME TO last_follows;
+%GO%
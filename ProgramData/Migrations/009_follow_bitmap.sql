@@ -0,0 +1,9 @@
+CREATE TABLE follow_bitmap (
+    acc_id INTEGER,
+    date INTEGER,
+    kind TEXT,
+    bits BLOB,
+    PRIMARY KEY (acc_id, kind, date),
+    FOREIGN KEY (acc_id) REFERENCES ig_account (id)
+);
+%GO%
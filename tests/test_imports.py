@@ -0,0 +1,166 @@
+"""
+Import path equivalence checks, run from the repository root with: python -m unittest discover tests
+
+Every way of importing the same snapshots (full, delta, streamed, scheduled, out of order, rolled back or upgraded from an
+original FC database) must leave the same relationships, bitmaps and summaries behind. Databases are kept in memory.
+"""
+import json
+from os.path import join
+import random
+import sqlite3
+import unittest
+from unittest import mock
+from tempfile import TemporaryDirectory
+import FC_DataClasses as dc
+import FC_ExportParser as ep
+from FC_Benchmark import export_generator
+from FC_DBAccess import dbAccessor
+from FC_Import import import_job, import_scheduler
+
+# Test About.json and the startup account every import goes to
+ABOUT = "ProgramData/TestData/TEST_FC_About.json"
+ACC_ID = 1
+
+
+class import_equivalence(unittest.TestCase):
+    """ Compares databases that imported the same synthetic snapshots in different ways."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory()
+        cls.exports = export_generator(users=400, snapshots=5, churn=0.1).generate(cls.tmp.name)["bench_acc_0"]
+        cls.dates = [date for date, _, _ in cls.exports]
+        # (date, followers, following) of every snapshot, read back from the exports
+        cls.snapshots = [(date, cls._read_users(flwr_json), cls._read_users(flwg_json)) for date, flwr_json, flwg_json in cls.exports]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    @staticmethod
+    def _read_users(path):
+        # Get the usernames in an export
+        with open(path, encoding="utf-8") as f:
+            return {x["username"] for x in next(iter(json.load(f).values()))}
+
+    def _mk_db(self, exports=None, **kwargs):
+        # Make an in-memory database and import exports (all of them by default) with munch_follow_data
+        db = dbAccessor(ABOUT, memory=True)
+        self.addCleanup(db.close)
+        for date, flwr_json, flwg_json in self.exports if exports is None else exports:
+            db.munch_follow_data(flwr_json, flwg_json, ACC_ID, date, **kwargs)
+        return db
+
+    def _get_state(self, db):
+        # Get everything the import paths must agree on: per date and kind the related usernames from spans and from bitmaps, and the summaries
+        acc = db.get_ig_account_by_id(ACC_ID)
+        state = {}
+        for date in self.dates:
+            for kind in ("follower", "following"):
+                bitmap = db.get_bitmap(acc, date, kind)
+                state[(date, kind)] = (set(db.get_relations_at(acc, date, kind)), set(db.obj_f.fmt_users(list(bitmap))) if bitmap else None)
+        state["summaries"] = [(x.date, x.follower, x.following, x.dfb, x.idfb, x.gained, x.lost) for x in db.get_summaries(acc)]
+        return state
+
+    def test_full_matches_snapshots(self):
+        state = self._get_state(self._mk_db())
+        previous = None
+        for date, flwr, flwg in self.snapshots:
+            self.assertEqual(state[(date, "follower")], (flwr, flwr))
+            self.assertEqual(state[(date, "following")], (flwg, flwg))
+            summary = next(x for x in state["summaries"] if x[0] == date)
+            gained, lost = (len(flwr - previous), len(previous - flwr)) if previous is not None else (0, 0)
+            self.assertEqual(summary, (date, len(flwr), len(flwg), len(flwg - flwr), len(flwr - flwg), gained, lost))
+            previous = flwr
+
+    def test_delta_matches_full(self):
+        self.assertEqual(self._get_state(self._mk_db(delta=True)), self._get_state(self._mk_db()))
+
+    def test_streamed_matches_full(self):
+        self.assertEqual(self._get_state(self._mk_db(stream=True)), self._get_state(self._mk_db()))
+
+    def test_scheduled_matches_full(self):
+        db = self._mk_db([])
+        jobs = import_scheduler(db, 1).run([import_job(ACC_ID, date, (flwr_json, flwg_json)) for date, flwr_json, flwg_json in self.exports])
+        self.assertEqual([job.status for job in jobs], ["done"] * len(jobs))
+        self.assertEqual(self._get_state(db), self._get_state(self._mk_db()))
+
+    def test_out_of_order_matches_full(self):
+        shuffled = list(self.exports)
+        random.Random(1).shuffle(shuffled)
+        self.assertEqual(self._get_state(self._mk_db(shuffled)), self._get_state(self._mk_db()))
+
+    def test_rollback_matches_fresh(self):
+        for index in (2, len(self.exports) - 1):
+            db = self._mk_db()
+            import_id = next(x.id for x in db.get_imports() if x.date == self.dates[index])
+            db.rollback_import(import_id)
+            self.assertEqual(self._get_state(db), self._get_state(self._mk_db(self.exports[:index] + self.exports[index + 1:])))
+
+    def test_duplicate_files_are_skipped(self):
+        db = self._mk_db()
+        date, flwr_json, flwg_json = self.exports[0]
+        self.assertIsNone(db.munch_follow_data(flwr_json, flwg_json, ACC_ID, self.dates[-1] + 1))
+        self.assertEqual(self._get_state(db), self._get_state(self._mk_db()))
+
+    def test_same_date_is_skipped(self):
+        # A second, different export for a date that was already imported must not be merged into that date's snapshot
+        db = self._mk_db()
+        date, flwr, _ = self.snapshots[2]
+        flwr_json = join(self.tmp.name, "followers_again.json")
+        with open(flwr_json, "w", encoding="utf-8") as f:
+            json.dump({"relationships_followers": [{"username": x} for x in flwr | {"late_follower"}]}, f)
+        self.assertIsNone(db.munch_follow_data(flwr_json, self.exports[2][2], ACC_ID, date))
+        self.assertEqual(self._get_state(db), self._get_state(self._mk_db()))
+
+    def test_scheduler_skips_imported_without_parsing(self):
+        db = self._mk_db()
+        jobs = [import_job(ACC_ID, date, (flwr_json, flwg_json)) for date, flwr_json, flwg_json in self.exports]
+        with mock.patch.object(ep, "parse_snapshot", side_effect=AssertionError("parsed")) as parse:
+            import_scheduler(db, 1).run(jobs)
+        parse.assert_not_called()
+        self.assertEqual([job.status for job in jobs], ["skipped"] * len(jobs))
+
+    def test_upgrade_from_original_schema(self):
+        with TemporaryDirectory() as folder:
+            db = dbAccessor(self._mk_original_db(folder))
+            self.addCleanup(db.close)
+            self.assertEqual(db.get_schema_version(), db._get_migrations()[-1][0])
+            self.assertEqual(self._get_state(db), self._get_state(self._mk_db()))
+            db.close()
+
+    def _mk_original_db(self, folder):
+        # Write the snapshots to a database the way FC saved them before migrations existed (creation script schema, dates as
+        # text in the About.json format, usernames on every row), returns its About.json
+        with open(ABOUT) as f:
+            about = json.load(f)
+        about.update(DataFolder=folder + "/", DBName="original.db")
+        about_path = join(folder, "about.json")
+        with open(about_path, "w") as f:
+            json.dump(about, f)
+        with open("ProgramData/TestData/FC_Startup_Data.json") as f:
+            startup = json.load(f)
+        with open("ProgramData/TestData/dbCreationScript.sql") as f:
+            script = f.read()
+
+        conn = sqlite3.connect(join(folder, "original.db"))
+        for statement in script.split(about["DBCmdDelim"]):
+            conn.execute(statement)
+        conn.executemany("INSERT INTO ig_account VALUES (?, ?, ?, ?);", startup["startup_acc"])
+        conn.executemany("INSERT INTO preferences (default_acc_id, progress_dir, data_dir, ig_url) VALUES (?, ?, ?, ?);",
+                         [x[1:] for x in startup["startup_prefs"]])
+        follow_id, newest = 0, {}
+        for date, flwr, flwg in self.snapshots:
+            text = dc.from_date_key(date).strftime(about["DateFormat"])
+            for user in sorted(flwr | flwg):
+                follow_id += 1
+                conn.execute("INSERT INTO follow VALUES (?, ?, ?, ?, ?, ?);", (follow_id, user, ACC_ID, text, user in flwr, user in flwg))
+                newest[user] = follow_id
+        conn.executemany("INSERT INTO last_follows VALUES (?, ?, ?, ?);", [(user, ACC_ID, x, x) for user, x in newest.items()])
+        conn.commit()
+        conn.close()
+        return about_path
+
+
+if __name__ == "__main__":
+    unittest.main()
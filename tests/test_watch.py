@@ -0,0 +1,48 @@
+"""
+Export watcher checks, run from the repository root with: python -m unittest discover tests
+"""
+import json
+from os.path import join
+import unittest
+from tempfile import TemporaryDirectory
+from FC_DBAccess import dbAccessor
+from FC_Watch import export_watcher
+
+# Test About.json and the startup account exports are imported to
+ABOUT = "ProgramData/TestData/TEST_FC_About.json"
+ACC_ID = 1
+DATE = 20240501
+
+
+class watcher_retry(unittest.TestCase):
+    """ Polls a directory with one export pair that fails to import until it is fixed."""
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db = dbAccessor(ABOUT, memory=True)
+        self.addCleanup(self.db.close)
+        self.watcher = export_watcher(self.db, tmp.name, settle=0, workers=1, acc_id=ACC_ID)
+        self.flwr_json = join(tmp.name, f"followers_{DATE}.json")
+        self.flwg_json = join(tmp.name, f"following_{DATE}.json")
+        self._write(self.flwg_json, {"relationships_following": [{"username": "followed"}]})
+
+    @staticmethod
+    def _write(path, data):
+        # Write data as json, or a string as is
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+
+    def test_failed_export_is_retried(self):
+        self._write(self.flwr_json, "[{\"username\": ")
+        self.assertEqual([x.status for x in self.watcher.poll()], ["failed"])
+        self.assertEqual([x.status for x in self.watcher.poll()], ["failed"])
+
+        self._write(self.flwr_json, [{"username": "follower"}])
+        self.assertEqual([x.status for x in self.watcher.poll()], ["done"])
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.db.get_relations_at(self.db.get_ig_account_by_id(ACC_ID), DATE, "follower"), ["follower"])
+
+
+if __name__ == "__main__":
+    unittest.main()